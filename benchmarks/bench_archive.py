@@ -0,0 +1,66 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Compares the time and size of saving and loading a Kompanion as a binary archive (`Kompanion.save` / `load`), with
+pickle and with JSON (one record per phase, as written by `JsonLinesSink`).
+
+    python benchmarks/bench_archive.py   (with kopylog installed or on the PYTHONPATH)
+"""
+import json
+import pickle
+from io import BytesIO
+from timeit import repeat
+
+from kopylog import Kompanion
+from kopylog.sinks import phase_to_record
+
+
+def _create_kompanion(nb_phases):
+    pi = Kompanion()
+    for i in range(nb_phases):
+        with pi.add_new_phase('phase_%s' % i) as phase:
+            phase.status = 'ok'
+            phase.nb_items = i
+            phase.ratio = i / 3
+            phase.tags = ['a', 'b']
+    return pi
+
+
+def main(nb_phases=20000):
+    pi = _create_kompanion(nb_phases)
+
+    def save_archive():
+        f = BytesIO()
+        pi.save(f)
+        return f
+
+    def save_pickle():
+        return pickle.dumps(pi.phases.values(), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def save_json():
+        return '\n'.join(json.dumps(phase_to_record(p), default=str) for p in pi.phases.values()).encode('utf-8')
+
+    archive, pickled, jsoned = save_archive(), save_pickle(), save_json()
+
+    def load_archive():
+        archive.seek(0)
+        return Kompanion.load(archive)
+
+    def load_pickle():
+        return pickle.loads(pickled)
+
+    def load_json():
+        return [json.loads(line) for line in jsoned.splitlines()]
+
+    for name, save, load, size in (('archive', save_archive, load_archive, len(archive.getvalue())),
+                                   ('pickle', save_pickle, load_pickle, len(pickled)),
+                                   ('json', save_json, load_json, len(jsoned))):
+        save_s = min(repeat(save, number=1, repeat=3))
+        load_s = min(repeat(load, number=1, repeat=3))
+        print("%-8s save %7.1f ms  load %7.1f ms  %6.1f bytes/phase" % (name, save_s * 1e3, load_s * 1e3,
+                                                                       size / nb_phases))
+
+
+if __name__ == '__main__':
+    main()
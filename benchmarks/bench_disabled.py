@@ -0,0 +1,50 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Compares the cost of an instrumented `with kompanion.add_new_phase(...)` block when the Kompanion is disabled, with
+the cost of an empty `with` block and of an enabled Kompanion.
+
+    python benchmarks/bench_disabled.py   (with kopylog installed or on the PYTHONPATH)
+"""
+from timeit import repeat
+
+from kopylog import Kompanion
+
+
+class _EmptyContext(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def main(number=200000):
+    ctx = _EmptyContext()
+    disabled = Kompanion(enabled=False)
+    enabled = Kompanion(enabled=True)
+
+    def empty_with():
+        with ctx as p:
+            pass
+
+    def disabled_phase():
+        with disabled.add_new_phase('p') as p:
+            p.foo = 1
+
+    def enabled_phase():
+        with enabled.add_new_phase('p') as p:
+            p.foo = 1
+
+    for name, func in (('empty with block', empty_with),
+                       ('disabled Kompanion', disabled_phase),
+                       ('enabled Kompanion', enabled_phase)):
+        best = min(repeat(func, number=number, repeat=5))
+        print("%-20s %8.1f ns/op" % (name, best / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Measures the per-operation cost of the instrumentation: creating phases with `Kompanion.add_new_phase`, entering and
+exiting them, getting and setting `OrderedMunch` attributes, `TypedTable.append`, rendering and columnar export, with
+10, 10k and 1M phases.
+
+Results are printed, and can be saved as JSON with `--output`. When a `--baseline` JSON file is given, the results are
+compared with it and the script exits with status 1 if an operation is slower than its baseline by more than
+`--threshold` (25% by default). Baselines only make sense on the machine where they were created: use
+`--update-baseline` to create or refresh one.
+
+    python benchmarks/bench_overhead.py --baseline overhead.json [--sizes 10 10000] [--threshold 0.25]
+    python benchmarks/bench_overhead.py --baseline overhead.json --update-baseline
+
+(with kopylog installed or on the PYTHONPATH)
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+from time import perf_counter
+
+from kopylog import Kompanion, PhaseInfo
+from kopylog.utils_bags import OrderedMunch
+from kopylog.utils_render import render
+from kopylog.utils_tables import TypedTable
+
+try:  # python 3.5+
+    from typing import Dict, Iterable, List
+except ImportError:
+    pass
+
+DEFAULT_SIZES = (10, 10000, 1000000)
+DEFAULT_THRESHOLD = 0.25
+
+_MIN_OPS = 100000
+""" Small sizes are repeated so that each measurement covers at least this number of phases """
+
+
+# ------- Operations: each function prepares the data for `loops` runs over `n` phases, and returns the function to
+# time. Small sizes are repeated `loops` times so that the measured duration is significant.
+def _add_new_phase(n, loops):
+    ids = ['phase_%s' % i for i in range(n)]
+    kompanions = [Kompanion() for _ in range(loops)]
+
+    def run():
+        for pi in kompanions:
+            add = pi.add_new_phase
+            for phase_id in ids:
+                add(phase_id, start=False)
+    return run
+
+
+def _enter_exit(n, loops):
+    # a phase can only be started once: create them all beforehand
+    phases = [PhaseInfo('phase_%s' % i, start=False) for i in range(n * loops)]
+
+    def run():
+        for p in phases:
+            with p:
+                pass
+    return run
+
+
+def _munch_set(n, loops):
+    keys = ['key_%s' % i for i in range(n)]
+
+    def run():
+        for _ in range(loops):
+            m = OrderedMunch()
+            for k in keys:
+                setattr(m, k, 1)
+    return run
+
+
+def _munch_get(n, loops):
+    keys = ['key_%s' % i for i in range(n)]
+    m = OrderedMunch(initial_pairs=[(k, 1) for k in keys])
+
+    def run():
+        for _ in range(loops):
+            for k in keys:
+                getattr(m, k)
+    return run
+
+
+def _table_append(n, loops):
+    phases = [PhaseInfo('phase_%s' % i, start=False) for i in range(n)]
+
+    def run():
+        for _ in range(loops):
+            append = TypedTable(PhaseInfo, 'phase_id').append
+            for p in phases:
+                append(p)
+    return run
+
+
+def _render(n, loops):
+    m = OrderedMunch(initial_pairs=[('key_%s' % i, i) for i in range(n)])
+
+    def run():
+        # a single operation, bounded by the rendering budget whatever the size
+        for _ in range(loops):
+            render(m)
+    return run
+
+
+def _export(n, loops):
+    pi = Kompanion()
+    for i in range(n):
+        with pi.add_new_phase('phase_%s' % i) as p:
+            p.nb_items = i
+
+    def run():
+        for _ in range(loops):
+            pi.to_columns()
+    return run
+
+
+OPERATIONS = (
+    # name, setup, whether a run performs one operation per phase (otherwise a single one)
+    ('add_new_phase', _add_new_phase, True),
+    ('enter_exit', _enter_exit, True),
+    ('munch_set', _munch_set, True),
+    ('munch_get', _munch_get, True),
+    ('table_append', _table_append, True),
+    ('render', _render, False),
+    ('export_to_columns', _export, True),
+)
+
+
+def measure(sizes=DEFAULT_SIZES,  # type: Iterable[int]
+            repeat=5              # type: int
+            ):
+    # type: (...) -> Dict[str, float]
+    """
+    Measures all operations at all sizes.
+
+    :param sizes: the numbers of phases
+    :param repeat: the number of measurements, the best one is kept
+    :return: a dict '<operation>[<size>]' -> time per operation, in nanoseconds
+    """
+    results = dict()
+    for name, setup, per_phase in OPERATIONS:
+        for n in sizes:
+            nb_ops = n if per_phase else 1
+            loops = max(1, _MIN_OPS // n) if per_phase else 100
+            best = None
+            for _ in range(repeat):
+                run = setup(n, loops)
+                gc.collect()
+                t = perf_counter()
+                run()
+                elapsed = perf_counter() - t
+                best = elapsed if best is None else min(best, elapsed)
+                del run
+            results['%s[%s]' % (name, n)] = best / (loops * nb_ops) * 1e9
+    return results
+
+
+def compare(results,   # type: Dict[str, float]
+            baseline,  # type: Dict[str, float]
+            threshold  # type: float
+            ):
+    # type: (...) -> List[str]
+    """ Returns the operations slower than their baseline by more than `threshold` (a ratio, 0.25 is 25%) """
+    return [op for op, ns in results.items() if op in baseline and ns > baseline[op] * (1 + threshold)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="the numbers of phases")
+    parser.add_argument('--repeat', type=int, default=5, help="the number of measurements, the best one is kept")
+    parser.add_argument('--output', help="a JSON file where to write the results")
+    parser.add_argument('--baseline', help="a JSON file of results to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="the accepted slowdown ratio with respect to the baseline")
+    parser.add_argument('--update-baseline', action='store_true', help="write the results to the baseline file")
+    args = parser.parse_args(argv)
+
+    results = measure(sizes=args.sizes, repeat=args.repeat)
+
+    baseline = dict()
+    if args.baseline and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    for op, ns in results.items():
+        line = "%-28s %12.1f ns/op" % (op, ns)
+        if op in baseline:
+            line += "  %+6.1f%%" % ((ns / baseline[op] - 1) * 100)
+        print(line)
+
+    report = dict(python=sys.version.split()[0], platform=platform.platform(), results=results)
+    for path in (args.output, args.baseline if args.update_baseline else None):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("Slower than the baseline by more than %.0f%%: %s" % (args.threshold * 100, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Measures the time to build an `ArchiveIndex` over many archived runs, and to query it.
+
+    python benchmarks/bench_query.py   (with kopylog installed or on the PYTHONPATH)
+"""
+import os
+import tempfile
+from datetime import datetime
+from glob import glob
+from time import perf_counter
+
+from kopylog import Kompanion
+from kopylog.query import ArchiveIndex
+
+
+def _save_runs(directory, nb_runs, nb_phases):
+    for run in range(nb_runs):
+        pi = Kompanion()
+        for i in range(nb_phases):
+            with pi.add_new_phase('phase_%s' % i) as phase:
+                phase.nb_items = i
+        pi.save(os.path.join(directory, 'run%s.kparch' % run), metadata={'run_id': 'run%s' % run})
+
+
+def main(nb_runs=50, nb_phases=20000):
+    with tempfile.TemporaryDirectory() as directory:
+        _save_runs(directory, nb_runs, nb_phases)
+        archives = sorted(glob(os.path.join(directory, '*.kparch')))
+        size = sum(os.path.getsize(a) for a in archives)
+        print("%s runs, %s phases, %.1f MB of archives" % (nb_runs, nb_runs * nb_phases, size / 1e6))
+
+        t = perf_counter()
+        ArchiveIndex.build(os.path.join(directory, 'index'), archives)
+        print("build index            %7.1f ms" % ((perf_counter() - t) * 1e3))
+
+        t = perf_counter()
+        ArchiveIndex.build(os.path.join(directory, 'index'), archives)
+        print("update index (no change) %5.1f ms" % ((perf_counter() - t) * 1e3))
+
+        t = perf_counter()
+        index = ArchiveIndex(os.path.join(directory, 'index'))
+        print("open index             %7.1f ms" % ((perf_counter() - t) * 1e3))
+
+        for name, kwargs in (('by phase id', dict(phase_id='phase_7')),
+                             ('by phase id and time', dict(phase_id='phase_7', start=datetime(2000, 1, 1))),
+                             ('by duration (scan)', dict(min_seconds=1e-3)),
+                             ('with attribute', dict(phase_id='phase_7', run_id='run3', attributes=['nb_items']))):
+            t = perf_counter()
+            cols = index.query(**kwargs)
+            print("query %-20s %7.1f ms  %s rows" % (name, (perf_counter() - t) * 1e3, len(cols['run_id'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Measures the time to compare the phase durations of two sets of runs with `kopylog.regression.compare_samples`.
+
+    python benchmarks/bench_regression.py   (with kopylog installed or on the PYTHONPATH)
+"""
+from time import perf_counter
+
+import numpy as np
+
+from kopylog.regression import compare_samples
+
+
+def main(nb_runs=2000, nb_phases=300):
+    rng = np.random.default_rng(0)
+    baseline = rng.lognormal(0, 0.2, (nb_runs, nb_phases))
+    candidate = rng.lognormal(0, 0.2, (nb_runs, nb_phases))
+    # a few slower phases, and a few missing values
+    candidate[:, :5] *= 1.05
+    baseline[rng.random(baseline.shape) < 0.01] = np.nan
+    phase_ids = ['phase_%s' % i for i in range(nb_phases)]
+
+    t = perf_counter()
+    table = compare_samples(phase_ids, baseline, candidate, seed=0)
+    print("%s x 2 runs, %s phases: %.2f s, %s regressions detected" % (nb_runs, nb_phases, perf_counter() - t,
+                                                                     table['regression'].sum()))
+
+
+if __name__ == '__main__':
+    main()
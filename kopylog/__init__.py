@@ -1,4 +1,12 @@
-from .main import Kompanion, PhaseInfo
+from .main import Kompanion, PhaseInfo, NullPhase, NULL_PHASE, set_enabled, is_enabled, \
+    get_current_phase
+from .utils_tables import RetentionPolicy
+from .utils_stats import PhaseStats
+from .utils_sampling import Sampler, EveryNSampler, RateSampler
+from .spill import SpillPolicy, SpillHandle
+from .decorators import phase
+from .collectors import Collector, CpuTimeCollector, ThreadTimeCollector, RusageCollector, IOCollector, \
+    TracemallocCollector, RssCollector, StackSamplerCollector
 
 try:
     # -- Distribution mode --
@@ -14,7 +22,12 @@ except ImportError:
 __all__ = [
     '__version__',
     # submodules
-    'main',
+    'main', 'aio', 'parallel', 'export', 'sinks', 'decorators', 'snapshots', 'spill', 'archive', 'query',
+    'regression', 'collectors',
     # symbols
-    'Kompanion', 'PhaseInfo'
+    'Kompanion', 'PhaseInfo', 'NullPhase', 'NULL_PHASE', 'set_enabled', 'is_enabled',
+    'get_current_phase', 'RetentionPolicy', 'PhaseStats', 'phase',
+    'Sampler', 'EveryNSampler', 'RateSampler', 'SpillPolicy', 'SpillHandle',
+    'Collector', 'CpuTimeCollector', 'ThreadTimeCollector', 'RusageCollector', 'IOCollector',
+    'TracemallocCollector', 'RssCollector', 'StackSamplerCollector'
 ]
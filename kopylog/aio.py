@@ -0,0 +1,123 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+asyncio support: measure the time that each phase actually spends running on the event loop.
+
+Phases can be used with `async with`, and the current phase follows asyncio tasks since it is stored in a context
+variable. In addition, if tasks are created by the `timed_task_factory` (see `install_loop_timer` and `run`), each
+phase running in them gets a `loop_seconds` duration: the time during which its task was actually running on the event
+loop, as opposed to awaiting. A phase with a large `loop_seconds` blocks the event loop.
+"""
+import asyncio
+from collections.abc import Coroutine
+
+from kopylog.utils_clock import perf_counter_ns, _loop_clock
+
+try:  # python 3.5+
+    from typing import Any, Optional, Awaitable
+except ImportError:
+    pass
+
+
+class TimedCoroutine(Coroutine):
+    """
+    A wrapper around a coroutine, measuring the time spent in each of its steps. It is installed as the loop clock of
+    its task's context at its first step, so that phases running in this task can read it.
+    """
+    __slots__ = '_coro', 'run_ns', '_step_start'
+
+    def __init__(self, coro):
+        self._coro = coro
+        self.run_ns = 0
+        self._step_start = None
+
+    def now_ns(self):
+        # type: (...) -> Optional[int]
+        """
+        Returns the cumulated time that the task spent running so far, or None if it is not currently running (for
+        example if the caller is another task that inherited our context).
+        """
+        step_start = self._step_start
+        if step_start is None:
+            return None
+        return self.run_ns + perf_counter_ns() - step_start
+
+    def send(self, value):
+        if _loop_clock.get() is not self:
+            # first step: we run in the context of our task, that may have inherited the clock of its parent task
+            _loop_clock.set(self)
+        self._step_start = start = perf_counter_ns()
+        try:
+            return self._coro.send(value)
+        finally:
+            self.run_ns += perf_counter_ns() - start
+            self._step_start = None
+
+    def throw(self, typ, val=None, tb=None):
+        self._step_start = start = perf_counter_ns()
+        try:
+            if val is None and tb is None:
+                return self._coro.throw(typ)
+            return self._coro.throw(typ, val, tb)
+        finally:
+            self.run_ns += perf_counter_ns() - start
+            self._step_start = None
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self._coro)
+
+
+def timed_task_factory(loop,  # type: asyncio.AbstractEventLoop
+                       coro,  # type: Any
+                       **kwargs
+                       ):
+    # type: (...) -> asyncio.Task
+    """
+    An asyncio task factory wrapping each task's coroutine in a `TimedCoroutine`. See `loop.set_task_factory`.
+    """
+    return asyncio.Task(TimedCoroutine(coro), loop=loop, **kwargs)
+
+
+def install_loop_timer(loop=None  # type: asyncio.AbstractEventLoop
+                       ):
+    """
+    Installs `timed_task_factory` on the given loop (default: the running loop). Only tasks created afterwards are
+    timed: use `run` to also time the main task.
+
+    :param loop:
+    :return:
+    """
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    loop.set_task_factory(timed_task_factory)
+
+
+async def _run_with_loop_timer(main):
+    install_loop_timer()
+    return await main
+
+
+def run(main,  # type: Awaitable
+        **kwargs
+        ):
+    """
+    Equivalent of `asyncio.run(main)` where all tasks, including the main one, are timed.
+
+    :param main: the main coroutine
+    :param kwargs: other arguments for `asyncio.run`
+    :return:
+    """
+    return asyncio.run(TimedCoroutine(_run_with_loop_timer(main)), **kwargs)
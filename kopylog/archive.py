@@ -0,0 +1,1048 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+A compact binary archive format for the phases of a `Kompanion`. See `Kompanion.save` and `Kompanion.load`.
+
+An archive is made of a header, blocks of phases, a footer and a trailer (all integers are little-endian):
+
+ - header: the magic bytes `KPARCH03`
+ - blocks: up to `BLOCK_SIZE` consecutive phases each, stored column by column: the phase ids (indices in the string
+   table), the indices of their parent phases, the indices of their anchors, the start counters, the durations, the
+   durations spent on the event loop, the time covered by the children unlinked from them and the end of this
+   union of intervals (see `Kompanion(keep_phases=False)`), and the indices of their attribute layouts. Then the
+   attribute values, column by column, for each layout used in the block.
+ - footer: the string table (phase ids, attribute names and short string values, each stored once), the table of
+   attribute layouts, the table of `WallClockAnchor`s, the JSON metadata of the run, and the offset and number of
+   phases of each block
+ - trailer: the offset of the footer, and the magic bytes again
+
+Phases are written by blocks, so the footer is only written when the archive is closed. Readers first read the
+footer, and can then decode any block without reading the others (see `ArchiveReader`).
+
+Integer columns store the offsets from their minimum value, with the narrowest unsigned width that holds them, or a
+single value when they are constant, and an optional mask of missing values. For example the start counters of a
+block usually take 4 bytes per phase, and the layout indices nothing. The layout of the attributes of a phase is the
+tuple of their names. An attribute column holding only short strings (as string table indices), only integers, only
+floats, only booleans or only None is stored as a packed array. A column of lists (or tuples) is stored as the column
+of their lengths, followed by the column of all their items. Other columns are stored value by value with a type
+tag: None, booleans, integers, floats, strings, bytes, naive datetimes, lists, tuples, dicts, and numpy arrays with a
+non-object dtype have compact encodings, and other values are pickled. Decoding restores values of the same types,
+exactly.
+
+Columns are encoded and decoded in bulk, and phases are restored without calling their constructor: saving and
+loading are faster than pickling the phases, and archives are smaller.
+"""
+import json
+import pickle
+import sys
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from itertools import accumulate, chain, filterfalse, islice, repeat
+from mmap import mmap, ACCESS_READ
+from operator import add, attrgetter, sub
+from struct import Struct
+from weakref import WeakKeyDictionary
+
+from kopylog.main import PhaseInfo, _build_phase, _build_phases, _gc_paused, _set
+from kopylog.spill import SpillHandle, load_spilled
+from kopylog.utils_clock import WallClockAnchor
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+try:  # python 3.5+
+    from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+    from kopylog.main import Kompanion
+    Record = Tuple[str, WallClockAnchor, Optional[int], Optional[int], Optional[int], Dict[str, Any]]
+except ImportError:
+    pass
+
+
+MAGIC = b'KPARCH03'
+
+BLOCK_SIZE = 4096
+""" The maximum number of phases in a block """
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+_UINT8 = Struct('<B')
+_UINT32 = Struct('<I')
+_INT64 = Struct('<q')
+_ANCHOR = Struct('<qq')
+_BLOCK = Struct('<QI')
+_TRAILER = Struct('<Q8s')
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+
+# value type tags
+_NONE, _FALSE, _TRUE, _INT32, _INT64_TAG, _BIGINT, _FLOAT, _STR, _BYTES, _DATETIME, _LIST, _TUPLE, _DICT, _NDARRAY, \
+    _PICKLE, _INTERNED = range(16)
+
+# the tag and the payload of the most frequent values, packed at once
+_TAGGED_INT32 = Struct('<Bi')
+_TAGGED_INT64 = Struct('<Bq')
+_TAGGED_FLOAT = Struct('<Bd')
+_TAGGED_UINT32 = Struct('<BI')
+_TAG_NONE, _TAG_FALSE, _TAG_TRUE = bytes((_NONE,)), bytes((_FALSE,)), bytes((_TRUE,))
+
+# integer columns: a constant, packed offsets from the minimum, or only missing values
+_CONSTANT, _PACKED, _ALL_MISSING = range(3)
+_INT_COLUMN = Struct('<BBBq')
+""" The header of an integer column: its kind, 1 if a mask of missing values follows, its width and its minimum """
+
+_WIDTH_CODES = tuple(next(c for c in 'BHILQ' if array(c).itemsize == size) for size in (1, 2, 4, 8))
+""" The `array` type codes of the unsigned integers of 1, 2, 4 and 8 bytes """
+
+_NP_WIDTHS = ('<u1', '<u2', '<u4', '<u8')
+""" The numpy dtypes of the same little-endian unsigned integers """
+
+# attribute column tags
+_STR_COLUMN, _INT_COLUMN_TAG, _FLOAT_COLUMN, _BOOL_COLUMN, _NONE_COLUMN, _VALUES_COLUMN, _LIST_COLUMN, \
+    _TUPLE_COLUMN = range(8)
+
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+_MAX_INTERNED_LEN = 64
+""" String values up to this length are stored in the string table """
+
+_get_id = attrgetter('phase_id')
+_get_parent = attrgetter('_parent')
+_get_anchor = attrgetter('_anchor')
+_get_start = attrgetter('_start_ns')
+_get_end = attrgetter('_end_ns')
+_get_loop = attrgetter('_loop_ns')
+_get_unlinked = attrgetter('_unlinked')
+_get_children = attrgetter('_children')
+_get_odict = attrgetter('odict')
+
+
+# ------- Encoding
+class _InternTable(object):
+    """ Interns hashable values (strings, attribute names layouts) while writing """
+    __slots__ = 'values', 'indices'
+
+    def __init__(self):
+        self.values = []    # type: List[Any]
+        self.indices = {}   # type: Dict[Any, int]
+
+    def index(self, v):
+        # type: (...) -> int
+        try:
+            return self.indices[v]
+        except KeyError:
+            idx = self.indices[v] = len(self.values)
+            self.values.append(v)
+            return idx
+
+    def index_all(self, values):
+        # type: (...) -> List[int]
+        values = values if isinstance(values, (list, tuple)) else list(values)
+        indices = self.indices
+        try:
+            return list(map(indices.__getitem__, values))
+        except KeyError:
+            # register the new values at once, in order of first appearance
+            new = list(filterfalse(indices.__contains__, dict.fromkeys(values)))
+            indices.update(zip(new, range(len(self.values), len(self.values) + len(new))))
+            self.values += new
+            return list(map(indices.__getitem__, values))
+
+
+def _encode_value(value,    # type: Any
+                  buf,      # type: bytearray
+                  strings   # type: _InternTable
+                  ):
+    """ Appends the typed encoding of `value` to `buf` """
+    t = type(value)
+    if t is str:
+        if len(value) <= _MAX_INTERNED_LEN:
+            buf += _TAGGED_UINT32.pack(_INTERNED, strings.index(value))
+        else:
+            _encode_bytes(_STR, value.encode('utf-8'), buf)
+    elif t is int:
+        if -2 ** 31 <= value < 2 ** 31:
+            buf += _TAGGED_INT32.pack(_INT32, value)
+        elif INT64_MIN <= value < 2 ** 63:
+            buf += _TAGGED_INT64.pack(_INT64_TAG, value)
+        else:
+            _encode_bytes(_BIGINT, str(value).encode('ascii'), buf)
+    elif t is float:
+        buf += _TAGGED_FLOAT.pack(_FLOAT, value)
+    elif value is None:
+        buf += _TAG_NONE
+    elif t is bool:
+        buf += _TAG_TRUE if value else _TAG_FALSE
+    elif t is bytes:
+        _encode_bytes(_BYTES, value, buf)
+    elif t is datetime and value.tzinfo is None:
+        buf += _TAGGED_INT64.pack(_DATETIME, (value - _EPOCH) // _ONE_US)
+    elif t is list or t is tuple:
+        buf += _TAGGED_UINT32.pack(_LIST if t is list else _TUPLE, len(value))
+        for item in value:
+            _encode_value(item, buf, strings)
+    elif t is dict:
+        buf += _TAGGED_UINT32.pack(_DICT, len(value))
+        for k, v in value.items():
+            _encode_value(k, buf, strings)
+            _encode_value(v, buf, strings)
+    elif np is not None and t is np.ndarray and not value.dtype.hasobject and value.dtype.names is None:
+        buf += _TAGGED_UINT32.pack(_NDARRAY, strings.index(value.dtype.str))
+        buf += _UINT8.pack(value.ndim)
+        for dim in value.shape:
+            buf += _INT64.pack(dim)
+        buf += np.ascontiguousarray(value).tobytes()
+    else:
+        _encode_bytes(_PICKLE, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), buf)
+
+
+def _encode_bytes(tag, b, buf):
+    buf += _TAGGED_UINT32.pack(tag, len(b))
+    buf += b
+
+
+def _encode_ints(values,  # type: List[Optional[int]]
+                 buf      # type: bytearray
+                 ):
+    """ Appends an integer column to `buf`. None values are missing. The other values should fit in 64 bits. """
+    if np is not None:
+        try:
+            arr = np.array(values, dtype=np.int64)
+        except TypeError:
+            pass  # some values are missing
+        else:
+            _encode_ints_np(arr, buf)
+            return
+    mask = None
+    try:
+        lo, hi = min(values), max(values)
+    except TypeError:
+        lo = None
+    if lo is None:
+        # some values are missing: they are replaced with the minimum, and a mask is stored
+        present = [v for v in values if v is not None]
+        if not present:
+            buf += _INT_COLUMN.pack(_ALL_MISSING, 0, 0, 0)
+            return
+        lo, hi = min(present), max(present)
+        mask = bytes([v is None for v in values])
+        values = [lo if v is None else v for v in values]
+
+    if lo == hi:
+        buf += _INT_COLUMN.pack(_CONSTANT, mask is not None, 0, lo)
+        if mask is not None:
+            buf += mask
+        return
+
+    span = hi - lo
+    width = 0 if span < 1 << 8 else 1 if span < 1 << 16 else 2 if span < 1 << 32 else 3
+    buf += _INT_COLUMN.pack(_PACKED, mask is not None, width, lo)
+    if mask is not None:
+        buf += mask
+    arr = array(_WIDTH_CODES[width], map(sub, values, repeat(lo)) if lo else values)
+    if _BIG_ENDIAN:
+        arr.byteswap()
+    buf += arr.tobytes()
+
+
+def _encode_ints_np(arr,  # type: np.ndarray
+                    buf   # type: bytearray
+                    ):
+    """ Vectorized version of `_encode_ints`, for an int64 array without missing values """
+    lo, hi = int(arr.min()), int(arr.max())
+    if lo == hi:
+        buf += _INT_COLUMN.pack(_CONSTANT, 0, 0, lo)
+        return
+    span = hi - lo
+    width = 0 if span < 1 << 8 else 1 if span < 1 << 16 else 2 if span < 1 << 32 else 3
+    buf += _INT_COLUMN.pack(_PACKED, 0, width, lo)
+    # the offsets are computed modulo 2**64, so that a span larger than the int64 range does not overflow
+    buf += (arr.view(np.uint64) - np.uint64(lo % (1 << 64))).astype(_NP_WIDTHS[width]).tobytes()
+
+
+def _encode_column(col,     # type: Tuple[Any, ...]
+                   buf,     # type: bytearray
+                   strings  # type: _InternTable
+                   ):
+    """ Appends an attribute column to `buf`: packed if all values have the same simple type, else value by value """
+    types = set(map(type, col))
+    if SpillHandle in types:
+        # the spill files are temporary: the values themselves are archived
+        col = tuple(load_spilled(list(col)))
+        types = set(map(type, col))
+    if len(types) == 1:
+        t = types.pop()
+        if (t is str or t is int) and col.count(col[0]) == len(col):
+            # a constant column, for example a status
+            if t is int and INT64_MIN <= col[0] <= INT64_MAX:
+                buf.append(_INT_COLUMN_TAG)
+                buf += _INT_COLUMN.pack(_CONSTANT, 0, 0, col[0])
+                return
+            elif t is str and len(col[0]) <= _MAX_INTERNED_LEN:
+                buf.append(_STR_COLUMN)
+                buf += _INT_COLUMN.pack(_CONSTANT, 0, 0, strings.index(col[0]))
+                return
+        if t is str:
+            if max(map(len, col)) <= _MAX_INTERNED_LEN:
+                buf.append(_STR_COLUMN)
+                _encode_ints(strings.index_all(col), buf)
+                return
+        elif t is int:
+            if INT64_MIN <= min(col) and max(col) <= INT64_MAX:
+                buf.append(_INT_COLUMN_TAG)
+                _encode_ints(col, buf)
+                return
+        elif t is float:
+            buf.append(_FLOAT_COLUMN)
+            arr = array('d', col)
+            if _BIG_ENDIAN:
+                arr.byteswap()
+            buf += arr.tobytes()
+            return
+        elif t is bool:
+            buf.append(_BOOL_COLUMN)
+            buf += bytes(col)
+            return
+        elif t is type(None):
+            buf.append(_NONE_COLUMN)
+            return
+        elif t is list or t is tuple:
+            # the lengths, then all items as a single column
+            buf.append(_LIST_COLUMN if t is list else _TUPLE_COLUMN)
+            _encode_ints(list(map(len, col)), buf)
+            _encode_column(tuple(chain.from_iterable(col)), buf, strings)
+            return
+    buf.append(_VALUES_COLUMN)
+    for value in col:
+        _encode_value(value, buf, strings)
+
+
+def _encode_strings(strings,  # type: List[str]
+                    buf       # type: bytearray
+                    ):
+    """ Appends a list of strings to `buf`: their number, their lengths in characters, then all of them at once """
+    buf += _UINT32.pack(len(strings))
+    if strings:
+        _encode_ints(list(map(len, strings)), buf)
+    b = ''.join(strings).encode('utf-8')
+    buf += _UINT32.pack(len(b))
+    buf += b
+
+
+def _datetime_to_us(dt  # type: datetime
+                    ):
+    # type: (...) -> int
+    return (dt - _EPOCH) // _ONE_US
+
+
+class ArchiveWriter(object):
+    """
+    Writes phases to an archive. Phases are encoded by blocks of `BLOCK_SIZE`: a phase should not be modified until
+    its block is written, which is at the latest when the archive is closed. The archive is only complete once `close`
+    is called, which writes the footer. It can be used as a context manager.
+    """
+    __slots__ = '_file', '_own_file', 'metadata', '_strings', '_layouts', '_anchors', '_anchor_indices', '_blocks', \
+                '_records', '_pending', '_pos', '_nb_phases'
+
+    def __init__(self,
+                 file,          # type: Union[str, BinaryIO]
+                 metadata=None  # type: Mapping[str, Any]
+                 ):
+        """
+
+        :param file: a path or a binary file object open for writing
+        :param metadata: an optional JSON-serializable mapping stored in the footer, for example a run id
+        """
+        # fail now rather than when the archive is closed, and before creating the file
+        self.metadata = dict(metadata or ())
+        json.dumps(self.metadata)
+
+        if isinstance(file, str):
+            self._file = open(file, 'wb')
+            self._own_file = True
+        else:
+            self._file = file
+            self._own_file = False
+        self._strings = _InternTable()
+        # most phases share the same attributes layout: blocks only reference it
+        self._layouts = _InternTable()
+        # the anchors are stored once by value. The anchor objects have the default identity hash.
+        self._anchors = {}          # type: Dict[Tuple[int, int], int]
+        self._anchor_indices = {}   # type: Dict[WallClockAnchor, int]
+        self._blocks = []           # type: List[Tuple[int, int]]
+        # the index of each phase written, while it is alive: the written phases can be freed, see `_write_block`
+        self._records = WeakKeyDictionary()  # type: WeakKeyDictionary
+        self._pending = []          # type: List[PhaseInfo]
+        self._file.write(MAGIC)
+        self._pos = len(MAGIC)
+        self._nb_phases = 0
+
+    def _check_anchor(self,
+                      anchor  # type: WallClockAnchor
+                      ):
+        """ Registers the anchor of a phase to write, or raises a ValueError if it can not be stored """
+        if anchor in self._anchor_indices:
+            return
+        wall_time = anchor.wall_time
+        if wall_time.tzinfo is not None:
+            raise ValueError("Only anchors with a naive wall-clock datetime can be archived: %r" % wall_time)
+        key = _datetime_to_us(wall_time), anchor.counter_ns
+        try:
+            idx = self._anchors[key]
+        except KeyError:
+            idx = self._anchors[key] = len(self._anchors)
+        self._anchor_indices[anchor] = idx
+
+    def write_phase(self,
+                    phase  # type: PhaseInfo
+                    ):
+        """
+        Appends a phase. Its parent is referenced if it was written before, while it was running or had children.
+        Phase ids must be strings.
+
+        :param phase:
+        :return:
+        """
+        _check_ids((phase.phase_id,))
+        self._check_anchor(phase._anchor)
+        pending = self._pending
+        pending.append(phase)
+        if len(pending) >= BLOCK_SIZE:
+            self._write_block(pending)
+            self._pending = []
+
+    def write_phases(self,
+                     phases  # type: Iterable[PhaseInfo]
+                     ):
+        """
+        Appends several phases, see `write_phase`.
+
+        :param phases:
+        :return:
+        """
+        phases = list(phases)
+        _check_ids(list(map(_get_id, phases)))
+        for anchor in dict.fromkeys(map(_get_anchor, phases)):
+            self._check_anchor(anchor)
+        pending = self._pending
+        pending.extend(phases)
+        if len(pending) >= BLOCK_SIZE:
+            for i in range(0, len(pending) - BLOCK_SIZE + 1, BLOCK_SIZE):
+                self._write_block(pending[i:i + BLOCK_SIZE])
+            self._pending = pending[i + BLOCK_SIZE:]
+
+    def _parent_indices(self,
+                        parents  # type: List[Optional[PhaseInfo]]
+                        ):
+        # type: (...) -> List[Optional[int]]
+        """ Returns the indices of the parents of the block being written, or None if they were not written before """
+        get_record = self._records.get
+        indices = [None if p is None else get_record(p) for p in parents]
+        return [None if q is None or q >= i else q for i, q in enumerate(indices, self._nb_phases)]
+
+    def _write_block(self,
+                     phases  # type: List[PhaseInfo]
+                     ):
+        """ Encodes and writes a block of phases """
+        n = len(phases)
+        strings = self._strings
+
+        ids, parents, anchors, starts, ends, loops, unlinked, odicts = (list(map(getter, phases)) for getter in (
+            _get_id, _get_parent, _get_anchor, _get_start, _get_end, _get_loop, _get_unlinked, _get_odict))
+
+        # only the phases that can be the parent of a phase written later are indexed: the running ones and the ones
+        # with children. They are referenced weakly, so that a streamed phase is freed once it is written, and an
+        # entry is removed with its phase, so that its id can be reused safely.
+        if None in ends or any(map(_get_children, phases)):
+            self._records.update((p, i) for i, p in enumerate(phases, self._nb_phases)
+                                 if p._end_ns is None or p._children)
+        # the parents are referenced if they were written before
+        if parents.count(None) != n:
+            parents = self._parent_indices(parents)
+        if anchors.count(anchors[0]) == n:
+            anchors = [self._anchor_indices[anchors[0]]] * n
+        else:
+            anchors = list(map(self._anchor_indices.__getitem__, anchors))
+        try:
+            elapsed = list(map(sub, ends, starts))
+        except TypeError:
+            elapsed = [None if e is None or s is None else e - s for s, e in zip(starts, ends)]
+        if unlinked.count(None) == n:
+            covered = union_ends = unlinked
+        else:
+            covered, union_ends = zip(*[(None, None) if u is None else u for u in unlinked])
+        names = list(map(tuple, odicts))
+        layouts = self._layouts.index_all(names)
+
+        buf = bytearray()
+        _encode_ints(strings.index_all(ids), buf)
+        _encode_ints(parents, buf)
+        _encode_ints(anchors, buf)
+        _encode_ints(starts, buf)
+        _encode_ints(elapsed, buf)
+        _encode_ints(loops, buf)
+        _encode_ints(list(covered), buf)
+        _encode_ints(list(union_ends), buf)
+        _encode_ints(layouts, buf)
+
+        # the attribute values of each layout, column by column
+        for layout, rows in _group_rows(layouts):
+            if names[0 if rows is None else rows[0]]:
+                for col in zip(*map(dict.values, odicts if rows is None else [odicts[i] for i in rows])):
+                    _encode_column(col, buf, strings)
+
+        self._file.write(buf)
+        self._blocks.append((self._pos, n))
+        self._pos += len(buf)
+        self._nb_phases += n
+
+    def close(self):
+        """ Writes the last block, the footer and the trailer, and closes the file if it was opened here """
+        if self._file is None:
+            return
+        try:
+            if self._pending:
+                self._write_block(self._pending)
+                self._pending = []
+
+            footer = bytearray()
+            strings = self._strings
+            # the layouts reference attribute names in the string table
+            layouts = [strings.index_all(names) for names in self._layouts.values]
+            _encode_strings(strings.values, footer)
+            footer += _UINT32.pack(len(layouts))
+            for layout in layouts:
+                footer += _UINT32.pack(len(layout))
+                footer += Struct('<%sI' % len(layout)).pack(*layout)
+            footer += _UINT32.pack(len(self._anchors))
+            for (wall_us, counter_ns), _ in sorted(self._anchors.items(), key=lambda a: a[1]):
+                footer += _ANCHOR.pack(wall_us, counter_ns)
+            metadata = json.dumps(self.metadata).encode('utf-8')
+            footer += _UINT32.pack(len(metadata))
+            footer += metadata
+            footer += _UINT32.pack(len(self._blocks))
+            for block in self._blocks:
+                footer += _BLOCK.pack(*block)
+            footer += _TRAILER.pack(self._pos, MAGIC)
+            self._file.write(footer)
+        finally:
+            if self._own_file:
+                self._file.close()
+            self._file = None
+            self._pending = None
+            self._records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _check_ids(ids  # type: List[Any]
+               ):
+    """ Raises a TypeError if a phase id can not be stored in the string table """
+    if not all(map(isinstance, ids, repeat(str))):
+        bad = next(i for i in ids if not isinstance(i, str))
+        raise TypeError("Only phases with a str id can be archived: %r" % (bad,))
+
+
+def _group_rows(layouts  # type: List[int]
+                ):
+    # type: (...) -> List[Tuple[int, Optional[List[int]]]]
+    """
+    Returns the positions of the rows of each layout, in the order of the layout indices. The positions are None when
+    all rows have the same layout.
+    """
+    distinct = set(layouts)
+    if len(distinct) == 1:
+        return [(distinct.pop(), None)]
+    rows = {layout: [] for layout in sorted(distinct)}
+    for i, layout in enumerate(layouts):
+        rows[layout].append(i)
+    return list(rows.items())
+
+
+def save_archive(kompanion,      # type: Kompanion
+                 file,           # type: Union[str, BinaryIO]
+                 metadata=None   # type: Mapping[str, Any]
+                 ):
+    """
+    Writes all phases of `kompanion` to an archive.
+
+    :param kompanion:
+    :param file: a path or a binary file object open for writing
+    :param metadata: an optional JSON-serializable mapping stored in the archive, for example a run id
+    :return:
+    """
+    with ArchiveWriter(file, metadata) as writer, _gc_paused():
+        writer.write_phases(kompanion.phases.values())
+
+
+# ------- Decoding
+def _decode_value(data,    # type: bytes
+                  pos,     # type: int
+                  strings  # type: List[str]
+                  ):
+    # type: (...) -> Tuple[Any, int]
+    """ Decodes the value at `data[pos]`, and returns it with the position of the next value """
+    tag = data[pos]
+    if tag == _INTERNED:
+        return strings[_TAGGED_UINT32.unpack_from(data, pos)[1]], pos + 5
+    elif tag == _INT32:
+        return _TAGGED_INT32.unpack_from(data, pos)[1], pos + 5
+    elif tag == _FLOAT:
+        return _TAGGED_FLOAT.unpack_from(data, pos)[1], pos + 9
+    elif tag == _INT64_TAG:
+        return _TAGGED_INT64.unpack_from(data, pos)[1], pos + 9
+    elif tag == _NONE:
+        return None, pos + 1
+    elif tag == _TRUE:
+        return True, pos + 1
+    elif tag == _FALSE:
+        return False, pos + 1
+    elif tag == _DATETIME:
+        return _EPOCH + timedelta(microseconds=_TAGGED_INT64.unpack_from(data, pos)[1]), pos + 9
+
+    n = _TAGGED_UINT32.unpack_from(data, pos)[1]
+    pos += 5
+    if tag == _LIST or tag == _TUPLE or tag == _DICT:
+        items = []
+        for _ in range(2 * n if tag == _DICT else n):
+            item, pos = _decode_value(data, pos, strings)
+            items.append(item)
+        if tag == _LIST:
+            return items, pos
+        elif tag == _TUPLE:
+            return tuple(items), pos
+        else:
+            return dict(zip(items[::2], items[1::2])), pos
+    elif tag == _NDARRAY:
+        dtype = np.dtype(strings[n])
+        ndim = data[pos]
+        shape = Struct('<%sq' % ndim).unpack_from(data, pos + 1)
+        pos += 1 + 8 * ndim
+        count = 1
+        for dim in shape:
+            count *= dim
+        arr = np.frombuffer(data, dtype=dtype, count=count, offset=pos).reshape(shape).copy()
+        return arr, pos + count * dtype.itemsize
+
+    b = bytes(data[pos:pos + n])
+    if tag == _STR:
+        return b.decode('utf-8'), pos + n
+    elif tag == _BYTES:
+        return b, pos + n
+    elif tag == _BIGINT:
+        return int(b.decode('ascii')), pos + n
+    elif tag == _PICKLE:
+        return pickle.loads(b), pos + n
+    raise ValueError("Unknown value type tag in archive: %s" % tag)
+
+
+def _decode_ints(data,  # type: bytes
+                 pos,   # type: int
+                 n      # type: int
+                 ):
+    # type: (...) -> Tuple[List[Optional[int]], int]
+    """ Decodes the integer column of `n` values at `data[pos]`, and returns it with the position of what follows """
+    kind, has_mask, width, lo = _INT_COLUMN.unpack_from(data, pos)
+    pos += _INT_COLUMN.size
+    if kind == _ALL_MISSING:
+        return [None] * n, pos
+    if has_mask:
+        mask = data[pos:pos + n]
+        pos += n
+    if kind == _CONSTANT:
+        values = [lo] * n
+    elif np is not None:
+        end = pos + n * (1 << width)
+        arr = np.frombuffer(data, _NP_WIDTHS[width], n, pos).astype(np.uint64)
+        values = (arr + np.uint64(lo % (1 << 64))).view(np.int64).tolist()
+        pos = end
+    else:
+        arr = array(_WIDTH_CODES[width])
+        end = pos + n * arr.itemsize
+        arr.frombytes(data[pos:end])
+        if _BIG_ENDIAN:
+            arr.byteswap()
+        values = arr.tolist()
+        if lo:
+            values = [v + lo for v in values]
+        pos = end
+    if has_mask:
+        values = [None if m else v for m, v in zip(mask, values)]
+    return values, pos
+
+
+def _decode_strings(data,  # type: bytes
+                    pos    # type: int
+                    ):
+    # type: (...) -> Tuple[List[str], int]
+    """ Decodes a list of strings written by `_encode_strings`, and returns it with the position of what follows """
+    n, = _UINT32.unpack_from(data, pos)
+    pos += 4
+    lengths, pos = _decode_ints(data, pos, n) if n else ([], pos)
+    size, = _UINT32.unpack_from(data, pos)
+    pos += 4
+    text = bytes(data[pos:pos + size]).decode('utf-8')
+    ends = list(accumulate(lengths))
+    return list(map(text.__getitem__, map(slice, [0] + ends, ends))), pos + size
+
+
+def _decode_column(data,    # type: bytes
+                   pos,     # type: int
+                   n,       # type: int
+                   strings  # type: List[str]
+                   ):
+    # type: (...) -> Tuple[List[Any], int]
+    """ Decodes the attribute column of `n` values at `data[pos]`, and returns it with the position of what follows """
+    tag = data[pos]
+    pos += 1
+    if tag == _STR_COLUMN:
+        indices, pos = _decode_ints(data, pos, n)
+        return list(map(strings.__getitem__, indices)), pos
+    elif tag == _INT_COLUMN_TAG:
+        return _decode_ints(data, pos, n)
+    elif tag == _FLOAT_COLUMN:
+        arr = array('d')
+        arr.frombytes(data[pos:pos + 8 * n])
+        if _BIG_ENDIAN:
+            arr.byteswap()
+        return arr.tolist(), pos + 8 * n
+    elif tag == _BOOL_COLUMN:
+        return list(map(bool, data[pos:pos + n])), pos + n
+    elif tag == _NONE_COLUMN:
+        return [None] * n, pos
+    elif tag == _LIST_COLUMN or tag == _TUPLE_COLUMN:
+        lengths, pos = _decode_ints(data, pos, n)
+        items, pos = _decode_column(data, pos, sum(lengths), strings)
+        items = iter(items)
+        seq = list if tag == _LIST_COLUMN else tuple
+        return [seq(islice(items, length)) for length in lengths], pos
+    elif tag == _VALUES_COLUMN:
+        values = []
+        for _ in range(n):
+            value, pos = _decode_value(data, pos, strings)
+            values.append(value)
+        return values, pos
+    raise ValueError("Unknown column tag in archive: %s" % tag)
+
+
+class _Block(object):
+    """ The decoded columns of a block. `attrs` holds None for the phases without attributes. """
+    __slots__ = 'ids', 'parents', 'anchors', 'starts', 'ends', 'loops', 'unlinked', 'attrs'
+
+    def __init__(self, ids, parents, anchors, starts, ends, loops, unlinked, attrs):
+        self.ids = ids              # type: List[str]
+        self.parents = parents      # type: List[Optional[int]]
+        self.anchors = anchors      # type: List[WallClockAnchor]
+        self.starts = starts        # type: List[Optional[int]]
+        self.ends = ends            # type: List[Optional[int]]
+        self.loops = loops          # type: List[Optional[int]]
+        self.unlinked = unlinked    # type: List[Optional[Tuple[int, int]]]
+        self.attrs = attrs          # type: List[Optional[Dict[str, Any]]]
+
+    def record(self, k):
+        # type: (...) -> Tuple[Record, int]
+        attrs = self.attrs[k]
+        parent = self.parents[k]
+        return (self.ids[k], self.anchors[k], self.starts[k], self.ends[k], self.loops[k],
+                dict(attrs) if attrs is not None else dict()), -1 if parent is None else parent
+
+    def phase(self, k):
+        # type: (...) -> PhaseInfo
+        """ Builds the `k`-th phase, as a standalone phase """
+        phase = _record_to_phase(self.record(k)[0], None)
+        _set(phase, '_unlinked', self.unlinked[k])
+        return phase
+
+
+def _ends(starts,   # type: List[Optional[int]]
+          elapsed   # type: List[Optional[int]]
+          ):
+    # type: (...) -> List[Optional[int]]
+    try:
+        return list(map(add, starts, elapsed))
+    except TypeError:
+        return [None if d is None else s + d for s, d in zip(starts, elapsed)]
+
+
+class ArchiveReader(object):
+    """
+    Reads an archive written by `ArchiveWriter`. Only the footer is read when opening it: phases are decoded on
+    demand by blocks, with `read_record` / `read_phase`, or one block after the other with `iter_records` / iteration
+    and `read_into`. It can be used as a context manager.
+    """
+    __slots__ = '_file', '_own_file', 'strings', 'layouts', 'anchors', 'metadata', 'blocks', '_firsts', \
+                '_records_end', '_map', '_cached'
+
+    def __init__(self,
+                 file,            # type: Union[str, BinaryIO]
+                 use_mmap=False   # type: bool
+                 ):
+        """
+
+        :param file: a path or a seekable binary file object open for reading
+        :param use_mmap: True to memory-map the file, so that reading a block only touches its pages. The file object
+            must then have a `fileno()`.
+        """
+        if isinstance(file, str):
+            self._file = open(file, 'rb')
+            self._own_file = True
+        else:
+            self._file = file
+            self._own_file = False
+        f = self._file
+        f.seek(0)
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a kopylog archive, or an archive written by another version of kopylog")
+        trailer_pos = f.seek(0, 2) - _TRAILER.size
+        if trailer_pos < len(MAGIC):
+            raise ValueError("Incomplete kopylog archive: the footer is missing")
+        f.seek(trailer_pos)
+        footer_pos, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("Incomplete kopylog archive: the footer is missing")
+        self._records_end = footer_pos
+        f.seek(footer_pos)
+        footer = f.read(trailer_pos - footer_pos)
+
+        strings, pos = _decode_strings(footer, 0)
+        self.strings = strings  # type: List[str]
+
+        n, = _UINT32.unpack_from(footer, pos)
+        pos += 4
+        layouts = []
+        for _ in range(n):
+            length, = _UINT32.unpack_from(footer, pos)
+            indices = Struct('<%sI' % length).unpack_from(footer, pos + 4)
+            layouts.append(tuple(strings[j] for j in indices))
+            pos += 4 + 4 * length
+        self.layouts = layouts  # type: List[Tuple[str, ...]]
+
+        n, = _UINT32.unpack_from(footer, pos)
+        pos += 4
+        anchors = []
+        for _ in range(n):
+            wall_us, counter_ns = _ANCHOR.unpack_from(footer, pos)
+            anchors.append(WallClockAnchor(_EPOCH + timedelta(microseconds=wall_us), counter_ns))
+            pos += _ANCHOR.size
+        self.anchors = anchors  # type: List[WallClockAnchor]
+
+        length, = _UINT32.unpack_from(footer, pos)
+        self.metadata = json.loads(footer[pos + 4:pos + 4 + length].decode('utf-8'))  # type: Dict[str, Any]
+        pos += 4 + length
+
+        n, = _UINT32.unpack_from(footer, pos)
+        pos += 4
+        # the offset and number of phases of each block
+        self.blocks = [_BLOCK.unpack_from(footer, pos + i * _BLOCK.size) for i in range(n)]
+        # the index of the first phase of each block
+        self._firsts = [0]
+        for _, size in self.blocks:
+            self._firsts.append(self._firsts[-1] + size)
+
+        self._map = mmap(f.fileno(), 0, access=ACCESS_READ) if use_mmap else None
+        self._cached = None
+
+    def __len__(self):
+        return self._firsts[-1]
+
+    def _block_data(self, b):
+        # type: (...) -> bytes
+        start = self.blocks[b][0]
+        end = self.blocks[b + 1][0] if b + 1 < len(self.blocks) else self._records_end
+        if self._map is not None:
+            return self._map[start:end]
+        f = self._file
+        f.seek(start)
+        return f.read(end - start)
+
+    def _decode_headers(self, b):
+        # type: (...) -> Tuple[bytes, int, List[Optional[int]], ...]
+        """ Decodes the columns of block `b` that precede the attributes """
+        data = self._block_data(b)
+        n = self.blocks[b][1]
+        ids, pos = _decode_ints(data, 0, n)
+        parents, pos = _decode_ints(data, pos, n)
+        anchors, pos = _decode_ints(data, pos, n)
+        starts, pos = _decode_ints(data, pos, n)
+        elapsed, pos = _decode_ints(data, pos, n)
+        loops, pos = _decode_ints(data, pos, n)
+        covered, pos = _decode_ints(data, pos, n)
+        union_ends, pos = _decode_ints(data, pos, n)
+        layouts, pos = _decode_ints(data, pos, n)
+        if covered.count(None) == n:
+            unlinked = covered
+        else:
+            unlinked = [None if c is None else (c, e) for c, e in zip(covered, union_ends)]
+        return data, pos, ids, parents, anchors, starts, elapsed, loops, unlinked, layouts
+
+    def _decode_block(self, b):
+        # type: (...) -> _Block
+        data, pos, ids, parents, anchors, starts, elapsed, loops, unlinked, layouts = self._decode_headers(b)
+        n = len(ids)
+        strings = self.strings
+        attrs = [None] * n
+        for layout, rows in _group_rows(layouts):
+            names = self.layouts[layout]
+            if not names:
+                continue
+            m = n if rows is None else len(rows)
+            columns = []
+            for _ in names:
+                col, pos = _decode_column(data, pos, m, strings)
+                columns.append(col)
+            dicts = list(map(dict, map(zip, repeat(names), zip(*columns))))
+            if rows is None:
+                attrs = dicts
+            else:
+                for i, d in zip(rows, dicts):
+                    attrs[i] = d
+        return _Block(list(map(strings.__getitem__, ids)), parents, list(map(self.anchors.__getitem__, anchors)),
+                      starts, _ends(starts, elapsed), loops, unlinked, attrs)
+
+    def _cached_block(self, b):
+        # type: (...) -> _Block
+        cached = self._cached
+        if cached is None or cached[0] != b:
+            cached = self._cached = b, self._decode_block(b)
+        return cached[1]
+
+    def read_headers(self):
+        # type: (...) -> Tuple[List[int], List[int], List[Optional[int]], List[Optional[int]]]
+        """
+        Decodes the phase ids (as indices in `strings`), the anchor indices (in `anchors`), the start counters and
+        the end counters of all phases, without their attributes.
+
+        :return: a tuple of four lists, with None for the missing counters
+        """
+        ids, anchors, starts, ends = [], [], [], []
+        for b in range(len(self.blocks)):
+            _, _, b_ids, _, b_anchors, b_starts, b_elapsed, _, _, _ = self._decode_headers(b)
+            ids += b_ids
+            anchors += b_anchors
+            starts += b_starts
+            ends += _ends(b_starts, b_elapsed)
+        return ids, anchors, starts, ends
+
+    def read_record(self,
+                    i  # type: int
+                    ):
+        # type: (...) -> Tuple[Record, int]
+        """
+        Decodes the record of the `i`-th phase, without reading the other blocks. The last block read is kept, so
+        reading records in order only decodes each block once.
+
+        :param i:
+        :return: a tuple ((phase_id, anchor, start_ns, end_ns, loop_ns, attributes), parent_index)
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        b = bisect_right(self._firsts, i) - 1
+        return self._cached_block(b).record(i - self._firsts[b])
+
+    def iter_records(self):
+        """ Decodes all records one block after the other. See `read_record`. """
+        for b in range(len(self.blocks)):
+            block = self._decode_block(b)
+            for k in range(len(block.ids)):
+                yield block.record(k)
+
+    def read_phase(self,
+                   i  # type: int
+                   ):
+        # type: (...) -> PhaseInfo
+        """ Decodes the `i`-th phase, as a standalone phase (it has no parent) """
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        b = bisect_right(self._firsts, i) - 1
+        return self._cached_block(b).phase(i - self._firsts[b])
+
+    def __iter__(self):
+        # type: (...) -> Iterator[PhaseInfo]
+        """ Decodes all phases one after the other, as standalone phases (they have no parent) """
+        for b in range(len(self.blocks)):
+            block = self._decode_block(b)
+            for k in range(len(block.ids)):
+                yield block.phase(k)
+
+    def read_into(self,
+                  kompanion  # type: Kompanion
+                  ):
+        # type: (...) -> List[PhaseInfo]
+        """
+        Decodes all phases and adds them to `kompanion`, restoring the phases tree. Phases are created in bulk, block by
+        block.
+
+        :param kompanion:
+        :return: the list of phases
+        """
+        phases = []
+        with _gc_paused():
+            for b in range(len(self.blocks)):
+                block = self._decode_block(b)
+                n = len(block.ids)
+                # the attribute dicts were created by _decode_block and can be used as the phases attributes
+                new = _build_phases(block.ids, block.attrs, block.anchors, kompanion, block.starts, block.ends)
+                if block.loops.count(None) != n:
+                    for phase, loop_ns in zip(new, block.loops):
+                        _set(phase, '_loop_ns', loop_ns)
+                if block.unlinked.count(None) != n:
+                    for phase, unlinked in zip(new, block.unlinked):
+                        _set(phase, '_unlinked', unlinked)
+                phases += new
+                if block.parents.count(None) != n:
+                    for phase, parent_idx in zip(new, block.parents):
+                        if parent_idx is not None:
+                            parent = phases[parent_idx]
+                            _set(phase, '_parent', parent)
+                            parent._add_child(phase)
+                kompanion.phases.extend(new)
+                kompanion._note_added(block.ids)
+        return phases
+
+    def close(self):
+        self._cached = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._own_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _record_to_phase(record,    # type: Record
+                     kompanion  # type: Optional[Kompanion]
+                     ):
+    # type: (...) -> PhaseInfo
+    phase_id, anchor, start_ns, end_ns, loop_ns, attrs = record
+    phase = _build_phase(phase_id, attrs or None, anchor, kompanion, start_ns, end_ns)
+    _set(phase, '_loop_ns', loop_ns)
+    return phase
+
+
+def load_archive(file,     # type: Union[str, BinaryIO]
+                 **kwargs
+                 ):
+    # type: (...) -> Kompanion
+    """
+    Reads all phases of an archive into a new Kompanion. See `ArchiveReader` to read phases one by one.
+
+    :param file: a path or a seekable binary file object open for reading
+    :param kwargs: arguments for the Kompanion constructor
+    :return:
+    """
+    from kopylog.main import Kompanion
+    return Kompanion.load(file, **kwargs)
@@ -0,0 +1,651 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Collectors of resource usage measurements, recorded as phase attributes. See `Kompanion(collectors=...)`.
+
+A collector takes a reading when a phase starts, and another one when it stops: the differences are set as
+attributes of the phase. Only the collectors enabled on a `Kompanion` cost anything, and a Kompanion without
+collectors does not pay for this feature.
+"""
+import os
+import sys
+import tracemalloc
+from threading import Event, Lock, Thread, get_ident
+from time import process_time_ns, thread_time_ns
+from weakref import WeakSet
+
+# python 3.9+: without it, the peak of each phase can not be measured
+_reset_peak = getattr(tracemalloc, 'reset_peak', None)
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+    from kopylog.main import PhaseInfo
+except ImportError:
+    pass
+
+
+class Collector(object):
+    """
+    Measures a resource usage during phases. `start(phase)` is called when a phase starts and returns a reading, that
+    is passed back to `stop(phase, reading)` when the phase stops. `stop` sets the measurements as attributes of the
+    phase.
+
+    `start` is called just before the start counter of the phase is read, and `stop` just after its end counter is
+    read, so that the cost of collectors is not included in the phase durations.
+    """
+    __slots__ = ()
+
+    def start(self,
+              phase  # type: PhaseInfo
+              ):
+        # type: (...) -> Any
+        raise NotImplementedError()
+
+    def stop(self,
+             phase,   # type: PhaseInfo
+             reading  # type: Any
+             ):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return "%s()" % type(self).__name__
+
+
+class CpuTimeCollector(Collector):
+    """
+    Sets `cpu_seconds`, the CPU time (user and system) used by the whole process during the phase, as measured by
+    `time.process_time`. A value close to `elapsed_seconds` means that the phase is CPU-bound, and a larger value that
+    several threads were busy.
+    """
+    __slots__ = ()
+
+    def start(self, phase):
+        return process_time_ns()
+
+    def stop(self, phase, reading):
+        phase.cpu_seconds = (process_time_ns() - reading) / 1e9
+
+
+class ThreadTimeCollector(Collector):
+    """
+    Sets `thread_cpu_seconds`, the CPU time (user and system) used by the thread running the phase, as measured by
+    `time.thread_time`. The difference with `elapsed_seconds` is the time the thread spent waiting: on I/O, on locks,
+    or for the CPU.
+    """
+    __slots__ = ()
+
+    def start(self, phase):
+        return thread_time_ns()
+
+    def stop(self, phase, reading):
+        phase.thread_cpu_seconds = (thread_time_ns() - reading) / 1e9
+
+
+class RusageCollector(Collector):
+    """
+    Sets the differences of the `resource.getrusage` counters during the phase:
+
+     - `minor_page_faults` and `major_page_faults` (the latter required I/O),
+     - `voluntary_context_switches` (usually waiting for I/O or a lock) and `involuntary_context_switches` (the
+       time slice was over: the CPU is contended),
+     - `block_inputs` and `block_outputs`, the number of filesystem block I/O operations.
+
+    With `scope='thread'` the counters of the thread running the phase are used (linux only), otherwise the counters
+    of the whole process.
+    """
+    __slots__ = 'scope', '_who'
+
+    FIELDS = (('ru_minflt', 'minor_page_faults'), ('ru_majflt', 'major_page_faults'),
+              ('ru_nvcsw', 'voluntary_context_switches'), ('ru_nivcsw', 'involuntary_context_switches'),
+              ('ru_inblock', 'block_inputs'), ('ru_oublock', 'block_outputs'))
+
+    def __init__(self,
+                 scope='process'  # type: str
+                 ):
+        """
+
+        :param scope: 'process' (default) or 'thread'
+        """
+        if resource is None:
+            raise ValueError("resource.getrusage is not available on this platform")
+        if scope == 'process':
+            self._who = resource.RUSAGE_SELF
+        elif scope == 'thread':
+            try:
+                self._who = resource.RUSAGE_THREAD
+            except AttributeError:
+                raise ValueError("Thread resource usage is not available on this platform")
+        else:
+            raise ValueError("Invalid scope: %r. It should be 'process' or 'thread'" % scope)
+        self.scope = scope
+
+    def _read(self):
+        # type: (...) -> Tuple[int, ...]
+        r = resource.getrusage(self._who)
+        return r.ru_minflt, r.ru_majflt, r.ru_nvcsw, r.ru_nivcsw, r.ru_inblock, r.ru_oublock
+
+    def start(self, phase):
+        return self._read()
+
+    def stop(self, phase, reading):
+        for (_, name), end, start in zip(self.FIELDS, self._read(), reading):
+            setattr(phase, name, end - start)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.scope)
+
+
+class _ProcFile(object):
+    """
+    A file of `/proc/self`, opened once and read again with `pread`. `/proc/self` is resolved when the file is opened:
+    it is therefore opened again in a forked child process, that would otherwise read the file of its parent.
+    """
+    __slots__ = 'path', '_fd', '_pid', '_lock'
+
+    def __init__(self,
+                 path  # type: str
+                 ):
+        """
+
+        :param path: the path of the file. An `OSError` is raised if it can not be opened.
+        """
+        self.path = path
+        self._lock = Lock()
+        self._fd = os.open(path, os.O_RDONLY)
+        self._pid = os.getpid()
+
+    def read(self,
+             size  # type: int
+             ):
+        # type: (...) -> bytes
+        """ Reads the current contents of the file, at most `size` bytes """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    fd = self._fd
+                    self._fd = os.open(self.path, os.O_RDONLY)
+                    self._pid = pid
+                    os.close(fd)
+        return os.pread(self._fd, size, 0)
+
+    def __del__(self):
+        fd = getattr(self, '_fd', None)
+        if fd is not None:
+            os.close(fd)
+
+
+class IOCollector(Collector):
+    """
+    Sets the differences of the counters of `/proc/self/io` during the phase (linux only):
+
+     - `io_read_bytes` and `io_write_bytes`, the bytes actually fetched from and sent to the storage layer,
+     - `io_read_chars` and `io_write_chars`, the bytes read and written by system calls, including the ones served
+       by the page cache, pipes and sockets.
+
+    With `scope='thread'`, the counters of the thread running the phase are used (`/proc/thread-self/io`).
+    """
+    __slots__ = 'scope', '_file'
+
+    FIELDS = ((b'read_bytes', 'io_read_bytes'), (b'write_bytes', 'io_write_bytes'),
+              (b'rchar', 'io_read_chars'), (b'wchar', 'io_write_chars'))
+
+    def __init__(self,
+                 scope='process'  # type: str
+                 ):
+        """
+
+        :param scope: 'process' (default) or 'thread'
+        """
+        if scope not in ('process', 'thread'):
+            raise ValueError("Invalid scope: %r. It should be 'process' or 'thread'" % scope)
+        path = '/proc/self/io' if scope == 'process' else '/proc/thread-self/io'
+        try:
+            proc_file = _ProcFile(path)
+        except OSError as e:
+            raise ValueError("%s is not available on this platform: %s" % (path, e))
+        if scope == 'process':
+            # the file is read again with pread, without reopening it
+            self._file = proc_file
+        else:
+            # /proc/thread-self is resolved when the file is opened: it is opened by each reading
+            self._file = None
+        self.scope = scope
+
+    def _read(self):
+        # type: (...) -> Tuple[int, ...]
+        if self._file is not None:
+            data = self._file.read(4096)
+        else:
+            with open('/proc/thread-self/io', 'rb') as f:
+                data = f.read()
+        values = dict(line.split(b': ') for line in data.splitlines() if line)
+        return tuple(int(values.get(key, 0)) for key, _ in self.FIELDS)
+
+    def start(self, phase):
+        return self._read()
+
+    def stop(self, phase, reading):
+        for (_, name), end, start in zip(self.FIELDS, self._read(), reading):
+            setattr(phase, name, end - start)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.scope)
+
+
+class _TracedPhase(object):
+    """ The tracemalloc measurements of a running phase, see `TracemallocCollector` """
+    __slots__ = 'start_bytes', 'peak_bytes', 'snapshot'
+
+    def __init__(self, start_bytes, snapshot):
+        self.start_bytes = start_bytes
+        self.peak_bytes = start_bytes
+        self.snapshot = snapshot
+
+
+class TracemallocCollector(Collector):
+    """
+    Measures the memory allocated by Python during the phases with `tracemalloc`, and sets:
+
+     - `alloc_net_bytes`: the traced memory at the end of the phase, minus the one at its start,
+     - `alloc_peak_bytes`: the maximum traced memory during the phase, minus the one at its start. It requires
+       python 3.9 or higher and is not set otherwise,
+     - `alloc_top`: if `top_n` > 0, the `top_n` source lines whose allocated memory grew the most during the phase, as a
+       list of ('file:line', size difference, count difference) tuples.
+
+    Each phase gets its own peak, even when phases are nested: the global tracemalloc peak is reset at each phase start
+    and stop, after being accounted to all the running phases. Note that tracemalloc traces the whole process: phases
+    running concurrently in other threads share their allocations.
+
+    Tracing is started with the first traced phase, if needed, and stopped when the last one stops, so that there is
+    no overhead outside of traced phases. It slows down all allocations while running, by a factor of about 2 to 4, and
+    `top_n` takes a snapshot of all traces at start and stop: it should only be enabled on a few phases, using
+    `phase_ids`. Memory allocated by native code without the Python allocators is not traced, see `RssCollector`.
+    """
+    __slots__ = 'phase_ids', 'top_n', 'nb_frames', '_lock', '_running', '_started_tracing'
+
+    def __init__(self,
+                 phase_ids=None,  # type: Iterable[str]
+                 top_n=0,         # type: int
+                 nb_frames=1      # type: int
+                 ):
+        """
+
+        :param phase_ids: the ids of the phases to trace. By default all phases are traced.
+        :param top_n: the number of allocation sites to record in `alloc_top`. Default 0 (disabled).
+        :param nb_frames: the number of frames stored by tracemalloc for each allocation, when tracing is started by
+            this collector.
+        """
+        self.phase_ids = None if phase_ids is None else frozenset(phase_ids)
+        self.top_n = top_n
+        self.nb_frames = nb_frames
+        self._lock = Lock()
+        self._running = []  # type: List[_TracedPhase]
+        self._started_tracing = False
+
+    def _account_peak(self):
+        """ Accounts the peak since the last reset to all running phases, and resets it """
+        current, peak = tracemalloc.get_traced_memory()
+        if _reset_peak is not None:
+            for traced in self._running:
+                if peak > traced.peak_bytes:
+                    traced.peak_bytes = peak
+            _reset_peak()
+        return current
+
+    def start(self, phase):
+        phase_ids = self.phase_ids
+        if phase_ids is not None and phase.phase_id not in phase_ids:
+            return None
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.nb_frames)
+                self._started_tracing = True
+            # the start snapshot is taken first, so that its own memory is part of the start traced memory
+            snapshot = tracemalloc.take_snapshot() if self.top_n > 0 else None
+            traced = _TracedPhase(self._account_peak(), snapshot)
+            self._running.append(traced)
+        return traced
+
+    def stop(self, phase, reading):
+        if reading is None:
+            return
+        with self._lock:
+            current = self._account_peak()
+            self._running.remove(reading)
+            snapshot = tracemalloc.take_snapshot() if reading.snapshot is not None else None
+            if not self._running and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        phase.alloc_net_bytes = current - reading.start_bytes
+        if _reset_peak is not None:
+            phase.alloc_peak_bytes = reading.peak_bytes - reading.start_bytes
+        if snapshot is not None:
+            stats = snapshot.compare_to(reading.snapshot, 'lineno')[:self.top_n]
+            phase.alloc_top = [("%s:%s" % (st.traceback[0].filename, st.traceback[0].lineno), st.size_diff,
+                                st.count_diff) for st in stats]
+
+    def __repr__(self):
+        return "%s(phase_ids=%r, top_n=%r)" % (type(self).__name__, self.phase_ids, self.top_n)
+
+
+_sampling_collectors = WeakSet()  # type: WeakSet
+""" The collectors with a background thread, reset in a forked child process, see `_after_fork_in_child` """
+
+
+def _after_fork_in_child():
+    """
+    Only the forking thread survives in a forked child process: the sampling threads are dead, and their locks may have
+    been held by one of them. The collectors forget them, and their running phases, which are not sampled anymore.
+    """
+    for collector in list(_sampling_collectors):
+        collector._reset()
+
+
+if hasattr(os, 'register_at_fork'):  # not available on windows
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class _RssPhase(object):
+    """ The RSS measurements of a running phase, see `RssCollector` """
+    __slots__ = 'start_bytes', 'peak_bytes'
+
+    def __init__(self, start_bytes):
+        self.start_bytes = start_bytes
+        self.peak_bytes = start_bytes
+
+
+class RssCollector(Collector):
+    """
+    Measures the resident memory (RSS) of the process during the phases, including the memory allocated by native code
+    that `TracemallocCollector` does not see (numpy, pandas, C extensions...). It sets:
+
+     - `rss_start` and `rss_end`: the RSS in bytes when the phase started and stopped,
+     - `rss_peak`: the largest RSS observed while the phase was running.
+
+    The RSS is read from `/proc/self/statm` (linux only) at each start and stop, and every `interval` seconds by a
+    background thread, which credits it to all the running phases. The peak can therefore be missed if it lasted less
+    than `interval`. The thread only runs while phases are running: it is started with the first phase, and stops
+    when the last one stops.
+    """
+    __slots__ = 'interval', '_file', '_page_size', '_lock', '_running', '_thread', '_wakeup', '__weakref__'
+
+    def __init__(self,
+                 interval=0.1  # type: float
+                 ):
+        """
+
+        :param interval: the sampling interval of the background thread, in seconds. Default 0.1.
+        """
+        if interval <= 0:
+            raise ValueError("interval should be positive: %r" % interval)
+        try:
+            self._file = _ProcFile('/proc/self/statm')
+        except OSError as e:
+            raise ValueError("/proc/self/statm is not available on this platform: %s" % e)
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self.interval = interval
+        self._reset()
+        _sampling_collectors.add(self)
+
+    def _reset(self):
+        """ Initializes the state of the background thread, also in a forked child process """
+        self._lock = Lock()
+        self._running = []  # type: List[_RssPhase]
+        self._thread = None  # type: Optional[Thread]
+        self._wakeup = Event()
+
+    def rss(self):
+        # type: (...) -> int
+        """ Returns the current RSS of the process, in bytes """
+        # the second field is the number of resident pages
+        return int(self._file.read(128).split()[1]) * self._page_size
+
+    def _sample(self):
+        """ The loop of the background thread: exits as soon as no phase is running """
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            rss = self.rss()
+            with self._lock:
+                if not self._running:
+                    self._thread = None
+                    return
+                for traced in self._running:
+                    if rss > traced.peak_bytes:
+                        traced.peak_bytes = rss
+
+    def start(self, phase):
+        traced = _RssPhase(self.rss())
+        with self._lock:
+            self._running.append(traced)
+            if self._thread is None:
+                self._thread = Thread(target=self._sample, name='kopylog-rss-sampler', daemon=True)
+                self._thread.start()
+        return traced
+
+    def stop(self, phase, reading):
+        rss = self.rss()
+        with self._lock:
+            try:
+                self._running.remove(reading)
+            except ValueError:
+                # started in the parent process before a fork: it was not sampled in this process
+                pass
+            else:
+                if not self._running:
+                    self._wakeup.set()
+        phase.rss_start = reading.start_bytes
+        phase.rss_end = rss
+        phase.rss_peak = max(reading.peak_bytes, rss)
+
+    def __repr__(self):
+        return "%s(interval=%r)" % (type(self).__name__, self.interval)
+
+
+class _SampledPhase(object):
+    """ The stack samples of a running phase, and the thread where it was started, see `StackSamplerCollector` """
+    __slots__ = 'counts', 'thread_id'
+
+    def __init__(self,
+                 thread_id  # type: int
+                 ):
+        self.counts = dict()  # type: Dict[str, int]
+        self.thread_id = thread_id
+
+
+class StackSamplerCollector(Collector):
+    """
+    A statistical profiler: a background thread samples the Python stacks of the threads running phases every
+    `interval` seconds (`sys._current_frames`), and each sample is credited to the innermost phase running in the
+    sampled thread. When a phase stops, it gets:
+
+     - `stack_samples`: a dict of collapsed stack -> number of samples, where a collapsed stack is the list of the
+       frames from the outermost to the innermost one, separated by ';'. Each frame is 'module:function'.
+     - `nb_stack_samples`: the total number of samples.
+
+    The time spent in a function is about its number of samples times `interval`. Use `collapsed_stacks` and
+    `write_collapsed_stacks` to export them for flame graph tools (`flamegraph.pl`, speedscope...).
+
+    The thread only runs while phases are running. Its overhead is a stack walk of the sampled threads at each tick,
+    which holds the GIL: with the default interval of 10ms it stays within a few percent. Phases interleaved in several
+    asyncio tasks of the same thread are approximately attributed: samples go to the phase started last.
+    """
+    __slots__ = 'interval', 'phase_ids', '_lock', '_running', '_thread', '_wakeup', '_labels', '__weakref__'
+
+    def __init__(self,
+                 interval=0.01,   # type: float
+                 phase_ids=None   # type: Iterable[str]
+                 ):
+        """
+
+        :param interval: the sampling interval, in seconds. Default 0.01.
+        :param phase_ids: the ids of the phases to profile. By default all phases are profiled.
+        """
+        if interval <= 0:
+            raise ValueError("interval should be positive: %r" % interval)
+        self.interval = interval
+        self.phase_ids = None if phase_ids is None else frozenset(phase_ids)
+        # the frame labels, by code object
+        self._labels = dict()  # type: Dict[Any, str]
+        self._reset()
+        _sampling_collectors.add(self)
+
+    def _reset(self):
+        """ Initializes the state of the background thread, also in a forked child process """
+        self._lock = Lock()
+        # the running profiled phases of each thread, the innermost last
+        self._running = dict()  # type: Dict[int, List[_SampledPhase]]
+        self._thread = None  # type: Optional[Thread]
+        self._wakeup = Event()
+
+    def _label(self, frame):
+        # type: (...) -> str
+        code = frame.f_code
+        try:
+            return self._labels[code]
+        except KeyError:
+            label = "%s:%s" % (frame.f_globals.get('__name__', '?'), getattr(code, 'co_qualname', code.co_name))
+            label = self._labels[code] = label.replace(';', ':').replace(' ', '_')
+            return label
+
+    def _sample(self):
+        """ The loop of the background thread: exits as soon as no phase is running """
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._running:
+                    self._thread = None
+                    return
+                for thread_id, running in self._running.items():
+                    frame = frames.get(thread_id)
+                    if frame is None or not running:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(self._label(frame))
+                        frame = frame.f_back
+                    labels.reverse()
+                    stack = ';'.join(labels)
+                    counts = running[-1].counts
+                    counts[stack] = counts.get(stack, 0) + 1
+            del frames
+
+    def start(self, phase):
+        phase_ids = self.phase_ids
+        if phase_ids is not None and phase.phase_id not in phase_ids:
+            return None
+        sampled = _SampledPhase(get_ident())
+        with self._lock:
+            self._running.setdefault(sampled.thread_id, []).append(sampled)
+            if self._thread is None:
+                self._thread = Thread(target=self._sample, name='kopylog-stack-sampler', daemon=True)
+                self._thread.start()
+        return sampled
+
+    def stop(self, phase, reading):
+        if reading is None:
+            return
+        # the phase may be stopped from another thread than the one it was started (and sampled) in
+        with self._lock:
+            thread_id = reading.thread_id
+            running = self._running.get(thread_id)
+            # a phase started in the parent process before a fork is not running in this process
+            if running is not None and reading in running:
+                running.remove(reading)
+                if not running:
+                    del self._running[thread_id]
+                    if not self._running:
+                        self._wakeup.set()
+            counts = reading.counts
+        phase.stack_samples = counts
+        phase.nb_stack_samples = sum(counts.values())
+
+    def __repr__(self):
+        return "%s(interval=%r, phase_ids=%r)" % (type(self).__name__, self.interval, self.phase_ids)
+
+
+def collapsed_stacks(phase,          # type: PhaseInfo
+                     inclusive=True  # type: bool
+                     ):
+    # type: (...) -> Dict[str, int]
+    """
+    Returns the stack samples of a phase recorded by a `StackSamplerCollector`, as a dict of collapsed stack -> number
+    of samples.
+
+    :param phase:
+    :param inclusive: True (default) to include the samples of the child phases, recursively
+    :return:
+    """
+    counts = dict(phase.odict.get('stack_samples', ()))
+    if inclusive:
+        for child in phase.child_phases:
+            for stack, n in collapsed_stacks(child, inclusive=True).items():
+                counts[stack] = counts.get(stack, 0) + n
+    return counts
+
+
+def write_collapsed_stacks(phases,         # type: Iterable[PhaseInfo]
+                           directory,      # type: str
+                           inclusive=True  # type: bool
+                           ):
+    # type: (...) -> List[str]
+    """
+    Writes the stack samples of each phase with samples to `<directory>/<phase_id>.collapsed`, in the collapsed stack
+    format of flame graph tools: one line per stack with its number of samples, such as
+    'module:main;module:load;module:parse 12'.
+
+    :param phases: the phases, for example `kompanion.phases.values()`
+    :param directory: an existing directory
+    :param inclusive: True (default) to include the samples of the child phases, recursively
+    :return: the paths of the files written
+    """
+    paths = []
+    for phase in phases:
+        counts = collapsed_stacks(phase, inclusive=inclusive)
+        if not counts:
+            continue
+        name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in str(phase.phase_id))
+        path = os.path.join(directory, "%s.collapsed" % name)
+        with open(path, 'w') as f:
+            for stack, n in sorted(counts.items()):
+                f.write("%s %s\n" % (stack, n))
+        paths.append(path)
+    return paths
+
+
+COLLECTORS = {
+    'cpu': CpuTimeCollector,
+    'thread_time': ThreadTimeCollector,
+    'rusage': RusageCollector,
+    'io': IOCollector,
+    'tracemalloc': TracemallocCollector,
+    'rss': RssCollector,
+    'stacks': StackSamplerCollector,
+}
+""" The collectors that can be enabled by name in `Kompanion(collectors=...)` """
+
+
+def to_collectors(collectors  # type: Iterable[Union[str, Collector]]
+                  ):
+    # type: (...) -> Tuple[Collector, ...]
+    """ Returns a tuple of collectors, creating the ones given by name (see `COLLECTORS`) with their default options """
+    result = []
+    for c in collectors:
+        if isinstance(c, str):
+            try:
+                c = COLLECTORS[c]()
+            except KeyError:
+                raise ValueError("Unknown collector: %r. Available collectors: %s" % (c, ', '.join(COLLECTORS)))
+        elif not isinstance(c, Collector):
+            raise TypeError("Not a Collector: %r" % (c,))
+        result.append(c)
+    return tuple(result)
@@ -0,0 +1,194 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+A decorator API to record a phase for each call of a function: `@phase(...)` or `@kompanion.phase(...)`.
+
+Everything that does not depend on the call (phase id, logger, phase creation function, names of the size attributes)
+is computed once, when the function is decorated.
+"""
+from functools import wraps
+from inspect import iscoroutinefunction, isgeneratorfunction, signature, Parameter
+from logging import Logger, getLogger
+
+from kopylog.main import PhaseInfo, NULL_PHASE, _current_phase
+
+try:  # python 3.5+
+    from typing import Any, Callable, Optional, Union
+    from kopylog.main import Kompanion
+except ImportError:
+    pass
+
+
+def default_size_of(obj  # type: Any
+                    ):
+    # type: (...) -> Optional[int]
+    """ The default size of an argument or result: its `len()`, or None if it has no length """
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+def phase(phase_id=None,                # type: Union[str, Callable]
+          logger=None,                  # type: Union[Logger, str]
+          kompanion=None,               # type: Kompanion
+          record_args_size=False,       # type: bool
+          record_result_size=False,     # type: bool
+          size_of=default_size_of       # type: Callable[[Any], Optional[int]]
+          ):
+    """
+    A decorator recording a phase for each call of the decorated function. It can be used with or without
+    parenthesis, on sync functions, coroutine functions and generator functions. For generators, the phase spans the
+    whole iteration, and it is the current phase only while the generator body runs.
+
+    If `kompanion` is not provided, the phase is added to the Kompanion of the current phase at call time if any,
+    otherwise it is a standalone phase (only useful for logging).
+
+    :param phase_id: the phase id. By default the qualified name of the function is used.
+    :param logger: an optional logger, or logger name, where to log the phase start and stop events
+    :param kompanion: an optional Kompanion where to add the phases
+    :param record_args_size: True to record the size of each argument as a `<arg_name>_size` phase attribute
+    :param record_result_size: True to record the size of the result as a `result_size` phase attribute. For
+        generators, this is the number of items yielded.
+    :param size_of: the function used to compute sizes. The default `default_size_of` uses `len()`. Attributes are
+        not set when it returns None.
+    :return:
+    """
+    if callable(phase_id):
+        # used without parenthesis
+        return _PhaseDecorator(None, logger, kompanion, record_args_size, record_result_size, size_of)(phase_id)
+    return _PhaseDecorator(phase_id, logger, kompanion, record_args_size, record_result_size, size_of)
+
+
+class _PhaseDecorator(object):
+    __slots__ = 'phase_id', 'logger', 'kompanion', 'record_args_size', 'record_result_size', 'size_of'
+
+    def __init__(self, phase_id, logger, kompanion, record_args_size, record_result_size, size_of):
+        self.phase_id = phase_id
+        self.logger = getLogger(logger) if isinstance(logger, str) else logger
+        self.kompanion = kompanion
+        self.record_args_size = record_args_size
+        self.record_result_size = record_result_size
+        self.size_of = size_of
+
+    def _phase_factory(self, phase_id):
+        # type: (...) -> Callable[[bool], PhaseInfo]
+        """ Returns the function creating a new phase for each call """
+        logger = self.logger
+        if self.kompanion is not None:
+            add_new_phase = self.kompanion.add_new_phase
+
+            def new_phase(start):
+                return add_new_phase(phase_id, start=start, logger=logger)
+        else:
+            def new_phase(start):
+                current = _current_phase.get()
+                kompanion = None if current is None else current._kompanion
+                if kompanion is None:
+                    return PhaseInfo(phase_id, logger=logger, start=start, parent=current)
+                return kompanion.add_new_phase(phase_id, start=start, logger=logger)
+        return new_phase
+
+    def _args_recorder(self, func):
+        # type: (...) -> Optional[Callable]
+        """ Returns the function recording the arguments sizes on a phase, or None """
+        if not self.record_args_size:
+            return None
+
+        size_of = self.size_of
+        positional = [p.name for p in signature(func).parameters.values()
+                      if p.kind in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD)]
+        positional_atts = ["%s_size" % name for name in positional]
+        keyword_atts = {name: "%s_size" % name for name in signature(func).parameters}
+
+        def record_args(p, args, kwargs):
+            for i, arg in enumerate(args):
+                size = size_of(arg)
+                if size is not None:
+                    setattr(p, positional_atts[i] if i < len(positional_atts) else "arg%s_size" % i, size)
+            for name, arg in kwargs.items():
+                size = size_of(arg)
+                if size is not None:
+                    setattr(p, keyword_atts.get(name) or "%s_size" % name, size)
+
+        return record_args
+
+    def __call__(self, func):
+        phase_id = self.phase_id if self.phase_id is not None else func.__qualname__
+        new_phase = self._phase_factory(phase_id)
+        record_args = self._args_recorder(func)
+        size_of = self.size_of if self.record_result_size else None
+
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def phase_wrapper(*args, **kwargs):
+                async with new_phase(True) as p:
+                    if record_args is not None and p is not NULL_PHASE:
+                        record_args(p, args, kwargs)
+                    result = await func(*args, **kwargs)
+                    if size_of is not None and p is not NULL_PHASE:
+                        size = size_of(result)
+                        if size is not None:
+                            p.result_size = size
+                return result
+
+        elif isgeneratorfunction(func):
+            @wraps(func)
+            def phase_wrapper(*args, **kwargs):
+                p = new_phase(False)
+                if p is NULL_PHASE:
+                    return (yield from func(*args, **kwargs))
+
+                if record_args is not None:
+                    record_args(p, args, kwargs)
+                gen = func(*args, **kwargs)
+                caller = _current_phase.get()
+                p.start()
+                # only phases owned by a Kompanion become the current phase, see PhaseInfo.start
+                pushed = _current_phase.get() is p
+                nb_items = 0
+                try:
+                    value, exc = None, None
+                    while True:
+                        try:
+                            item = gen.send(value) if exc is None else gen.throw(exc)
+                        except StopIteration as e:
+                            return e.value
+                        nb_items += 1
+
+                        # the phase is only the current one while the generator body runs
+                        if pushed and _current_phase.get() is p:
+                            _current_phase.set(caller)
+                        try:
+                            value, exc = (yield item), None
+                        except GeneratorExit:
+                            gen.close()
+                            raise
+                        except BaseException as e:
+                            value, exc = None, e
+                        if pushed:
+                            caller = _current_phase.get()
+                            _current_phase.set(p)
+                finally:
+                    # when the generator is closed or collected from elsewhere, the current phase is not ours to restore
+                    if pushed and _current_phase.get() is p:
+                        _current_phase.set(caller)
+                    if size_of is not None:
+                        p.result_size = nb_items
+                    p.stop()
+
+        else:
+            @wraps(func)
+            def phase_wrapper(*args, **kwargs):
+                with new_phase(True) as p:
+                    if record_args is not None and p is not NULL_PHASE:
+                        record_args(p, args, kwargs)
+                    result = func(*args, **kwargs)
+                    if size_of is not None and p is not NULL_PHASE:
+                        size = size_of(result)
+                        if size is not None:
+                            p.result_size = size
+                return result
+
+        return phase_wrapper
@@ -0,0 +1,246 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Columnar export and import of phases, used by `Kompanion.to_columns`/`to_df`/`to_records` and their `from_*`
+counterparts.
+
+Two layouts are supported:
+
+ - the *stacked* layout has three columns (phase_id, property, value) and one row per phase property,
+ - the *pivoted* layout has one row per phase, a phase_id column and one column per property.
+
+The timing properties `start_time`, `end_time` and `elapsed_seconds` are part of both layouts.
+"""
+from datetime import datetime, timedelta
+from itertools import chain, repeat
+from operator import attrgetter
+
+from kopylog.main import PhaseInfo, _PHASE_ID_ATT_NAME, _build_phases, _gc_paused
+from kopylog.spill import load_spilled
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional
+    np = None
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterable, List, Optional, Tuple
+    from kopylog.main import Kompanion
+    from kopylog.utils_clock import WallClockAnchor
+    Columns = Dict[str, List[Any]]
+except ImportError:
+    pass
+
+
+PROPERTY = 'property'
+VALUE = 'value'
+TIMING_PROPERTIES = ('start_time', 'end_time', 'elapsed_seconds')
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+
+_get_id = attrgetter(_PHASE_ID_ATT_NAME)
+_get_odict = attrgetter('odict')
+_get_anchor = attrgetter('_anchor')
+_get_start = attrgetter('_start_ns')
+_get_end = attrgetter('_end_ns')
+
+
+def _timings(starts,  # type: List[Optional[int]]
+             ends,    # type: List[Optional[int]]
+             anchors  # type: List[WallClockAnchor]
+             ):
+    # type: (...) -> Tuple[List[Optional[datetime]], List[Optional[datetime]], List[Optional[float]]]
+    """
+    Returns the start times, end times and elapsed seconds corresponding to the given raw counters, with None for
+    missing values. Computations are vectorized with numpy when available. The datetimes are identical to the ones
+    returned by `WallClockAnchor.to_datetime`.
+    """
+    if np is None or len(starts) == 0:
+        start_times = [None if s is None else a.to_datetime(s) for s, a in zip(starts, anchors)]
+        end_times = [None if e is None else a.to_datetime(e) for e, a in zip(ends, anchors)]
+        elapsed = [None if e is None else (e - s) / 1e9 for s, e in zip(starts, ends)]
+        return start_times, end_times, elapsed
+
+    if len(set(map(id, anchors))) == 1:
+        # a single anchor: the usual case
+        anchor = anchors[0]
+        counters = anchor.counter_ns
+        walls_us = (anchor.wall_time - _EPOCH) // _ONE_US
+    else:
+        counters = np.array([a.counter_ns for a in anchors], dtype=np.int64)
+        walls_us = np.array([(a.wall_time - _EPOCH) // _ONE_US for a in anchors], dtype=np.int64)
+
+    s_missing = [s is None for s in starts]
+    e_missing = [e is None for e in ends]
+    s_any, e_any = any(s_missing), any(e_missing)
+    s = np.array([0 if x is None else x for x in starts] if s_any else starts, dtype=np.int64)
+    e = np.array([0 if x is None else x for x in ends] if e_any else ends, dtype=np.int64)
+
+    start_times = (walls_us + (s - counters) // 1000).astype('datetime64[us]').astype(object).tolist()
+    end_times = (walls_us + (e - counters) // 1000).astype('datetime64[us]').astype(object).tolist()
+    elapsed = ((e - s) / 1e9).tolist()
+    if s_any:
+        start_times = [None if m else v for m, v in zip(s_missing, start_times)]
+    if e_any:
+        end_times = [None if m else v for m, v in zip(e_missing, end_times)]
+        elapsed = [None if m else v for m, v in zip(e_missing, elapsed)]
+    return start_times, end_times, elapsed
+
+
+def phases_to_columns(phases,      # type: Iterable[PhaseInfo]
+                      pivot=False  # type: bool
+                      ):
+    # type: (...) -> Columns
+    """
+    Exports phases as a dict of lists, in the stacked (default) or pivoted layout. The phase fields are read with
+    C-level iterations, and timings are computed in a vectorized way when numpy is available.
+
+    :param phases:
+    :param pivot: False (default) for the stacked layout, True for the pivoted layout
+    :return: an ordered dict of column name -> list of values
+    """
+    phases = list(phases)
+    n = len(phases)
+    ids = list(map(_get_id, phases))
+    odicts = list(map(_get_odict, phases))
+    start_times, end_times, elapsed = _timings(list(map(_get_start, phases)), list(map(_get_end, phases)),
+                                               list(map(_get_anchor, phases)))
+
+    # all user attributes, flattened. Spilled values are loaded back.
+    lengths = list(map(len, odicts))
+    keys = list(chain.from_iterable(odicts))
+    values = load_spilled(list(chain.from_iterable(map(dict.values, odicts))))
+
+    if pivot:
+        columns = {_PHASE_ID_ATT_NAME: ids, 'start_time': start_times, 'end_time': end_times,
+                   'elapsed_seconds': elapsed}
+        rows = chain.from_iterable(repeat(i, length) for i, length in enumerate(lengths) if length)
+        for i, k, v in zip(rows, keys, values):
+            try:
+                columns[k][i] = v
+            except KeyError:
+                col = columns[k] = [None] * n
+                col[i] = v
+        return columns
+    else:
+        # the timing rows of each phase, followed by its attributes rows
+        id_col, prop_col, val_col, row_phase = [], [], [], []
+        for prop, col in zip(TIMING_PROPERTIES, (start_times, end_times, elapsed)):
+            present = [i for i, v in enumerate(col) if v is not None]
+            row_phase.extend(present)
+            prop_col.extend(repeat(prop, len(present)))
+            val_col.extend(col[i] for i in present)
+        row_phase.extend(chain.from_iterable(repeat(i, length) for i, length in enumerate(lengths) if length))
+        prop_col.extend(keys)
+        val_col.extend(values)
+
+        # group the rows by phase, keeping the order of the properties (stable sort)
+        if np is not None:
+            order = np.argsort(np.array(row_phase, dtype=np.int64), kind='stable').tolist()
+        else:
+            order = sorted(range(len(row_phase)), key=row_phase.__getitem__)
+        id_col = [ids[row_phase[j]] for j in order]
+        prop_col = [prop_col[j] for j in order]
+        val_col = [val_col[j] for j in order]
+        return {_PHASE_ID_ATT_NAME: id_col, PROPERTY: prop_col, VALUE: val_col}
+
+
+def phases_from_columns(columns,   # type: Columns
+                        kompanion  # type: Kompanion
+                        ):
+    # type: (...) -> List[PhaseInfo]
+    """
+    Rebuilds phases from a dict of columns in the stacked or pivoted layout (detected automatically), and adds them
+    to `kompanion`. Rows are grouped by phase id in a single pass, and the phases are created in bulk.
+
+    In the pivoted layout, a None cell means that the phase does not have this attribute, as in `phases_to_columns`.
+    Other values, including NaN, are restored as-is.
+
+    :param columns: a mapping of column name -> sequence of values
+    :param kompanion: the Kompanion where the phases should be added. Its anchor is used to restore timings.
+    :return: the list of restored phases
+    """
+    with _gc_paused():
+        if set(columns) == {_PHASE_ID_ATT_NAME, PROPERTY, VALUE}:
+            # stacked: group the rows by phase id
+            contents = dict()
+            for phase_id, prop, value in zip(columns[_PHASE_ID_ATT_NAME], columns[PROPERTY], columns[VALUE]):
+                try:
+                    contents[phase_id][prop] = value
+                except KeyError:
+                    contents[phase_id] = {prop: value}
+            ids = list(contents)
+            dcts = list(contents.values())
+            start_times = [d.pop('start_time', None) for d in dcts]
+            end_times = [d.pop('end_time', None) for d in dcts]
+            elapsed = [d.pop('elapsed_seconds', None) for d in dcts]
+        else:
+            # pivoted: the timings are read as columns, and the phases attributes are filled column by column
+            ids = list(columns[_PHASE_ID_ATT_NAME])
+            missing = [None] * len(ids)
+            start_times, end_times, elapsed = (list(columns.get(name, missing)) for name in TIMING_PROPERTIES)
+            dcts = [dict() for _ in ids]
+            for name, col in columns.items():
+                if name != _PHASE_ID_ATT_NAME and name not in TIMING_PROPERTIES:
+                    for dct, value in zip(dcts, col):
+                        if value is not None:
+                            dct[name] = value
+
+        to_counter_ns = kompanion._anchor.to_counter_ns
+        starts = [None if t is None else to_counter_ns(t) for t in start_times]
+        # the elapsed seconds are more precise than the end time
+        ends = [None if s is None else (s + int(round(e_s * 1e9)) if e_s is not None else
+                                        (None if e is None else to_counter_ns(e)))
+                for s, e, e_s in zip(starts, end_times, elapsed)]
+
+        # the dicts were created above and can be used as the phases attributes
+        phases = _build_phases(ids, [dct or None for dct in dcts], repeat(kompanion._anchor), kompanion, starts, ends)
+    kompanion.phases.extend(phases)
+    kompanion._note_added(ids)
+    return phases
+
+
+def columns_to_df(columns  # type: Columns
+                  ):
+    """
+    Converts a dict of columns into a pandas DataFrame. Columns containing None cells, for example the attributes that
+    only some phases have in the pivoted layout, have the object dtype so that pandas does not replace None with NaN.
+    This way a NaN attribute value is not mistaken for a missing attribute by `phases_from_columns`.
+
+    :param columns:
+    :return:
+    """
+    import pandas as pd
+    return pd.DataFrame({name: pd.Series(col, dtype=object) if any(v is None for v in col) else col
+                         for name, col in columns.items()})
+
+
+def columns_to_records(columns  # type: Columns
+                       ):
+    """
+    Converts a dict of columns into a numpy structured array. Numeric, boolean and datetime columns keep their
+    dtype, other columns have the object dtype.
+
+    :param columns:
+    :return:
+    """
+    if np is None:
+        raise ImportError("numpy is required to export phases as a structured array")
+    arrays = []
+    for col in columns.values():
+        try:
+            arr = np.asarray(col)
+        except ValueError:
+            # for example sequences of different lengths, such as array attributes
+            arr = None
+        if arr is None or arr.dtype.kind not in 'biufcM' or arr.ndim != 1:
+            arr = np.empty(len(col), dtype=object)
+            arr[:] = col
+        arrays.append(arr)
+    n = len(arrays[0]) if arrays else 0
+    records = np.empty(n, dtype=[(name, arr.dtype) for name, arr in zip(columns, arrays)])
+    for name, arr in zip(columns, arrays):
+        records[name] = arr
+    return records
@@ -0,0 +1,146 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Propagation of the phases recorded in a worker process (or thread) back to the submitting `Kompanion`.
+"""
+from concurrent.futures import Future
+from threading import get_ident
+from weakref import ref
+
+from kopylog.main import Kompanion, _current_phase, _current_phase_of
+
+try:  # python 3.5+
+    from typing import Any, Callable, List, Optional
+    from concurrent.futures import Executor
+    from kopylog.main import PhaseInfo
+except ImportError:
+    pass
+
+
+class RemoteResult(object):
+    """
+    The result of a `RemoteCall`: the return value of the callable together with the root phases it recorded.
+    """
+    __slots__ = 'result', 'phases'
+
+    def __init__(self,
+                 result,  # type: Any
+                 phases   # type: List[PhaseInfo]
+                 ):
+        self.result = result
+        self.phases = phases
+
+    def __reduce__(self):
+        return RemoteResult, (self.result, self.phases)
+
+
+class RemoteCall(object):
+    """
+    A picklable wrapper around a callable, to execute in a worker. The callable receives a fresh `Kompanion` in its
+    `kompanion_arg` keyword argument, and its root phases are returned with its result in a `RemoteResult`.
+    """
+    __slots__ = 'fn', 'kompanion_arg'
+
+    def __init__(self,
+                 fn,                        # type: Callable
+                 kompanion_arg='kompanion'  # type: str
+                 ):
+        self.fn = fn
+        self.kompanion_arg = kompanion_arg
+
+    def __call__(self, *args, **kwargs):
+        # type: (...) -> RemoteResult
+        kompanion = Kompanion()
+        kwargs[self.kompanion_arg] = kompanion
+        # forked workers may inherit the current phase of the submitting thread: start from a clean stack
+        token = _current_phase.set(None)
+        try:
+            result = self.fn(*args, **kwargs)
+        finally:
+            _current_phase.reset(token)
+        return RemoteResult(result, kompanion.root_phases())
+
+    def __reduce__(self):
+        return RemoteCall, (self.fn, self.kompanion_arg)
+
+
+class MergingFuture(Future):
+    """
+    The future returned by `Kompanion.submit`. Reading its result from the submitting thread also merges the phases of
+    the completed calls into the Kompanion, see `Kompanion.merge_pending_phases`. Cancelling it cancels the call
+    submitted to the executor, so it can only be cancelled while this call is pending.
+    """
+    def __init__(self,
+                 kompanion  # type: Kompanion
+                 ):
+        super(MergingFuture, self).__init__()
+        self.kompanion = kompanion
+        self._inner = None  # type: Optional[Future]
+
+    def cancel(self):
+        # type: (...) -> bool
+        inner = self._inner
+        if inner is not None and not inner.cancel():
+            return False
+        return super(MergingFuture, self).cancel()
+
+    def result(self, timeout=None):
+        result = super(MergingFuture, self).result(timeout)
+        self.kompanion.merge_pending_phases()
+        return result
+
+    def _set_remote_result(self,
+                           remote_result,  # type: RemoteResult
+                           thread_id,      # type: int
+                           thread,         # type: ref
+                           parent          # type: Optional[PhaseInfo]
+                           ):
+        """ Registers the phases of `remote_result` to be merged and sets the result, unless cancelled """
+        # holding the condition, so that the future can not be cancelled in the meantime
+        with self._condition:
+            if self.cancelled():
+                return
+            self.kompanion._add_pending_merge(thread_id, thread, remote_result.phases, parent)
+            self.set_result(remote_result.result)
+
+
+def submit(kompanion,  # type: Kompanion
+           executor,   # type: Executor
+           fn,         # type: Callable
+           *args,
+           **kwargs
+           ):
+    # type: (...) -> Future
+    """
+    Submits `RemoteCall(fn)(*args, **kwargs)` to `executor`. See `Kompanion.submit`.
+
+    :param kompanion: the Kompanion where the phases recorded by `fn` should be merged
+    :param executor:
+    :param fn:
+    :param args:
+    :param kwargs:
+    :return: a `MergingFuture` holding the result of `fn`
+    """
+    parent = _current_phase_of(kompanion)
+    thread_id = get_ident()
+    thread = ref(kompanion._submitting_thread())
+    outer = MergingFuture(kompanion)
+
+    def _on_done(inner):
+        if inner.cancelled():
+            Future.cancel(outer)
+            return
+        try:
+            remote_result = inner.result()
+        except BaseException as e:
+            with outer._condition:
+                if not outer.cancelled():
+                    outer.set_exception(e)
+        else:
+            # this usually runs in a thread of the executor: the submitting thread will merge the phases
+            outer._set_remote_result(remote_result, thread_id, thread, parent)
+
+    outer._inner = inner = executor.submit(RemoteCall(fn), *args, **kwargs)
+    inner.add_done_callback(_on_done)
+    return outer
@@ -0,0 +1,325 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+An on-disk index over archived runs (see `Kompanion.save`), to query the phases of many runs by phase id, run id,
+start time and duration without loading them. See `ArchiveIndex`.
+
+The index is a directory containing:
+
+ - `catalog.json`: the indexed archives (path, size, modification time, run id and metadata) and the phase ids,
+ - `phases.npy`: one row per phase of all archives, sorted by phase id and start time: the archive, the phase id, the
+   record index in the archive, the start time (microseconds since the epoch) and the duration (nanoseconds, or -1
+   when the phase was not stopped).
+
+The rows are memory-mapped when the index is opened: queries only read the parts of the index that they need, using
+binary searches on the sorted columns and vectorized filters. Attribute values are decoded from the archives, for the
+matching phases only. numpy is required.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from kopylog.archive import ArchiveReader
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterable, List, Optional, Union
+except ImportError:
+    pass
+
+
+CATALOG_FILE = 'catalog.json'
+PHASES_FILE = 'phases.npy'
+
+ROW_DTYPE = np.dtype([('archive', '<i4'), ('phase', '<i4'), ('record', '<i4'), ('start_us', '<i8'),
+                      ('elapsed_ns', '<i8')])
+""" The rows of the index """
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+
+
+def _to_us(dt  # type: Optional[datetime]
+           ):
+    # type: (...) -> Optional[int]
+    return None if dt is None else (dt - _EPOCH) // _ONE_US
+
+
+def _as_list(x):
+    return [x] if isinstance(x, str) else list(x)
+
+
+class _IndexedArchive(object):
+    """ The rows and catalog entry of an archive, as read by `_scan_archive` """
+    __slots__ = 'entry', 'phase_ids', 'rows'
+
+    def __init__(self, entry, phase_ids, rows):
+        self.entry = entry
+        self.phase_ids = phase_ids
+        self.rows = rows
+
+
+def _scan_archive(path  # type: str
+                  ):
+    # type: (...) -> _IndexedArchive
+    """
+    Reads the footer and the phase ids and timings columns of an archive. The attribute values are not decoded.
+    """
+    st = os.stat(path)
+    with ArchiveReader(path, use_mmap=True) as reader:
+        phase_idx, anchor_idx, start_ns, end_ns = reader.read_headers()
+        n = len(phase_idx)
+        started = np.array([s is not None for s in start_ns], dtype=bool)
+        stopped = np.array([e is not None for e in end_ns], dtype=bool)
+        start_ns = np.array([0 if s is None else s for s in start_ns], dtype=np.int64)
+        end_ns = np.array([0 if e is None else e for e in end_ns], dtype=np.int64)
+        anchor_idx = np.array(anchor_idx, dtype=np.int64)
+
+        anchors = reader.anchors
+        anchors_wall_us = np.array([_to_us(a.wall_time) for a in anchors], dtype=np.int64)
+        anchors_counter_ns = np.array([a.counter_ns for a in anchors], dtype=np.int64)
+
+        strings = np.array(reader.strings, dtype=object)
+        phase_ids, phase_codes = np.unique(strings[np.array(phase_idx, dtype=np.int64)].astype(str),
+                                           return_inverse=True) \
+            if n else (np.array([], dtype=str), np.array([], dtype=np.int64))
+
+        rows = np.empty(n, dtype=ROW_DTYPE)
+        rows['phase'] = phase_codes
+        rows['record'] = np.arange(n)
+        # phases that were not started are indexed at the time of their anchor
+        rows['start_us'] = anchors_wall_us[anchor_idx] + np.where(
+            started, (start_ns - anchors_counter_ns[anchor_idx]) // 1000, 0)
+        rows['elapsed_ns'] = np.where(started & stopped, end_ns - start_ns, -1)
+
+        metadata = reader.metadata
+        run_id = metadata.get('run_id')
+        if run_id is None:
+            run_id = os.path.splitext(os.path.basename(path))[0]
+        entry = dict(path=os.path.abspath(path), size=st.st_size, mtime_ns=st.st_mtime_ns, run_id=str(run_id),
+                     metadata=metadata)
+    return _IndexedArchive(entry, [str(p) for p in phase_ids], rows)
+
+
+class ArchiveIndex(object):
+    """
+    An index over archived runs, stored in a directory. Create or update it with `ArchiveIndex.build`, open it with
+    `ArchiveIndex(directory)`, and use `query` to find phases:
+
+    >>> index = ArchiveIndex.build('runs.idx', glob('runs/*.kparch'))
+    >>> cols = index.query('train', start=datetime.now() - timedelta(days=7), min_seconds=30)
+    >>> cols['run_id'], cols['elapsed_seconds']
+
+    The run id of each archive is the 'run_id' of its metadata, or the name of the file without extension.
+    """
+    __slots__ = 'directory', 'archives', 'phase_ids', 'rows', '_phase_codes', '_run_codes'
+
+    def __init__(self,
+                 directory  # type: str
+                 ):
+        """
+        Opens an existing index. Its rows are memory-mapped.
+
+        :param directory:
+        """
+        self.directory = directory
+        with open(os.path.join(directory, CATALOG_FILE), 'r') as f:
+            catalog = json.load(f)
+        self.archives = catalog['archives']  # type: List[Dict[str, Any]]
+        self.phase_ids = catalog['phase_ids']  # type: List[str]
+        self.rows = np.load(os.path.join(directory, PHASES_FILE), mmap_mode='r')  # type: np.ndarray
+        self._phase_codes = {p: i for i, p in enumerate(self.phase_ids)}
+        self._run_codes = dict()  # type: Dict[str, List[int]]
+        for i, entry in enumerate(self.archives):
+            self._run_codes.setdefault(entry['run_id'], []).append(i)
+
+    @classmethod
+    def build(cls,
+              directory,  # type: str
+              archives    # type: Iterable[str]
+              ):
+        # type: (...) -> ArchiveIndex
+        """
+        Creates the index of `archives` in `directory`, or updates it if it exists: archives that were already indexed
+        and did not change are not read again, and archives that are not listed anymore are removed from the index.
+
+        :param directory: the index directory. It is created if needed.
+        :param archives: the paths of the archive files
+        :return: the opened index
+        """
+        old = None
+        if os.path.exists(os.path.join(directory, CATALOG_FILE)):
+            old = cls(directory)
+            old_entries = {entry['path']: i for i, entry in enumerate(old.archives)}
+            # group the rows by archive once: the rows of archive i are old.rows[order[bounds[i]:bounds[i + 1]]]
+            old_archives = old.rows['archive']
+            if len(old.archives) <= np.iinfo(np.uint16).max:
+                # numpy uses a radix sort for small integers
+                old_archives = old_archives.astype(np.uint16)
+            order = np.argsort(old_archives, kind='stable')
+            bounds = [0] + np.cumsum(np.bincount(old_archives, minlength=len(old.archives))).tolist()
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+        parts = []  # type: List[_IndexedArchive]
+        for path in archives:
+            path = os.path.abspath(path)
+            if old is not None and path in old_entries:
+                i = old_entries[path]
+                entry = old.archives[i]
+                st = os.stat(path)
+                if entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                    rows = old.rows[order[bounds[i]:bounds[i + 1]]]
+                    used, rows['phase'] = np.unique(rows['phase'], return_inverse=True)
+                    parts.append(_IndexedArchive(entry, [old.phase_ids[c] for c in used.tolist()], rows))
+                    continue
+            parts.append(_scan_archive(path))
+
+        # merge the phase ids of all archives, and sort the rows
+        phase_ids = sorted(set().union(*(p.phase_ids for p in parts)))
+        codes = {p: i for i, p in enumerate(phase_ids)}
+        all_rows = []
+        for i, part in enumerate(parts):
+            rows = part.rows
+            rows['archive'] = i
+            if len(rows):
+                rows['phase'] = np.array([codes[p] for p in part.phase_ids], dtype=np.int32)[rows['phase']]
+            all_rows.append(rows)
+        rows = np.concatenate(all_rows) if all_rows else np.empty(0, dtype=ROW_DTYPE)
+        rows = rows[np.lexsort((rows['start_us'], rows['phase']))]
+
+        if old is not None:
+            # release the memory map before replacing the file
+            old.rows = None
+            del old
+        _replace(os.path.join(directory, PHASES_FILE), lambda f: np.save(f, rows))
+        catalog = dict(archives=[p.entry for p in parts], phase_ids=phase_ids)
+        _replace(os.path.join(directory, CATALOG_FILE), lambda f: f.write(json.dumps(catalog).encode('utf-8')))
+        return cls(directory)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def run_ids(self):
+        # type: (...) -> List[str]
+        """ Returns the run ids of the indexed archives """
+        return list(self._run_codes)
+
+    def _select(self,
+                phase_id,     # type: Optional[Union[str, Iterable[str]]]
+                run_id,       # type: Optional[Union[str, Iterable[str]]]
+                start_us,     # type: Optional[int]
+                end_us,       # type: Optional[int]
+                min_seconds,  # type: Optional[float]
+                max_seconds   # type: Optional[float]
+                ):
+        # type: (...) -> np.ndarray
+        """ Returns the positions of the matching rows """
+        rows = self.rows
+        if phase_id is None:
+            ranges = [(0, len(rows))]
+            by_phase = False
+        else:
+            # the rows of a phase id are contiguous, sorted by start time
+            ranges = []
+            phases = rows['phase']
+            for p in _as_list(phase_id):
+                code = self._phase_codes.get(p)
+                if code is not None:
+                    ranges.append((np.searchsorted(phases, code, 'left'), np.searchsorted(phases, code, 'right')))
+            by_phase = True
+        archives = None if run_id is None else [i for r in _as_list(run_id) for i in self._run_codes.get(r, ())]
+
+        selected = []
+        for lo, hi in ranges:
+            if by_phase and (start_us is not None or end_us is not None):
+                starts = rows['start_us'][lo:hi]
+                lo, hi = (lo if start_us is None else lo + np.searchsorted(starts, start_us, 'left'),
+                          hi if end_us is None else lo + np.searchsorted(starts, end_us, 'left'))
+            if hi <= lo:
+                continue
+            chunk = rows[lo:hi]
+            mask = np.ones(hi - lo, dtype=bool)
+            if not by_phase:
+                if start_us is not None:
+                    mask &= chunk['start_us'] >= start_us
+                if end_us is not None:
+                    mask &= chunk['start_us'] < end_us
+            if archives is not None:
+                mask &= np.isin(chunk['archive'], archives)
+            if min_seconds is not None or max_seconds is not None:
+                elapsed = chunk['elapsed_ns']
+                mask &= elapsed >= (0 if min_seconds is None else min_seconds * 1e9)
+                if max_seconds is not None:
+                    mask &= elapsed <= max_seconds * 1e9
+            selected.append(lo + np.flatnonzero(mask))
+        return np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
+
+    def query(self,
+              phase_id=None,     # type: Union[str, Iterable[str]]
+              run_id=None,       # type: Union[str, Iterable[str]]
+              start=None,        # type: datetime
+              end=None,          # type: datetime
+              min_seconds=None,  # type: float
+              max_seconds=None,  # type: float
+              attributes=()      # type: Iterable[str]
+              ):
+        # type: (...) -> Dict[str, Any]
+        """
+        Returns the phases matching all the given criteria, as columns: 'run_id', 'phase_id', 'start_time'
+        (numpy datetime64[us]), 'elapsed_seconds' (NaN when the phase was not stopped), and one column per requested
+        attribute (None when a phase does not have it). Rows are sorted by phase id then start time.
+
+        Only the index is read, except for `attributes`: their values are decoded from the archives, for the matching
+        phases only.
+
+        :param phase_id: a phase id, or several
+        :param run_id: a run id, or several
+        :param start: only phases started at or after this time
+        :param end: only phases started before this time
+        :param min_seconds: only stopped phases that lasted at least this duration
+        :param max_seconds: only stopped phases that lasted at most this duration
+        :param attributes: the names of the attributes to read
+        :return: a dict of columns, that can be passed to `pandas.DataFrame`
+        """
+        positions = self._select(phase_id, run_id, _to_us(start), _to_us(end), min_seconds, max_seconds)
+        rows = self.rows[positions]
+        elapsed_ns = rows['elapsed_ns']
+        run_ids = np.array([entry['run_id'] for entry in self.archives], dtype=object)
+        columns = dict(run_id=run_ids[rows['archive']].tolist(),
+                       phase_id=np.array(self.phase_ids, dtype=object)[rows['phase']].tolist(),
+                       start_time=rows['start_us'].astype('datetime64[us]'),
+                       elapsed_seconds=np.where(elapsed_ns >= 0, elapsed_ns / 1e9, np.nan))
+
+        attributes = list(attributes)
+        if attributes:
+            values = {a: [None] * len(rows) for a in attributes}
+            # read the archives one by one, each record at most once
+            order = np.lexsort((rows['record'], rows['archive']))
+            reader, current = None, None
+            try:
+                for k in order.tolist():
+                    archive = int(rows['archive'][k])
+                    if archive != current:
+                        if reader is not None:
+                            reader.close()
+                        reader = ArchiveReader(self.archives[archive]['path'], use_mmap=True)
+                        current = archive
+                    attrs = reader.read_record(int(rows['record'][k]))[0][-1]
+                    for a in attributes:
+                        values[a][k] = attrs.get(a)
+            finally:
+                if reader is not None:
+                    reader.close()
+            columns.update(values)
+        return columns
+
+
+def _replace(path, write):
+    """ Writes a file through a temporary file, so that readers never see a partial file """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
@@ -0,0 +1,246 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Detection of phase timing regressions between two sets of runs, for example two releases. See `compare_runs`.
+
+The durations of each phase id are compared with the ratio of their medians, a bootstrap confidence interval of this
+ratio, and a two-sided Mann-Whitney U test. All phases are processed at once with vectorized numpy computations on
+(runs x phases) matrices, where missing phases are NaN. numpy is required.
+"""
+import warnings
+from math import erfc, sqrt
+
+import numpy as np
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterable, List, Sequence, Tuple
+    from kopylog.main import Kompanion
+except ImportError:
+    pass
+
+
+_erfc = np.frompyfunc(erfc, 1, 1)
+
+
+def _durations(runs  # type: Iterable[Any]
+               ):
+    # type: (...) -> List[Dict[str, float]]
+    """ The durations of the stopped phases of each run, by phase id """
+    durations = []
+    for run in runs:
+        phases = getattr(run, 'phases', run).values()
+        durations.append({p.phase_id: (p._end_ns - p._start_ns) / 1e9 for p in phases
+                          if p._end_ns is not None and p._start_ns is not None})
+    return durations
+
+
+def _to_matrix(durations,  # type: List[Dict[str, float]]
+               phase_ids   # type: List[str]
+               ):
+    # type: (...) -> np.ndarray
+    matrix = np.full((len(durations), len(phase_ids)), np.nan)
+    for i, d in enumerate(durations):
+        matrix[i] = [d.get(phase_id, np.nan) for phase_id in phase_ids]
+    return matrix
+
+
+def elapsed_matrix(runs,           # type: Iterable[Any]
+                   phase_ids=None  # type: Sequence[str]
+                   ):
+    # type: (...) -> Tuple[List[str], np.ndarray]
+    """
+    Returns the `elapsed_seconds` of the phases of several runs, as a (runs x phases) matrix. Phases that are missing
+    from a run, or that were not stopped, are NaN.
+
+    :param runs: `Kompanion`s, or `KompanionSnapshot`s
+    :param phase_ids: the phase ids of the columns. By default all the phase ids of the runs, in order of appearance.
+    :return: the phase ids, and the matrix
+    """
+    durations = _durations(runs)
+    if phase_ids is None:
+        phase_ids = list(dict.fromkeys(phase_id for d in durations for phase_id in d))
+    else:
+        phase_ids = list(phase_ids)
+    return phase_ids, _to_matrix(durations, phase_ids)
+
+
+def _medians(samples  # type: np.ndarray
+             ):
+    # type: (...) -> np.ndarray
+    """ The medians of the columns, ignoring NaNs. `np.median` is much faster when there are none. """
+    if np.isnan(samples).any():
+        with warnings.catch_warnings():
+            # columns without any value
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmedian(samples, axis=0)
+    return np.median(samples, axis=0)
+
+
+def bootstrap_medians(samples,      # type: np.ndarray
+                      n_bootstrap,  # type: int
+                      rng           # type: np.random.Generator
+                      ):
+    # type: (...) -> np.ndarray
+    """
+    Draws the medians of `n_bootstrap` resamplings with replacement of each column of `samples`, ignoring NaNs.
+
+    The resamplings are not materialized: when n indices are drawn uniformly in 1..n, the k-th smallest one is
+    ceil(n * U) where U is the k-th smallest of n uniform variables on [0, 1), distributed as Beta(k, n - k + 1). The
+    next one is drawn from the distribution of the smallest of the n - k other variables, knowing U. The cost is
+    therefore independent of the number of runs, and the draws have exactly the distribution of the resampled medians.
+
+    :param samples: a (runs x phases) matrix
+    :param n_bootstrap:
+    :param rng:
+    :return: a (n_bootstrap x phases) matrix
+    """
+    s = np.sort(samples, axis=0)  # NaNs are sorted last
+    n = (~np.isnan(samples)).sum(axis=0)
+    nn = np.maximum(n, 1)
+    k = (nn + 1) // 2
+    shape = (n_bootstrap, samples.shape[1])
+    u = rng.beta(k, nn - k + 1, size=shape)
+    # the (k+1)-th smallest variable, used when n is even
+    u2 = u + (1 - u) * (1 - rng.random(shape) ** (1 / np.maximum(nn - k, 1)))
+    j1 = np.clip(np.ceil(u * nn).astype(np.int64), 1, nn) - 1
+    j2 = np.where(nn % 2 == 0, np.clip(np.ceil(u2 * nn).astype(np.int64), 1, nn) - 1, j1)
+    medians = (np.take_along_axis(s, j1, axis=0) + np.take_along_axis(s, j2, axis=0)) / 2
+    medians[:, n == 0] = np.nan
+    return medians
+
+
+def _average_ranks(values  # type: np.ndarray
+                   ):
+    # type: (...) -> Tuple[np.ndarray, np.ndarray]
+    """
+    Ranks the values of each column (1 is the smallest), ties getting their average rank. NaNs are ranked last and
+    are never tied. Also returns the size of the group of ties of each value.
+    """
+    n = len(values)
+    order = np.argsort(values, axis=0, kind='stable')
+    s = np.take_along_axis(values, order, axis=0)
+    idx = np.broadcast_to(np.arange(n)[:, None], s.shape)
+    # NaN != NaN: NaNs are all in their own group
+    differs = s[1:] != s[:-1]
+    first = np.where(np.concatenate([np.ones((1, s.shape[1]), bool), differs]), idx, 0)
+    first = np.maximum.accumulate(first, axis=0)
+    last = np.where(np.concatenate([differs, np.ones((1, s.shape[1]), bool)]), idx, n)
+    last = np.minimum.accumulate(last[::-1], axis=0)[::-1]
+    ranks = np.empty(s.shape)
+    ties = np.empty(s.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=0)
+    np.put_along_axis(ties, order, last - first + 1, axis=0)
+    return ranks, ties
+
+
+def mann_whitney(baseline,  # type: np.ndarray
+                 candidate  # type: np.ndarray
+                 ):
+    # type: (...) -> Tuple[np.ndarray, np.ndarray]
+    """
+    Two-sided Mann-Whitney U tests between the columns of two matrices, ignoring NaNs. The p-values use the normal
+    approximation, with tie and continuity corrections: they are accurate for about 8 samples or more on each side.
+
+    :param baseline: a (runs x phases) matrix
+    :param candidate: a (runs x phases) matrix
+    :return: the U statistic of the baseline for each column, and the p-values (NaN when a column has no samples)
+    """
+    ranks, ties = _average_ranks(np.concatenate([baseline, candidate]))
+    n1 = (~np.isnan(baseline)).sum(axis=0)
+    n2 = (~np.isnan(candidate)).sum(axis=0)
+    n = n1 + n2
+    u1 = np.where(np.isnan(baseline), 0, ranks[:len(baseline)]).sum(axis=0) - n1 * (n1 + 1) / 2
+    # each group of t ties contributes t^3 - t, that is t^2 - 1 for each of its values
+    tie_term = np.where(np.isnan(np.concatenate([baseline, candidate])), 0, ties ** 2 - 1).sum(axis=0)
+    with np.errstate(all='ignore'):
+        sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+        z = np.maximum(np.abs(u1 - n1 * n2 / 2) - 0.5, 0) / sigma
+    p = np.where(sigma > 0, _erfc(np.nan_to_num(z) / sqrt(2)).astype(float), 1.)
+    p[(n1 == 0) | (n2 == 0)] = np.nan
+    return u1, np.minimum(p, 1.)
+
+
+def compare_samples(phase_ids,         # type: Sequence[str]
+                    baseline,          # type: np.ndarray
+                    candidate,         # type: np.ndarray
+                    n_bootstrap=1000,  # type: int
+                    confidence=0.95,   # type: float
+                    alpha=0.05,        # type: float
+                    seed=None          # type: int
+                    ):
+    # type: (...) -> Dict[str, Any]
+    """
+    Compares the durations of phases in two sets of runs, given as (runs x phases) matrices with NaN for missing
+    values, for example created with `elapsed_matrix`. See `compare_runs` for the other arguments and the result.
+
+    :param phase_ids: the phase ids of the columns
+    :param baseline: the durations in the reference runs
+    :param candidate: the durations in the runs to compare with the reference
+    """
+    baseline = np.asarray(baseline, dtype=float)
+    candidate = np.asarray(candidate, dtype=float)
+    if len(baseline) == 0 or len(candidate) == 0:
+        raise ValueError("Both sets of runs should contain at least one run")
+    with np.errstate(all='ignore'):
+        base_median = _medians(baseline)
+        cand_median = _medians(candidate)
+        ratio = cand_median / base_median
+        rng = np.random.default_rng(seed)
+        ratios = bootstrap_medians(candidate, n_bootstrap, rng) / bootstrap_medians(baseline, n_bootstrap, rng)
+    tail = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, high = np.nanpercentile(ratios, [tail, 100 - tail], axis=0)
+    _, p_value = mann_whitney(baseline, candidate)
+    regression = (p_value < alpha) & (low > 1)
+
+    # regressions first, then by decreasing ratio
+    order = np.lexsort((-np.nan_to_num(ratio, nan=-np.inf), ~regression))
+    phase_ids = np.array(list(phase_ids), dtype=object)
+    return dict(phase_id=phase_ids[order].tolist(),
+                n_baseline=(~np.isnan(baseline)).sum(axis=0)[order],
+                n_candidate=(~np.isnan(candidate)).sum(axis=0)[order],
+                baseline_median=base_median[order],
+                candidate_median=cand_median[order],
+                ratio=ratio[order],
+                ratio_low=low[order],
+                ratio_high=high[order],
+                p_value=p_value[order],
+                regression=regression[order])
+
+
+def compare_runs(baseline,          # type: Iterable[Kompanion]
+                 candidate,         # type: Iterable[Kompanion]
+                 n_bootstrap=1000,  # type: int
+                 confidence=0.95,   # type: float
+                 alpha=0.05,        # type: float
+                 seed=None          # type: int
+                 ):
+    # type: (...) -> Dict[str, Any]
+    """
+    Compares the `elapsed_seconds` of each phase id between two sets of runs, and returns a table of all phase ids
+    with, as columns:
+
+     - 'phase_id', 'n_baseline', 'n_candidate': the phase id and its number of runs in each set,
+     - 'baseline_median', 'candidate_median', 'ratio': the median durations, and the ratio candidate / baseline,
+     - 'ratio_low', 'ratio_high': the bootstrap confidence interval of the ratio,
+     - 'p_value': the p-value of a two-sided Mann-Whitney U test,
+     - 'regression': True when the phase is significantly slower: the p-value is below `alpha` and the confidence
+       interval of the ratio is above 1.
+
+    Regressions come first, then phases are sorted by decreasing ratio. The table can be passed to `pandas.DataFrame`.
+
+    :param baseline: the reference runs, as `Kompanion`s or `KompanionSnapshot`s
+    :param candidate: the runs to compare with the reference
+    :param n_bootstrap: the number of bootstrap resamplings
+    :param confidence: the level of the confidence interval of the ratio
+    :param alpha: the significance level of the test
+    :param seed: an optional seed for the bootstrap, for reproducible results
+    :return: a dict of columns
+    """
+    baseline = _durations(baseline)
+    candidate = _durations(candidate)
+    phase_ids = list(dict.fromkeys(phase_id for d in baseline + candidate for phase_id in d))
+    return compare_samples(phase_ids, _to_matrix(baseline, phase_ids), _to_matrix(candidate, phase_ids),
+                           n_bootstrap=n_bootstrap, confidence=confidence, alpha=alpha, seed=seed)
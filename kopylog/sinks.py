@@ -0,0 +1,217 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Sinks receive each phase of a `Kompanion` as soon as it is stopped. See `Kompanion(sink=...)`.
+"""
+import atexit
+import json
+import os
+import warnings
+from collections import deque
+from threading import Thread, Event, Lock
+
+from kopylog.spill import load_spilled_attrs
+
+try:  # python 3.5+
+    from typing import Any, Callable, Dict, IO, Optional, Union
+    from kopylog.main import PhaseInfo
+except ImportError:
+    pass
+
+
+class PhaseSink(object):
+    """
+    Base class of phase sinks. `write` is called with each phase when it is stopped: it should be fast, and should
+    not keep a reference to the phase if possible.
+    """
+
+    def write(self,
+              phase  # type: PhaseInfo
+              ):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _capture(phase  # type: PhaseInfo
+             ):
+    """ Captures the raw contents of a phase, cheaply. See `_capture_to_record` """
+    parent = phase._parent
+    return (phase.phase_id, None if parent is None else parent.phase_id, phase._anchor, phase._start_ns,
+            phase._end_ns, dict(phase.odict))
+
+
+def _capture_to_record(captured):
+    # type: (...) -> Dict[str, Any]
+    phase_id, parent_id, anchor, start_ns, end_ns, attrs = captured
+    record = {'phase_id': phase_id,
+              'parent_phase_id': parent_id,
+              'start_time': None if start_ns is None else anchor.to_datetime(start_ns).isoformat(),
+              'end_time': None if end_ns is None else anchor.to_datetime(end_ns).isoformat(),
+              'elapsed_seconds': None if end_ns is None else (end_ns - start_ns) / 1e9}
+    # spilled values are loaded back, here in the writer thread
+    record.update(load_spilled_attrs(attrs))
+    return record
+
+
+def phase_to_record(phase  # type: PhaseInfo
+                    ):
+    # type: (...) -> Dict[str, Any]
+    """
+    Returns the dictionary written by `JsonLinesSink` for a phase: its id, parent phase id, timings and attributes.
+
+    :param phase:
+    :return:
+    """
+    return _capture_to_record(_capture(phase))
+
+
+class JsonLinesSink(PhaseSink):
+    """
+    A sink writing each phase as one JSON Lines record (see `phase_to_record`).
+
+    `write` only takes a copy of the phase raw contents. The records are built, serialized and written by a background
+    thread, in batches: every `flush_interval` seconds, or as soon as `batch_size` records are pending. The file is
+    flushed after each batch, so that a crash only loses the last records. Call `close()` (or use the sink as a context
+    manager) to write the remaining records; this is also done automatically at interpreter exit.
+
+    A record that can not be serialized is skipped, counted in `nb_errors` and reported to `on_error`: the other
+    records are still written. A batch that can not be written to the file (full disk...) is also counted in
+    `nb_errors` and reported, and its records are counted in `nb_dropped`. When the file is too slow, at most
+    `max_pending` records wait to be written: the next ones are dropped and counted in `nb_dropped`, so that memory
+    stays bounded.
+    """
+
+    def __init__(self,
+                 file,                # type: Union[str, IO[str]]
+                 batch_size=1000,     # type: int
+                 flush_interval=1.0,  # type: float
+                 fsync=False,         # type: bool
+                 default=str,         # type: Optional[Callable[[Any], Any]]
+                 on_error=None,       # type: Callable[[Optional[str], Exception], Any]
+                 max_pending=100000   # type: int
+                 ):
+        """
+
+        :param file: a path, that is opened in append mode, or an open text file
+        :param batch_size: the number of pending records that triggers a write
+        :param flush_interval: the maximum duration in seconds between two writes
+        :param fsync: True to also call `os.fsync` after each batch
+        :param default: the `default` argument of `json.dumps`, used for values that are not JSON-serializable.
+            By default `str` is used.
+        :param on_error: an optional callback receiving the phase id and the exception, for each record that can not be
+            serialized, or None and the exception for each batch that can not be written. By default a `RuntimeWarning`
+            is issued.
+        :param max_pending: the maximum number of records waiting to be written. Default 100000.
+        """
+        if isinstance(file, str):
+            self._file = open(file, mode='a', encoding='utf-8')
+            self._owns_file = True
+        else:
+            self._file = file
+            self._owns_file = False
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.default = default
+        self.on_error = on_error
+        self.max_pending = max_pending
+        self.nb_errors = 0
+        self.nb_dropped = 0
+
+        self._pending = deque()
+        self._wakeup = Event()
+        self._write_lock = Lock()
+        self._closed = False
+        self._thread = Thread(target=self._run, name='kopylog-jsonlines-sink', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self,
+              phase  # type: PhaseInfo
+              ):
+        """
+        Queues a record for the given phase. It will be written by the background thread.
+
+        :param phase:
+        :return:
+        """
+        pending = self._pending
+        if len(pending) >= self.max_pending:
+            self.nb_dropped += 1
+            return
+        pending.append(_capture(phase))
+        if len(pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """ Writes all pending records now """
+        with self._write_lock:
+            pending = self._pending
+            lines = []
+            default = self.default
+            while pending:
+                captured = pending.popleft()
+                try:
+                    lines.append(json.dumps(_capture_to_record(captured), default=default))
+                except Exception as e:
+                    self._report_error(captured[0], e)
+            if lines and not self._file.closed:
+                try:
+                    self._file.write("\n".join(lines) + "\n")
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                except Exception as e:
+                    # for example a full disk: the batch is lost, but the writer thread keeps running
+                    self.nb_dropped += len(lines)
+                    self._report_error(None, e)
+
+    def _report_error(self,
+                      phase_id,  # type: Optional[str]
+                      error      # type: Exception
+                      ):
+        """
+        Reports a record that could not be serialized, or a batch that could not be written if `phase_id` is None. It
+        must not raise, to keep the writer thread alive.
+        """
+        self.nb_errors += 1
+        try:
+            if self.on_error is not None:
+                self.on_error(phase_id, error)
+            elif phase_id is None:
+                warnings.warn("Records could not be written to the JSON Lines sink: %r" % (error,), RuntimeWarning)
+            else:
+                warnings.warn("Phase %r could not be written to the JSON Lines sink: %r" % (phase_id, error),
+                              RuntimeWarning)
+        except Exception:
+            pass
+
+    def close(self):
+        """ Stops the background thread, writes all pending records and closes the file if it was opened here """
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        if self._owns_file:
+            self._file.close()
+        atexit.unregister(self.close)
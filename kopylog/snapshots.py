@@ -0,0 +1,208 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Read-only snapshots of a live `Kompanion`, for example for a reporter thread. See `Kompanion.snapshot()`.
+
+A snapshot is made of `FrozenPhase`, that are read-only copies of the phases. Frozen phases are shared between
+successive snapshots: a phase is copied again only if it changed since the previous snapshot, which the Kompanion
+tracks so that the other phases are not checked.
+"""
+from operator import attrgetter
+
+from kopylog.main import PhaseInfo, _PHASE_ID_ATT_NAME, _set
+from kopylog.spill import SpillHandle
+from kopylog.utils_bags import ODict
+from kopylog.utils_render import render
+
+try:  # python 3.5+
+    from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+    from kopylog.main import Kompanion
+except ImportError:
+    pass
+
+
+class FrozenPhase(object):
+    """
+    A read-only copy of a `PhaseInfo`: its id, user attributes, parent id and timings. User attributes can be read as
+    attributes, and timings are available through the same properties as `PhaseInfo`.
+    """
+    __slots__ = (_PHASE_ID_ATT_NAME, 'odict', 'parent_id', '_anchor', '_start_ns', '_end_ns', '_loop_ns', '_source_id',
+                 '_version')
+
+    def __init__(self,
+                 phase  # type: PhaseInfo
+                 ):
+        # read the version first: if the phase changes while it is copied, it will be copied again next time
+        _set(self, '_version', phase._version)
+        # only the id of the phase is kept: a snapshot must not keep alive the phases removed from the Kompanion
+        _set(self, '_source_id', id(phase))
+        _set(self, _PHASE_ID_ATT_NAME, phase.phase_id)
+        # copying a dict is atomic with the GIL, so this is safe even if another thread sets attributes
+        _set(self, 'odict', ODict(phase.odict))
+        parent = phase._parent
+        _set(self, 'parent_id', None if parent is None else parent.phase_id)
+        _set(self, '_anchor', phase._anchor)
+        _set(self, '_start_ns', phase._start_ns)
+        _set(self, '_end_ns', phase._end_ns)
+        _set(self, '_loop_ns', phase._loop_ns)
+
+    def _is_up_to_date(self,
+                       phase  # type: PhaseInfo
+                       ):
+        # type: (...) -> bool
+        """
+        Returns True if this is a copy of `phase` in its current state. The id of a phase that was garbage collected can
+        be reused, but not with the same start and end counters.
+        """
+        return (self._source_id == id(phase) and self._version == phase._version and self._end_ns is not None
+                and self._end_ns == phase._end_ns and self._start_ns == phase._start_ns)
+
+    def is_started(self):
+        return self._start_ns is not None
+
+    def is_stopped(self):
+        return self._end_ns is not None
+
+    start_time = PhaseInfo.start_time
+    end_time = PhaseInfo.end_time
+    elapsed_ns = PhaseInfo.elapsed_ns
+    elapsed_seconds = PhaseInfo.elapsed_seconds
+    loop_seconds = PhaseInfo.loop_seconds
+    awaiting_seconds = PhaseInfo.awaiting_seconds
+
+    def __getattr__(self, key):
+        try:
+            value = self.odict[key]
+        except KeyError:
+            raise AttributeError(key)
+        return value.load() if type(value) is SpillHandle else value
+
+    def __setattr__(self, key, value):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __delattr__(self, key):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __str__(self):
+        return render(self.odict)
+
+    def __repr__(self):
+        return "%s<%s>:\n%s" % (type(self).__name__, self.phase_id, render(self.odict))
+
+
+class KompanionSnapshot(object):
+    """
+    A consistent and read-only view of the phases of a `Kompanion` at a given time. It provides the same read API as
+    `Kompanion.phases` (`keys()`, `values()`, `items()`, item access, `in`, `len()` and iteration on the phases), and
+    the columnar export methods.
+    """
+    __slots__ = '_phases', 'nb_frozen'
+
+    def __init__(self,
+                 phases,    # type: Dict[str, FrozenPhase]
+                 nb_frozen  # type: int
+                 ):
+        """
+
+        :param phases: a dict of phase id -> `FrozenPhase`, in order. It should not be modified afterwards.
+        :param nb_frozen: the number of phases that were copied to create this snapshot. The others are shared with
+            the previous snapshot.
+        """
+        self._phases = phases
+        self.nb_frozen = nb_frozen
+
+    def keys(self):
+        # type: (...) -> List[str]
+        return list(self._phases.keys())
+
+    def values(self):
+        # type: (...) -> List[FrozenPhase]
+        return list(self._phases.values())
+
+    def items(self):
+        # type: (...) -> List[Tuple[str, FrozenPhase]]
+        return list(self._phases.items())
+
+    def __getitem__(self, phase_id):
+        # type: (...) -> FrozenPhase
+        return self._phases[phase_id]
+
+    def __contains__(self, phase_id):
+        return phase_id in self._phases
+
+    def __iter__(self):
+        # type: (...) -> Iterator[FrozenPhase]
+        return iter(self._phases.values())
+
+    def __len__(self):
+        return len(self._phases)
+
+    def to_columns(self,
+                   pivot=False  # type: bool
+                   ):
+        # type: (...) -> Dict[str, List[Any]]
+        """ Returns the phases as a dict of lists. See `Kompanion.to_columns` """
+        from kopylog.export import phases_to_columns
+        return phases_to_columns(self._phases.values(), pivot=pivot)
+
+    def to_df(self,
+              pivot=False  # type: bool
+              ):
+        """ Returns the phases as a pandas DataFrame. See `Kompanion.to_df` """
+        from kopylog.export import columns_to_df
+        return columns_to_df(self.to_columns(pivot=pivot))
+
+
+_get_id = attrgetter(_PHASE_ID_ATT_NAME)
+
+
+def take_snapshot(phases,       # type: List[PhaseInfo]
+                  previous,     # type: Optional[KompanionSnapshot]
+                  changed=None  # type: Optional[Set[str]]
+                  ):
+    # type: (...) -> KompanionSnapshot
+    """
+    Creates a snapshot of the given phases. The frozen phases of `previous` are reused for the stopped phases that did
+    not change since then: only new, running or modified phases are copied.
+
+    :param phases: the phases, in order
+    :param previous: the previous snapshot, if any
+    :param changed: the ids of the phases added or modified since `previous` was taken, if known. The frozen phases of
+        the other ones are then reused without being checked: only the phases with these ids are copied, as well as
+        the phases with an id that was not in `previous`.
+    :return:
+    """
+    if previous is not None and changed is not None:
+        # reuse all the frozen phases by id, without visiting them
+        ids = list(map(_get_id, phases))
+        previous_phases = previous._phases
+        if ids == list(previous_phases):
+            # the same ids in the same order: copying the dict is much faster than building it
+            frozen = ODict(previous_phases)
+        else:
+            frozen = ODict(zip(ids, map(previous_phases.get, ids)))
+            if None in frozen.values():
+                # new ids
+                changed = changed.union([k for k, f in frozen.items() if f is None])
+        changed = [k for k in changed if k in frozen]
+        if len(changed) < 8:
+            # a few linear searches are faster than indexing all phases by id
+            get_phase = lambda phase_id: phases[ids.index(phase_id)]
+        else:
+            get_phase = dict(zip(ids, phases)).__getitem__
+        for phase_id in changed:
+            frozen[phase_id] = FrozenPhase(get_phase(phase_id))
+        return KompanionSnapshot(frozen, len(changed))
+
+    previous_phases = dict() if previous is None else previous._phases
+    frozen = ODict()
+    nb_frozen = 0
+    for phase in phases:
+        phase_id = phase.phase_id
+        f = previous_phases.get(phase_id)
+        if f is None or not f._is_up_to_date(phase):
+            f = FrozenPhase(phase)
+            nb_frozen += 1
+        frozen[phase_id] = f
+    return KompanionSnapshot(frozen, nb_frozen)
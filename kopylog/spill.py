@@ -0,0 +1,316 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Spilling of large phase attributes to disk. See `Kompanion(spill=SpillPolicy(...))`.
+
+Values are written with pickle protocol 5, with out-of-band buffers: the raw buffers of numpy arrays (and therefore of
+pandas objects) are written as-is after the pickle stream, aligned, and are memory-mapped when the value is loaded.
+Before python 3.8, protocol 5 is not available: values are pickled in-band with the highest protocol, and are loaded
+entirely.
+
+Spilled values are only held by their phases as `SpillHandle`s. The handles are replaced by the values when phases are
+exported or pickled, since the spill files are local and temporary. A spill file is deleted as soon as its handle is
+not used anymore, for example when the attribute is set again or when its phase is freed.
+"""
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import warnings
+from itertools import count
+from mmap import mmap, ACCESS_COPY
+from struct import Struct
+from weakref import finalize
+
+from kopylog.utils_render import RenderOutput, register_summarizer
+
+try:  # python 3.5+
+    from typing import Any, Callable, Dict, List, Mapping, MutableMapping, Optional
+except ImportError:
+    pass
+
+
+_MAGIC = b'KPSPILL1'
+# header: magic, pickle stream length, number of buffers
+_HEADER = Struct('<8sQI')
+# then for each buffer: offset and length
+_BUFFER = Struct('<QQ')
+_ALIGNMENT = 64
+
+# python 3.8+: pickle protocol 5 with out-of-band buffers
+_OUT_OF_BAND = pickle.HIGHEST_PROTOCOL >= 5
+
+
+def value_nbytes(value  # type: Any
+                 ):
+    # type: (...) -> int
+    """
+    A cheap estimate of the memory used by a value: `nbytes` for numpy arrays and pandas series, the sum of
+    `memory_usage()` for pandas dataframes, and `sys.getsizeof` otherwise.
+
+    :param value:
+    :return:
+    """
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    memory_usage = getattr(value, 'memory_usage', None)
+    if callable(memory_usage):
+        try:
+            return int(memory_usage().sum())
+        except Exception:
+            pass
+    return sys.getsizeof(value)
+
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def dump_spill_file(value,  # type: Any
+                    path    # type: str
+                    ):
+    """
+    Writes `value` to `path`, with pickle protocol 5 and out-of-band buffers when available. See `load_spill_file`.
+
+    :param value:
+    :param path:
+    :return:
+    """
+    if _OUT_OF_BAND:
+        buffers = []  # type: List[pickle.PickleBuffer]
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        raws = [b.raw() for b in buffers]
+    else:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        raws = []
+
+    offset = _HEADER.size + _BUFFER.size * len(raws) + len(data)
+    table = []
+    for raw in raws:
+        offset = _align(offset)
+        table.append((offset, raw.nbytes))
+        offset += raw.nbytes
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(data), len(raws)))
+        for entry in table:
+            f.write(_BUFFER.pack(*entry))
+        f.write(data)
+        for raw, (buffer_offset, _) in zip(raws, table):
+            f.write(b'\0' * (buffer_offset - f.tell()))
+            f.write(raw)
+
+
+def load_spill_file(path  # type: str
+                    ):
+    # type: (...) -> Any
+    """
+    Loads a value written with `dump_spill_file`. The out-of-band buffers are not read: they are memory-mapped in
+    copy-on-write mode, so that the arrays are loaded lazily by the OS and remain writable.
+
+    :param path:
+    :return:
+    """
+    with open(path, 'rb') as f:
+        mm = mmap(f.fileno(), 0, access=ACCESS_COPY)
+    view = memoryview(mm)
+    magic, data_len, nb_buffers = _HEADER.unpack_from(view)
+    if magic != _MAGIC:
+        raise ValueError("%s is not a spill file" % path)
+    offset = _HEADER.size
+    buffers = []
+    for i in range(nb_buffers):
+        buffer_offset, length = _BUFFER.unpack_from(view, offset)
+        buffers.append(view[buffer_offset:buffer_offset + length])
+        offset += _BUFFER.size
+    data = view[offset:offset + data_len]
+    return pickle.loads(data, buffers=buffers) if buffers else pickle.loads(data)
+
+
+class SpillHandle(object):
+    """
+    A lazy handle on a value spilled to disk. `PhaseInfo` replaces the attributes values that it holds by such handles,
+    and transparently loads the value (see `load`) each time the attribute is read.
+    """
+    __slots__ = 'path', 'nbytes', 'type_name', '__weakref__'
+
+    def __init__(self,
+                 path,      # type: str
+                 nbytes,    # type: int
+                 type_name  # type: str
+                 ):
+        """
+
+        :param path: the spill file
+        :param nbytes: the estimated size of the value in memory
+        :param type_name: the name of the type of the value
+        """
+        self.path = path
+        self.nbytes = nbytes
+        self.type_name = type_name
+
+    def load(self):
+        # type: (...) -> Any
+        """ Loads the value from the spill file. Large arrays are memory-mapped. """
+        return load_spill_file(self.path)
+
+    def __reduce__(self):
+        return SpillHandle, (self.path, self.nbytes, self.type_name)
+
+    def __repr__(self):
+        return "%s<%s, %s bytes, %s>" % (type(self).__name__, self.type_name, self.nbytes, self.path)
+
+
+def load_spilled(values  # type: List[Any]
+                 ):
+    # type: (...) -> List[Any]
+    """
+    Replaces in place the `SpillHandle`s of `values` by the values they hold, loaded from their spill files.
+
+    :param values:
+    :return: `values`
+    """
+    if SpillHandle in set(map(type, values)):
+        for i, value in enumerate(values):
+            if type(value) is SpillHandle:
+                values[i] = value.load()
+    return values
+
+
+def load_spilled_attrs(attrs  # type: Mapping[str, Any]
+                       ):
+    # type: (...) -> Mapping[str, Any]
+    """
+    Returns `attrs`, or a dict of the same attributes where the `SpillHandle`s are replaced by the values they hold.
+
+    :param attrs:
+    :return:
+    """
+    if SpillHandle in set(map(type, attrs.values())):
+        return {k: v.load() if type(v) is SpillHandle else v for k, v in attrs.items()}
+    return attrs
+
+
+def _render_handle(handle,  # type: SpillHandle
+                   out      # type: RenderOutput
+                   ):
+    """ Renders a handle as its repr: its `nbytes` is the size of the spilled value, not of the repr """
+    out.write(repr(handle))
+
+
+register_summarizer(SpillHandle, _render_handle)
+
+
+class SpillPolicy(object):
+    """
+    Defines which phase attributes values are spilled to disk: the ones larger than `threshold_bytes`, estimated with
+    `sizeof`. They are written to `directory`, by default a new temporary directory, and replaced by a `SpillHandle`.
+    """
+    __slots__ = 'threshold_bytes', 'directory', 'sizeof'
+
+    def __init__(self,
+                 threshold_bytes=10 * 1024 * 1024,  # type: int
+                 directory=None,                    # type: str
+                 sizeof=value_nbytes                # type: Callable[[Any], int]
+                 ):
+        """
+
+        :param threshold_bytes: the size above which values are spilled. Default 10MiB.
+        :param directory: an optional existing directory where to write the spill files. By default a temporary
+            directory is created when the first value is spilled, and removed when the files are deleted.
+        :param sizeof: the function estimating the memory used by a value. Default `value_nbytes`.
+        """
+        self.threshold_bytes = threshold_bytes
+        self.directory = directory
+        self.sizeof = sizeof
+
+
+class _SpillState(object):
+    """ The spill files of a `Kompanion`, created according to a `SpillPolicy` """
+    __slots__ = 'policy', 'nb_spilled', 'spilled_bytes', 'nb_errors', '_files', '_counter', '_tmp_dir'
+
+    def __init__(self,
+                 policy  # type: SpillPolicy
+                 ):
+        self.policy = policy
+        self.nb_spilled = 0
+        self.spilled_bytes = 0
+        self.nb_errors = 0
+        # the finalizer deleting each spill file when its handle is freed, by path
+        self._files = dict()  # type: Dict[str, finalize]
+        self._counter = count()
+        self._tmp_dir = None  # type: Optional[str]
+
+    def _directory(self):
+        # type: (...) -> str
+        directory = self.policy.directory
+        if directory is not None:
+            return directory
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix='kopylog-spill-')
+        return self._tmp_dir
+
+    def spill(self,
+              value  # type: Any
+              ):
+        # type: (...) -> Any
+        """ Returns `value`, or a `SpillHandle` if it is larger than the threshold """
+        if type(value) is SpillHandle:
+            # already spilled: its `nbytes` is the size of the value, not of the handle
+            return value
+        policy = self.policy
+        nbytes = policy.sizeof(value)
+        if nbytes < policy.threshold_bytes:
+            return value
+        path = os.path.join(self._directory(), "%s-%s.spill" % (os.getpid(), next(self._counter)))
+        try:
+            dump_spill_file(value, path)
+        except Exception as e:
+            # for example a value that can not be pickled: it is kept in memory
+            _remove(path)
+            self.nb_errors += 1
+            warnings.warn("A %s value could not be spilled to disk, it is kept in memory: %r"
+                          % (type(value).__name__, e), RuntimeWarning)
+            return value
+        self.nb_spilled += 1
+        self.spilled_bytes += nbytes
+        handle = SpillHandle(path, nbytes, type(value).__name__)
+        self._files[path] = finalize(handle, self._delete, path)
+        return handle
+
+    def _delete(self,
+                path  # type: str
+                ):
+        """ Deletes a spill file, once its handle is freed or on cleanup """
+        self._files.pop(path, None)
+        _remove(path)
+
+    def spill_values(self,
+                     attrs  # type: MutableMapping[str, Any]
+                     ):
+        """ Replaces in place the values of `attrs` larger than the threshold by `SpillHandle`s, see `spill` """
+        for key, value in list(attrs.items()):
+            spilled = self.spill(value)
+            if spilled is not value:
+                attrs[key] = spilled
+
+    def cleanup(self):
+        """ Deletes all spill files. Their handles can not be loaded anymore. """
+        for delete in list(self._files.values()):
+            delete()
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+
+def _remove(path  # type: str
+            ):
+    """ Deletes a file if possible """
+    try:
+        os.remove(path)
+    except OSError:
+        # for example a file still memory-mapped on windows, or not created
+        pass
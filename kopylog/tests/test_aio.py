@@ -0,0 +1,85 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import asyncio
+import time
+
+import pytest
+
+from kopylog import Kompanion, get_current_phase
+from kopylog.aio import run
+
+
+def test_async_phases():
+    """ Concurrent tasks have their own current phase, and the time spent running on the loop is measured """
+    pi = Kompanion()
+
+    async def blocking():
+        async with pi.add_new_phase('blocking') as phase:
+            await asyncio.sleep(0)
+            assert get_current_phase() is phase
+            time.sleep(0.05)
+            await asyncio.sleep(0)
+        return phase
+
+    async def awaiting():
+        async with pi.add_new_phase('awaiting') as phase:
+            await asyncio.sleep(0.05)
+            assert get_current_phase() is phase
+            async with pi.add_new_phase('child') as child:
+                await asyncio.sleep(0)
+            assert child.parent_phase is phase
+        return phase
+
+    async def main():
+        async with pi.add_new_phase('main') as main_phase:
+            blocking_phase, awaiting_phase = await asyncio.gather(blocking(), awaiting())
+        return main_phase, blocking_phase, awaiting_phase
+
+    main_phase, blocking_phase, awaiting_phase = run(main())
+
+    # both tasks inherited the main phase as their parent
+    assert blocking_phase.parent_phase is main_phase
+    assert awaiting_phase.parent_phase is main_phase
+    assert get_current_phase() is None
+
+    assert blocking_phase.loop_seconds >= 0.05
+    assert awaiting_phase.loop_seconds < 0.05 <= awaiting_phase.awaiting_seconds
+    assert main_phase.loop_seconds < main_phase.elapsed_seconds
+
+
+def test_untimed_async_phase():
+    """ Without kopylog.aio.run, phases still work but do not have a loop time """
+    pi = Kompanion()
+
+    async def main():
+        async with pi.add_new_phase('main') as phase:
+            await asyncio.sleep(0)
+        return phase
+
+    phase = asyncio.run(main())
+    assert phase.is_stopped()
+    assert not hasattr(phase, 'loop_seconds')
+
+
+@pytest.mark.parametrize('keep_phases', [True, False], ids="keep_phases={}".format)
+def test_gathered_children_exclusive_time(keep_phases):
+    """ Children running at the same time are subtracted once from the exclusive time of their parent """
+    pi = Kompanion(keep_phases=keep_phases)
+
+    async def child(i):
+        async with pi.add_new_phase('child_%s' % i) as phase:
+            await asyncio.sleep(0.05)
+        return phase
+
+    async def main():
+        async with pi.add_new_phase('main') as main_phase:
+            children = await asyncio.gather(*[child(i) for i in range(5)])
+        return main_phase, children
+
+    main_phase, children = asyncio.run(main())
+    assert len(main_phase.child_phases) == (5 if keep_phases else 0)
+    # the children overlap: they cover the interval from the first start to the last end
+    covered_ns = max(c._end_ns for c in children) - min(c._start_ns for c in children)
+    assert 0 <= main_phase.exclusive_seconds < main_phase.elapsed_seconds
+    assert main_phase.exclusive_seconds == (main_phase.elapsed_ns - covered_ns) / 1e9
@@ -0,0 +1,189 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from kopylog import Kompanion
+from kopylog.archive import ArchiveReader
+
+
+def test_archive_round_trip():
+    """ Phases, their attributes of all types and the phases tree are restored exactly """
+    pi = Kompanion()
+    values = dict(none=None, flag=True, small=-3, big=2 ** 70, ratio=0.1, text='hello', long_text='x' * 1000,
+                  raw=b'\x00\x01', when=datetime(2020, 1, 2, 3, 4, 5, 6), items=[1, 'a', (2.5, None)],
+                  mapping={'a': [1], 2: {'b': False}}, arr=np.arange(6, dtype=np.int32).reshape(2, 3),
+                  aware=datetime(2020, 1, 1, tzinfo=timezone.utc), delta=timedelta(seconds=3))
+    with pi.add_new_phase('main') as main:
+        for k, v in values.items():
+            setattr(main, k, v)
+        with pi.add_new_phase('child'):
+            pass
+    pi.add_new_phase('not_started', start=False)
+
+    f = BytesIO()
+    pi.save(f, metadata={'run_id': 'abc'})
+    restored = Kompanion.load(f)
+
+    assert restored.phases.keys() == ['main', 'child', 'not_started']
+    r_main = restored.phases['main']
+    assert list(r_main.odict) == list(values)
+    for k, v in values.items():
+        r = getattr(r_main, k)
+        assert type(r) is type(v)
+        if k == 'arr':
+            assert r.dtype == v.dtype and np.array_equal(r, v)
+        else:
+            assert r == v
+    assert r_main.start_time == main.start_time and r_main.elapsed_ns == main.elapsed_ns
+    assert restored.phases['child'].parent_phase is r_main
+    assert not restored.phases['not_started'].is_started()
+
+    with ArchiveReader(f) as reader:
+        assert reader.metadata == {'run_id': 'abc'}
+        assert len(reader) == 3
+        # a single phase can be decoded without the others
+        assert reader.read_phase(1).phase_id == 'child'
+        assert [p.phase_id for p in reader] == ['main', 'child', 'not_started']
+
+
+def test_archive_incomplete():
+    """ An archive that was not closed can not be read """
+    from kopylog.archive import ArchiveWriter
+    f = BytesIO()
+    writer = ArchiveWriter(f)
+    with Kompanion().add_new_phase('a') as phase:
+        pass
+    writer.write_phase(phase)
+    with pytest.raises(ValueError):
+        ArchiveReader(f)
+
+
+def test_archive_anchors():
+    """ Anchors are stored once per value, without limit on their number, and tz-aware anchors are rejected """
+    from kopylog.archive import ArchiveWriter
+    from kopylog.main import PhaseInfo
+    from kopylog.utils_clock import WallClockAnchor
+
+    t0 = datetime(2020, 1, 1)
+    phases = [PhaseInfo('p%s' % i, start=False, anchor=WallClockAnchor(t0 + timedelta(seconds=i), i))
+              for i in range(70000)]
+    # an equal anchor is not stored again
+    phases.append(PhaseInfo('same', start=False, anchor=WallClockAnchor(t0, 0)))
+    f = BytesIO()
+    with ArchiveWriter(f) as writer:
+        writer.write_phases(phases)
+    with ArchiveReader(f) as reader:
+        assert len(reader.anchors) == 70000
+        restored = list(reader)
+    assert restored[69999]._anchor.wall_time == t0 + timedelta(seconds=69999)
+    assert restored[69999]._anchor.counter_ns == 69999
+    assert restored[-1]._anchor is restored[0]._anchor
+
+    aware = PhaseInfo('aware', start=False, anchor=WallClockAnchor(t0.replace(tzinfo=timezone.utc), 0))
+    with ArchiveWriter(BytesIO()) as writer:
+        with pytest.raises(ValueError):
+            writer.write_phase(aware)
+
+
+def test_archive_invalid_metadata(tmp_path):
+    """ Metadata that is not JSON-serializable is rejected before the file is created """
+    from kopylog.archive import ArchiveWriter
+    path = tmp_path / 'run.kpa'
+    with pytest.raises(TypeError):
+        ArchiveWriter(str(path), metadata={'when': object()})
+    assert not path.exists()
+
+
+def test_archive_blocks(monkeypatch):
+    """ Phases are written in blocks: parents are referenced across blocks, list and tuple columns are restored """
+    from kopylog import archive
+    monkeypatch.setattr(archive, 'BLOCK_SIZE', 3)
+
+    pi = Kompanion()
+    with pi.add_new_phase('main'):
+        for i in range(10):
+            with pi.add_new_phase('child_%s' % i) as child:
+                child.tags = ['a', i]
+                child.shape = (i, i + 1)
+                child.nb = None if i % 2 else i
+    f = BytesIO()
+    pi.save(f)
+    restored = Kompanion.load(f)
+
+    assert restored.phases.keys() == pi.phases.keys()
+    r_main = restored.phases['main']
+    for i in range(10):
+        original, r = pi.phases['child_%s' % i], restored.phases['child_%s' % i]
+        assert r.parent_phase is r_main
+        assert r.odict == original.odict and type(r.shape) is tuple
+        assert r.elapsed_ns == original.elapsed_ns
+    with ArchiveReader(f) as reader:
+        assert len(reader.blocks) == 4
+        assert reader.read_phase(7).phase_id == 'child_6'
+
+
+def test_archive_invalid_ids():
+    """ Phases without a str id are rejected when they are written, so the archive can still be closed """
+    from kopylog.archive import ArchiveWriter
+    from kopylog.main import PhaseInfo
+
+    f = BytesIO()
+    with ArchiveWriter(f) as writer:
+        writer.write_phase(PhaseInfo('ok', start=False))
+        with pytest.raises(TypeError):
+            writer.write_phase(PhaseInfo(1, start=False))
+        with pytest.raises(TypeError):
+            writer.write_phases([PhaseInfo('fine', start=False), PhaseInfo(('a', 2), start=False)])
+    with ArchiveReader(f) as reader:
+        assert [p.phase_id for p in reader] == ['ok']
+
+
+def test_archive_streaming(monkeypatch):
+    """ The written phases are not kept alive by the writer, and parents written before are still referenced """
+    import gc
+    import weakref
+    from kopylog import archive
+    from kopylog.archive import ArchiveWriter
+    monkeypatch.setattr(archive, 'BLOCK_SIZE', 2)
+
+    pi = Kompanion(keep_phases=False)
+    refs = []
+    f = BytesIO()
+    with ArchiveWriter(f) as writer:
+        with pi.add_new_phase('main') as main:
+            writer.write_phase(main)
+            for i in range(6):
+                with pi.add_new_phase('child_%s' % i) as child:
+                    pass
+                writer.write_phase(child)
+                refs.append(weakref.ref(child))
+                del child
+            gc.collect()
+            # only the phases of the last block, not written yet, are alive
+            assert sum(r() is not None for r in refs) == 1
+    with ArchiveReader(f) as reader:
+        assert [parent for _, parent in reader.iter_records()] == [-1] + [0] * 6
+
+
+def test_archive_unlinked_children():
+    """ The time of the children unlinked from a phase is archived, so that its exclusive time is restored """
+    # only the last phase with a given id is kept: the previous children are unlinked from main
+    pi = Kompanion(aggregate=True)
+    with pi.add_new_phase('main') as main:
+        for i in range(3):
+            with pi.add_new_phase('child'):
+                pass
+    assert len(main.child_phases) == 1 and main._unlinked is not None
+    f = BytesIO()
+    pi.save(f)
+    restored = Kompanion.load(f).phases['main']
+    assert restored._unlinked == main._unlinked
+    assert restored.exclusive_seconds == main.exclusive_seconds
+    with ArchiveReader(f) as reader:
+        # a standalone phase has no children, but keeps the time of the unlinked ones
+        assert reader.read_phase(pi.phases.keys().index('main'))._unlinked == main._unlinked
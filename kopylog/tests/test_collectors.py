@@ -0,0 +1,264 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import os
+import sys
+import time
+import tracemalloc
+from threading import Thread
+
+import pytest
+
+from kopylog import Kompanion
+from kopylog.collectors import Collector, CpuTimeCollector, IOCollector, RssCollector, RusageCollector, \
+    StackSamplerCollector, TracemallocCollector, collapsed_stacks, write_collapsed_stacks
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_cpu_collectors():
+    """ CPU time is recorded for busy phases, not for sleeping ones; phases without collectors are not affected """
+    pi = Kompanion(collectors=['cpu', 'thread_time'])
+    with pi.add_new_phase('busy') as busy:
+        _busy(0.05)
+    with pi.add_new_phase('sleep') as sleep:
+        time.sleep(0.05)
+
+    assert busy.thread_cpu_seconds > 0.03
+    assert busy.cpu_seconds >= busy.thread_cpu_seconds * 0.9
+    assert sleep.thread_cpu_seconds < 0.02
+    assert list(sleep.odict) == ['cpu_seconds', 'thread_cpu_seconds']
+
+    with Kompanion().add_new_phase('no_collectors') as phase:
+        pass
+    assert phase._odict is None
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="/proc and per-thread rusage are linux-only")
+def test_rusage_and_io_collectors(tmpdir):
+    """ Context switches, page faults and written bytes are recorded """
+    pi = Kompanion(collectors=[RusageCollector(scope='thread'), IOCollector(), 'rusage'])
+    path = str(tmpdir.join('data.bin'))
+    with pi.add_new_phase('write') as phase:
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100000)
+        time.sleep(0.01)
+
+    assert phase.io_write_chars >= 100000
+    assert phase.voluntary_context_switches >= 1
+    for name in ('minor_page_faults', 'major_page_faults', 'involuntary_context_switches', 'block_inputs',
+                 'block_outputs', 'io_read_bytes', 'io_write_bytes', 'io_read_chars'):
+        assert getattr(phase, name) >= 0
+    os.remove(path)
+
+
+def test_custom_collector():
+    """ Custom collectors receive their start reading at stop time, and collectors can be checked """
+    class CounterCollector(Collector):
+        __slots__ = 'count',
+
+        def __init__(self):
+            self.count = 0
+
+        def start(self, phase):
+            self.count += 1
+            return self.count
+
+        def stop(self, phase, reading):
+            phase.reading = reading
+
+    collector = CounterCollector()
+    pi = Kompanion(collectors=[collector, CpuTimeCollector()])
+    with pi.add_new_phase('a') as a:
+        with pi.add_new_phase('b') as b:
+            pass
+    assert (a.reading, b.reading) == (1, 2)
+
+    with pytest.raises(ValueError):
+        Kompanion(collectors=['unknown'])
+    with pytest.raises(TypeError):
+        Kompanion(collectors=[object()])
+
+
+def test_tracemalloc_collector():
+    """ Net and peak allocations are recorded per phase, nested phases get their own peak, top sites are listed """
+    pi = Kompanion(collectors=[TracemallocCollector(phase_ids=['outer', 'inner'], top_n=3)])
+    with pi.add_new_phase('outer') as outer:
+        kept = bytearray(1000000)
+        with pi.add_new_phase('inner') as inner:
+            tmp = bytearray(3000000)
+            del tmp
+        with pi.add_new_phase('ignored') as ignored:
+            pass
+        tmp = bytearray(2000000)
+        del tmp
+
+    assert not tracemalloc.is_tracing()
+    assert abs(inner.alloc_net_bytes) < 100000
+    assert 900000 <= outer.alloc_net_bytes < 1100000
+    if sys.version_info >= (3, 9):
+        assert 2900000 <= inner.alloc_peak_bytes < 3100000
+        assert 3900000 <= outer.alloc_peak_bytes < 4200000
+    else:
+        assert 'alloc_peak_bytes' not in inner.odict
+    assert ignored._odict is None
+    site, size, count = outer.alloc_top[0]
+    assert site.startswith(__file__) and size >= 1000000
+    assert len(inner.alloc_top) == 3
+    del kept
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="/proc is linux-only")
+def test_rss_collector():
+    """ The peak RSS of native allocations is credited to all running phases; the thread stops with the phases """
+    np = pytest.importorskip('numpy')
+    collector = RssCollector(interval=0.005)
+    pi = Kompanion(collectors=[collector])
+    size = 50 * 1024 * 1024
+    with pi.add_new_phase('outer') as outer:
+        with pi.add_new_phase('inner') as inner:
+            arr = np.ones(size, dtype=np.uint8)
+            time.sleep(0.05)
+            del arr
+        assert collector._thread is not None
+
+    for phase in (outer, inner):
+        assert phase.rss_peak - phase.rss_start > size * 0.9
+        assert phase.rss_peak - phase.rss_end > size * 0.9
+    collector._wakeup.set()
+    time.sleep(0.05)
+    assert collector._thread is None
+
+
+def _spin(seconds):
+    _busy(seconds)
+
+
+def test_stack_sampler_collector(tmpdir):
+    """ Stack samples are credited to the innermost phase, and exported in the collapsed stack format """
+    pi = Kompanion(collectors=[StackSamplerCollector(interval=0.002)])
+    with pi.add_new_phase('outer') as outer:
+        _busy(0.05)
+        with pi.add_new_phase('inner') as inner:
+            _spin(0.05)
+
+    # the sampler needs the GIL: a busy thread only releases it every `sys.getswitchinterval()`
+    assert outer.nb_stack_samples >= 2 and inner.nb_stack_samples >= 2
+    module = __name__
+    # a few samples may be taken while kopylog starts or stops the inner phase
+    outer_samples = {s: n for s, n in outer.stack_samples.items() if 'kopylog.main:' not in s}
+    inner_samples = {s: n for s, n in inner.stack_samples.items() if 'kopylog.main:' not in s}
+    assert sum(outer_samples.values()) >= outer.nb_stack_samples - 3
+    assert sum(inner_samples.values()) >= inner.nb_stack_samples - 3
+    assert all(s.endswith('%s:_busy' % module) for s in outer_samples)
+    assert all(s.endswith('%s:_spin;%s:_busy' % (module, module)) for s in inner_samples)
+    assert sum(collapsed_stacks(outer).values()) == outer.nb_stack_samples + inner.nb_stack_samples
+    assert collapsed_stacks(outer, inclusive=False) == outer.stack_samples
+
+    paths = write_collapsed_stacks(pi.phases.values(), str(tmpdir))
+    assert [os.path.basename(p) for p in paths] == ['outer.collapsed', 'inner.collapsed']
+    with open(paths[1]) as f:
+        lines = f.read().splitlines()
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == inner.nb_stack_samples
+
+
+def test_stack_sampler_cross_thread_stop():
+    """ A phase started in one thread can be stopped in another one, and the sampler thread then exits """
+    sampler = StackSamplerCollector(interval=0.002)
+    pi = Kompanion(collectors=[sampler])
+    p = pi.add_new_phase('started_here')
+    t = Thread(target=p.stop)
+    t.start()
+    t.join()
+    assert p.nb_stack_samples >= 0
+    assert not sampler._running
+    deadline = time.perf_counter() + 1
+    while sampler._thread is not None and time.perf_counter() < deadline:
+        time.sleep(0.005)
+    assert sampler._thread is None
+
+
+def test_collectors_restarted_phase():
+    """ Starting a running phase again completes its pending readings, so that the collectors do not track them """
+    was_tracing = tracemalloc.is_tracing()
+    tracer, sampler = TracemallocCollector(), StackSamplerCollector(interval=0.002)
+    pi = Kompanion(collectors=[tracer, sampler])
+    phase = pi.add_new_phase('restarted')
+    phase.start(force=True)
+    assert len(tracer._running) == 1 and len(sampler._running[phase._collected[1][1].thread_id]) == 1
+    phase.stop()
+    assert not tracer._running and not sampler._running
+    assert tracemalloc.is_tracing() == was_tracing
+    assert phase.nb_stack_samples >= 0
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="/proc and fork are linux-only")
+def test_proc_collectors_after_fork():
+    """ In a forked child process, the collectors read the /proc files of the child, not the ones of the parent """
+    collectors = [RssCollector(), IOCollector()]
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            collectors[0].rss()
+            collectors[1].start(None)
+            own = all(os.readlink('/proc/self/fd/%s' % c._file._fd).startswith('/proc/%s/' % os.getpid())
+                      for c in collectors)
+            os.write(w, b'1' if own else b'0')
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(r, 1) == b'1'
+    os.close(r)
+    os.close(w)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="/proc and fork are linux-only")
+def test_rss_collector_after_fork():
+    """ In a forked child process, the RSS collector starts its own sampling thread """
+    collector = RssCollector(interval=0.005)
+    pi = Kompanion(collectors=[collector])
+    r, w = os.pipe()
+    with pi.add_new_phase('parent') as parent:
+        assert collector._thread is not None
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with pi.add_new_phase('child'):
+                    ok = collector._thread.is_alive() and len(collector._running) == 1
+                parent.stop()
+                os.write(w, b'1' if ok and parent.rss_peak >= parent.rss_start else b'0')
+            finally:
+                os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(r, 1) == b'1'
+    os.close(r)
+    os.close(w)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="fork is not available")
+def test_stack_sampler_after_fork():
+    """ In a forked child process, the stack sampler starts its own sampling thread """
+    sampler = StackSamplerCollector(interval=0.002)
+    pi = Kompanion(collectors=[sampler])
+    r, w = os.pipe()
+    with pi.add_new_phase('parent') as parent:
+        assert sampler._thread is not None
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with pi.add_new_phase('child') as child:
+                    ok = sampler._thread.is_alive() and len(sampler._running) == 1
+                    _busy(0.05)
+                parent.stop()
+                os.write(w, b'1' if ok and child.nb_stack_samples > 0 and not sampler._running else b'0')
+            finally:
+                os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(r, 1) == b'1'
+    os.close(r)
+    os.close(w)
@@ -0,0 +1,88 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import asyncio
+
+import pytest
+
+from kopylog import Kompanion, get_current_phase, phase
+
+
+def test_decorators():
+    """ Sync functions, coroutines and generators can be decorated, with optional size attributes """
+    pi = Kompanion()
+
+    @pi.phase("load", record_args_size=True, record_result_size=True)
+    def load(items, factor=1):
+        return [i * factor for i in items]
+
+    @pi.phase
+    async def fetch():
+        await asyncio.sleep(0)
+        return get_current_phase()
+
+    @pi.phase(record_result_size=True)
+    def gen(n):
+        for i in range(n):
+            assert get_current_phase().phase_id.endswith('gen')
+            yield i
+
+    with pi.add_new_phase('main') as main:
+        assert load([1, 2, 3], factor=2) == [2, 4, 6]
+        fetched = asyncio.run(fetch())
+        g = gen(3)
+        assert next(g) == 0
+        # between two items the caller phase is the current one
+        assert get_current_phase() is main
+        assert list(g) == [1, 2]
+
+    load_phase, fetch_phase, gen_phase = main.child_phases
+    assert load_phase.phase_id == 'load'
+    assert load_phase.items_size == 3 and load_phase.result_size == 3
+    assert not hasattr(load_phase, 'factor_size')
+    assert fetch_phase.phase_id.endswith('fetch') and fetched is fetch_phase and fetch_phase.is_stopped()
+    assert gen_phase.result_size == 3 and gen_phase.is_stopped()
+    assert get_current_phase() is None
+
+
+def test_decorator_current_kompanion():
+    """ The module-level decorator records in the Kompanion of the current phase, and exceptions stop the phase """
+    @phase("fail")
+    def fail():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        fail()
+
+    pi = Kompanion()
+    with pi.add_new_phase('main'):
+        with pytest.raises(ValueError):
+            fail()
+    assert list(pi.phases.keys()) == ['main', 'fail']
+    assert pi.phases['fail'].is_stopped()
+
+
+def test_generator_closed_elsewhere():
+    """ Closing a decorated generator does not restore a stale current phase, standalone phases are never current """
+    pi = Kompanion()
+
+    @pi.phase
+    def gen():
+        yield 1
+        yield 2
+
+    @phase("standalone")
+    def standalone_gen():
+        yield get_current_phase()
+
+    before = get_current_phase()
+    with pi.add_new_phase('first'):
+        g = gen()
+        assert next(g) == 1
+    with pi.add_new_phase('second') as second:
+        g.close()
+        assert get_current_phase() is second
+    assert get_current_phase() is before
+    # outside of any phase, the decorated generator records a standalone phase
+    assert list(standalone_gen()) == [before]
+    assert get_current_phase() is before
@@ -0,0 +1,101 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+from datetime import timedelta
+
+import pytest
+
+from kopylog import Kompanion
+
+
+def _create_kompanion():
+    pi = Kompanion()
+    with pi.add_new_phase('first') as phase:
+        phase.hello = 'world'
+        phase.basic_nb = 2.0
+    with pi.add_new_phase('second') as phase:
+        phase.yodeling = True
+    not_started = pi.add_new_phase('third', start=False)
+    not_started.foo = 'bar'
+    return pi
+
+
+def _assert_same_phases(pi, restored):
+    assert restored.phases.keys() == pi.phases.keys()
+    for phase in pi.phases:
+        other = restored.phases[phase.phase_id]
+        assert dict(other.odict) == dict(phase.odict)
+        assert other.is_started() == phase.is_started()
+        if phase.is_stopped():
+            # datetimes have a microsecond resolution: the start time and the duration are restored exactly
+            assert other.start_time == phase.start_time
+            assert other.elapsed_ns == phase.elapsed_ns
+            assert abs(other.end_time - phase.end_time) <= timedelta(microseconds=1)
+
+
+def test_to_columns():
+    """ Stacked and pivoted dict-of-lists exports """
+    pi = _create_kompanion()
+    first = pi.phases['first']
+
+    stacked = pi.to_columns()
+    assert list(stacked) == ['phase_id', 'property', 'value']
+    assert list(zip(stacked['phase_id'], stacked['property']))[:5] == [
+        ('first', 'start_time'), ('first', 'end_time'), ('first', 'elapsed_seconds'), ('first', 'hello'),
+        ('first', 'basic_nb')]
+    assert stacked['value'][:5] == [first.start_time, first.end_time, first.elapsed_seconds, 'world', 2.0]
+
+    pivoted = pi.to_columns(pivot=True)
+    assert list(pivoted) == ['phase_id', 'start_time', 'end_time', 'elapsed_seconds', 'hello', 'basic_nb',
+                             'yodeling', 'foo']
+    assert pivoted['phase_id'] == ['first', 'second', 'third']
+    assert pivoted['hello'] == ['world', None, None]
+    assert pivoted['start_time'][2] is None
+
+    for pivot in (False, True):
+        _assert_same_phases(pi, Kompanion.from_columns(pi.to_columns(pivot=pivot)))
+
+
+@pytest.mark.parametrize('pivot', [False, True], ids="pivot={}".format)
+def test_to_df(pivot):
+    """ pandas export and import """
+    pd = pytest.importorskip('pandas')
+    pi = _create_kompanion()
+    df = pi.to_df(pivot=pivot)
+    assert isinstance(df, pd.DataFrame)
+    if pivot:
+        assert len(df) == 3
+    _assert_same_phases(pi, Kompanion.from_df(df))
+
+
+@pytest.mark.parametrize('pivot', [False, True], ids="pivot={}".format)
+def test_to_records(pivot):
+    """ numpy structured array export and import """
+    np = pytest.importorskip('numpy')
+    pi = _create_kompanion()
+    records = pi.to_records(pivot=pivot)
+    assert isinstance(records, np.ndarray)
+    if pivot:
+        assert records.dtype['elapsed_seconds'] == object
+        assert records.dtype['start_time'] == object
+    _assert_same_phases(pi, Kompanion.from_records(records))
+
+
+@pytest.mark.parametrize('pivot', [False, True], ids="pivot={}".format)
+def test_array_and_nan_attributes(pivot):
+    """ Array attributes and genuine NaN values survive the round trip, missing attributes are not created """
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('pandas')
+    pi = Kompanion()
+    with pi.add_new_phase('arr') as phase:
+        phase.values = np.arange(3)
+        phase.score = float('nan')
+    with pi.add_new_phase('empty'):
+        pass
+
+    for restored in (Kompanion.from_columns(pi.to_columns(pivot=pivot)), Kompanion.from_df(pi.to_df(pivot=pivot)),
+                     Kompanion.from_records(pi.to_records(pivot=pivot))):
+        arr = restored.phases['arr']
+        assert (arr.values == np.arange(3)).all()
+        assert arr.score != arr.score
+        assert restored.phases['empty']._odict is None
@@ -2,6 +2,8 @@
 #
 #  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
 
+import pytest
+
 from kopylog import Kompanion, PhaseInfo
 
 
@@ -109,3 +111,193 @@ def test_dump_phase_info_containing_dataframe():
         phase.df = pd.DataFrame()
         # this was the bug
         str(phase)
+
+
+def test_phase_timings():
+    """ Timings are measured with a monotonic counter and converted to datetimes using the Kompanion anchor """
+    pi = Kompanion()
+    with pi.add_new_phase('timed') as phase:
+        assert phase.is_started() and not phase.is_stopped()
+        assert not hasattr(phase, 'end_time')
+        assert not hasattr(phase, 'elapsed_seconds')
+
+    assert phase.is_stopped()
+    assert phase._anchor is pi._anchor
+    assert phase.elapsed_ns >= 0
+    assert phase.elapsed_seconds == phase.elapsed_ns / 1e9
+    assert pi._anchor.wall_time <= phase.start_time <= phase.end_time
+
+    # timings are not part of the user attributes
+    assert str(phase) == "{}"
+
+    # a phase that was not started has no timings
+    not_started = PhaseInfo('not_started', start=False)
+    assert not not_started.is_started()
+    assert not hasattr(not_started, 'start_time')
+
+    # and can not be stopped
+    from kopylog.main import InvalidStopCommandError
+    for force in (False, True):
+        with pytest.raises(InvalidStopCommandError, match="not started"):
+            not_started.stop(force=force)
+    assert not not_started.is_stopped()
+
+
+def test_lazy_attributes():
+    """ The user attributes dict is only created when the first attribute is set, `odict` is always a mapping """
+    phase = PhaseInfo('lazy', start=False)
+    assert phase._odict is None
+    assert dict(phase.odict) == {} and phase.odict.get('foo', 1) == 1
+    with pytest.raises(TypeError):
+        phase.odict['foo'] = 1
+    assert not hasattr(phase, 'foo')
+    with pytest.raises(AttributeError):
+        del phase.foo
+
+    phase.foo = 1
+    phase.bar = 'a'
+    assert list(phase.odict.items()) == [('foo', 1), ('bar', 'a')]
+    del phase.foo
+    assert not hasattr(phase, 'foo') and phase.bar == 'a'
+
+    assert PhaseInfo('init', start=False, initial_dict={'a': 1}).a == 1
+    assert PhaseInfo('init', start=False, b=2).b == 2
+
+
+def test_disabled_kompanion():
+    """ A disabled Kompanion returns the shared null phase and records nothing """
+    from kopylog import NULL_PHASE, set_enabled, is_enabled
+
+    pi = Kompanion(enabled=False)
+    with pi.add_new_phase('first') as phase:
+        phase.useless1 = 'hello'
+        phase.start()
+        phase.stop()
+
+    assert phase is NULL_PHASE
+    assert not phase.is_started()
+    assert not hasattr(phase, 'useless1')
+    assert len(pi.phases) == 0
+
+    pi.add_existing_phase(PhaseInfo('second'))
+    assert len(pi.phases) == 0
+
+    # global switch
+    assert is_enabled()
+    pi = Kompanion()
+    set_enabled(False)
+    try:
+        assert pi.add_new_phase('first') is NULL_PHASE
+        assert Kompanion(enabled=True).add_new_phase('first') is not NULL_PHASE
+    finally:
+        set_enabled(True)
+    assert pi.add_new_phase('first') is not NULL_PHASE
+
+
+def test_phase_log_messages(caplog):
+    """ Start/stop messages use the Kompanion templates and are only formatted when INFO is enabled """
+    import logging
+    logger = logging.getLogger('kopylog.tests.phases')
+
+    pi = Kompanion(start_msg="start %(phase_id)s", stop_msg="stop %(phase_id)s")
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        with pi.add_new_phase('first', logger=logger):
+            pass
+    assert [r.getMessage() for r in caplog.records] == ["start first", "stop first"]
+
+    # the message arguments are not even built when INFO is disabled
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger=logger.name):
+        with pi.add_new_phase('second', logger=logger):
+            pass
+    assert caplog.records == []
+
+
+def test_nested_phases():
+    """ Phases created inside a running phase become its children, with inclusive and exclusive timings """
+    from kopylog import get_current_phase
+
+    # phases of other Kompanions left running by previous tests may be current, they are not adopted
+    before = get_current_phase()
+    pi = Kompanion()
+    with pi.add_new_phase('outer') as outer:
+        assert get_current_phase() is outer
+        with pi.add_new_phase('inner1') as inner1:
+            assert get_current_phase() is inner1
+            with pi.add_new_phase('deepest') as deepest:
+                pass
+        assert get_current_phase() is outer
+        with pi.add_new_phase('inner2') as inner2:
+            pass
+    assert get_current_phase() is before
+
+    with pi.add_new_phase('other') as other:
+        pass
+
+    assert outer.parent_phase is None
+    assert outer.child_phases == (inner1, inner2)
+    assert inner1.child_phases == (deepest,)
+    assert deepest.parent_phase is inner1
+    assert pi.root_phases() == [outer, other]
+    assert [(d, p.phase_id) for d, p in pi.iter_tree()] == [(0, 'outer'), (1, 'inner1'), (2, 'deepest'),
+                                                            (1, 'inner2'), (0, 'other')]
+
+    assert outer.inclusive_seconds == outer.elapsed_seconds
+    children_ns = inner1.elapsed_ns + inner2.elapsed_ns
+    assert abs(outer.exclusive_seconds - (outer.elapsed_ns - children_ns) / 1e9) < 1e-12
+    assert deepest.exclusive_seconds == deepest.elapsed_seconds
+    assert pi.format_tree().splitlines()[2].startswith("    deepest: ")
+
+    # stopping phases out of order gives the current phase back to the innermost phase still running
+    a = pi.add_new_phase('a')
+    b = pi.add_new_phase('b')
+    c = pi.add_new_phase('c')
+    b.stop()
+    assert get_current_phase() is c
+    c.stop()
+    assert get_current_phase() is a
+    a.stop()
+    assert get_current_phase() is before
+
+
+def test_nested_phases_several_kompanions():
+    """ Phases are only adopted by a running phase of the same Kompanion, and standalone phases are never current """
+    from kopylog import get_current_phase
+
+    before = get_current_phase()
+    orphan = PhaseInfo('orphan')
+    assert get_current_phase() is before
+
+    k1, k2 = Kompanion(), Kompanion()
+    with k1.add_new_phase('outer') as outer:
+        with k2.add_new_phase('other') as other:
+            inner = k1.add_new_phase('inner')
+            inner.stop()
+    orphan.stop()
+
+    assert other.parent_phase is None
+    assert k2.root_phases() == [other]
+    assert inner.parent_phase is outer
+    assert k1.root_phases() == [outer]
+
+
+def test_concurrent_kompanion():
+    """ Phases recorded by several threads are merged in start order and tagged with their thread id """
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import get_ident
+
+    pi = Kompanion(concurrent=True)
+
+    def work(i):
+        with pi.add_new_phase('work_%s' % i):
+            pass
+        return get_ident()
+
+    with ThreadPoolExecutor(4) as executor:
+        thread_ids = list(executor.map(work, range(200)))
+
+    phases = pi.phases.values()
+    assert len(phases) == 200
+    assert [p._start_ns for p in phases] == sorted(p._start_ns for p in phases)
+    for i, thread_id in enumerate(thread_ids):
+        assert pi.phases['work_%s' % i].thread_id == thread_id
@@ -0,0 +1,147 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from kopylog import Kompanion, PhaseInfo
+from kopylog.utils_tables import TypedTable, ConcurrentTypedTable
+
+
+def test_pickle_phase():
+    """ Phases and tables can be pickled, with their timings, attributes and children """
+    pi = Kompanion()
+    with pi.add_new_phase('outer') as outer:
+        outer.foo = 'bar'
+        with pi.add_new_phase('inner') as inner:
+            inner.nb = 2
+
+    restored = pickle.loads(pickle.dumps(outer))
+    assert isinstance(restored, PhaseInfo)
+    assert restored.phase_id == 'outer'
+    assert restored.foo == 'bar'
+    assert restored.start_time == outer.start_time
+    assert restored.elapsed_ns == outer.elapsed_ns
+    restored_inner, = restored.child_phases
+    assert restored_inner.parent_phase is restored
+    assert restored_inner.nb == 2
+    assert restored_inner._anchor is restored._anchor
+
+    for table in (pi.phases, ConcurrentTypedTable(PhaseInfo, 'phase_id', sort_key=id)):
+        restored_table = pickle.loads(pickle.dumps(table))
+        assert type(restored_table) is type(table)
+        assert restored_table.keys() == table.keys()
+
+
+def _work(x, kompanion):
+    with kompanion.add_new_phase('remote_%s' % x) as phase:
+        phase.x = x
+        with kompanion.add_new_phase('remote_child_%s' % x):
+            pass
+    return x * 2
+
+
+def test_process_pool_phases():
+    """ Phases recorded in worker processes are merged under the submitting phase """
+    pi = Kompanion()
+    with ProcessPoolExecutor(2) as executor:
+        with pi.add_new_phase('submit') as submitting:
+            futures = [pi.submit(executor, _work, i) for i in range(3)]
+            results = [f.result() for f in futures]
+
+    assert results == [0, 2, 4]
+    assert len(submitting.child_phases) == 3
+    for i in range(3):
+        remote = pi.phases['remote_%s' % i]
+        assert remote.x == i
+        assert remote.parent_phase is submitting
+        assert remote.is_stopped()
+        assert pi.phases['remote_child_%s' % i].parent_phase is remote
+    assert pi.root_phases() == [submitting]
+
+
+def test_phases_merged_by_submitting_thread():
+    """ The phases of a completed call are merged by the submitting thread, not by the executor thread """
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from threading import Event, get_ident
+
+    def _wait_and_work(event, x, kompanion):
+        # the call completes after submit() returned, so that the done callback runs in the executor thread
+        event.wait()
+        return _work(x, kompanion)
+
+    pi = Kompanion(concurrent=True)
+    event = Event()
+    with ThreadPoolExecutor(1) as executor:
+        with pi.add_new_phase('submit') as submitting:
+            future = pi.submit(executor, _wait_and_work, event, 1)
+            event.set()
+            wait([future])
+            # the executor thread did not modify the Kompanion
+            assert 'remote_1' not in pi.phases
+            assert submitting.child_phases == ()
+            assert future.result() == 2
+
+    remote = pi.phases['remote_1']
+    assert remote.parent_phase is submitting
+    assert remote.thread_id == get_ident()
+    assert pi.phases['remote_child_1'].parent_phase is remote
+
+
+def test_cancel_submitted_call():
+    """ Cancelling the future cancels the call submitted to the executor, unless it already runs """
+    from concurrent.futures import CancelledError, ThreadPoolExecutor
+    from threading import Event
+
+    def _wait(event, kompanion):
+        event.wait()
+
+    pi = Kompanion()
+    event = Event()
+    with ThreadPoolExecutor(1) as executor:
+        running = pi.submit(executor, _wait, event)
+        pending = pi.submit(executor, _work, 1)
+        assert pending.cancel()
+        assert pending.cancelled()
+        assert not running.cancel()
+        event.set()
+        assert running.result() is None
+        with pytest.raises(CancelledError):
+            pending.result()
+    assert 'remote_1' not in pi.phases
+
+
+def test_phases_of_exited_submitting_thread():
+    """ The phases of calls submitted from a thread that exited without reading their result are merged later """
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from threading import Event, Thread
+
+    def _wait_and_work(event, x, kompanion):
+        event.wait()
+        return _work(x, kompanion)
+
+    pi = Kompanion(concurrent=True)
+    events = Event(), Event()
+    futures = []
+
+    def _submit():
+        # the first call completes before this thread exits, the second one after
+        futures.append(pi.submit(executor, _wait_and_work, events[0], 1))
+        events[0].set()
+        wait(futures)
+        futures.append(pi.submit(executor, _wait_and_work, events[1], 2))
+
+    with ThreadPoolExecutor(1) as executor:
+        thread = Thread(target=_submit)
+        thread.start()
+        thread.join()
+        events[1].set()
+        wait(futures)
+        assert 'remote_1' not in pi.phases
+
+    assert pi._pending_merges
+    # any thread merges them
+    assert {p.phase_id for p in pi.root_phases()} == {'remote_1', 'remote_2'}
+    assert not pi._pending_merges
@@ -0,0 +1,62 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from kopylog import Kompanion
+from kopylog.query import ArchiveIndex
+from kopylog.utils_clock import WallClockAnchor
+
+
+def _save_run(path, run_id, day, train_seconds):
+    """ Saves a run with a 'train' phase of the given duration, started on the given day of 2020 """
+    anchor = WallClockAnchor(datetime(2020, 1, day), 0)
+    pi = Kompanion()
+    train = pi.add_new_phase('train', start=False)
+    pi.add_new_phase('load', start=False)
+    for phase in pi.phases.values():
+        object.__setattr__(phase, '_anchor', anchor)
+    object.__setattr__(train, '_start_ns', 0)
+    object.__setattr__(train, '_end_ns', int(train_seconds * 1e9))
+    train.accuracy = day / 100
+    pi.save(path, metadata={'run_id': run_id})
+
+
+def test_archive_index(tmpdir):
+    """ Queries by phase id, run id, time range and duration, and incremental updates """
+    paths = []
+    for day, seconds in ((1, 10), (5, 40), (9, 50)):
+        path = str(tmpdir.join('run%s.kparch' % day))
+        _save_run(path, 'run%s' % day, day, seconds)
+        paths.append(path)
+
+    index_dir = str(tmpdir.join('index'))
+    index = ArchiveIndex.build(index_dir, paths[:2])
+    assert len(index) == 4
+    assert sorted(index.run_ids()) == ['run1', 'run5']
+
+    index = ArchiveIndex.build(index_dir, paths)
+    assert len(index) == 6
+
+    cols = index.query('train', start=datetime(2020, 1, 3), min_seconds=30, attributes=['accuracy', 'missing'])
+    assert cols['run_id'] == ['run5', 'run9']
+    assert cols['phase_id'] == ['train', 'train']
+    assert cols['start_time'].tolist() == [datetime(2020, 1, 5), datetime(2020, 1, 9)]
+    assert cols['elapsed_seconds'].tolist() == [40., 50.]
+    assert cols['accuracy'] == [0.05, 0.09]
+    assert cols['missing'] == [None, None]
+
+    cols = index.query(run_id='run1')
+    assert cols['phase_id'] == ['load', 'train']
+    assert np.isnan(cols['elapsed_seconds'][0])
+
+    assert index.query(end=datetime(2020, 1, 1), max_seconds=100)['run_id'] == []
+    assert index.query('unknown')['run_id'] == []
+
+    # removed archives are removed from the index
+    os.remove(paths[0])
+    index = ArchiveIndex.build(index_dir, paths[1:])
+    assert index.query('train')['run_id'] == ['run5', 'run9']
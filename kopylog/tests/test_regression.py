@@ -0,0 +1,58 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import numpy as np
+
+from kopylog import Kompanion
+from kopylog.regression import bootstrap_medians, compare_runs, mann_whitney
+
+
+def _run(durations):
+    """ A run with stopped phases of the given durations in seconds """
+    pi = Kompanion()
+    for phase_id, seconds in durations.items():
+        phase = pi.add_new_phase(phase_id, start=False)
+        object.__setattr__(phase, '_start_ns', 0)
+        object.__setattr__(phase, '_end_ns', int(seconds * 1e9))
+    return pi
+
+
+def test_compare_runs():
+    """ A slower phase is detected as a regression and ranked first; phases missing from some runs are handled """
+    rng = np.random.default_rng(0)
+    baseline = [_run(dict(load=rng.normal(1, 0.05), train=rng.normal(10, 0.5))) for _ in range(30)]
+    candidate = [_run(dict(load=rng.normal(1, 0.05), train=rng.normal(12, 0.5), new=1.)) for _ in range(30)]
+
+    table = compare_runs(baseline, candidate, seed=0)
+    assert table['phase_id'] == ['train', 'load', 'new']
+    assert table['regression'].tolist() == [True, False, False]
+    assert 1.1 < table['ratio_low'][0] < table['ratio'][0] < table['ratio_high'][0] < 1.3
+    assert table['p_value'][0] < 1e-6
+    assert table['n_baseline'].tolist() == [30, 30, 0]
+    assert np.isnan(table['ratio'][2]) and np.isnan(table['p_value'][2])
+
+
+def test_mann_whitney():
+    """ The U statistic, with ties and missing values, is the one of the pairwise definition """
+    rng = np.random.default_rng(1)
+    baseline = rng.integers(0, 5, (12, 3)).astype(float)
+    candidate = rng.integers(1, 6, (9, 3)).astype(float)
+    baseline[2, 1] = np.nan
+    u, p = mann_whitney(baseline, candidate)
+    for j in range(3):
+        b = baseline[:, j][~np.isnan(baseline[:, j])]
+        expected = ((b[:, None] > candidate[:, j]) + 0.5 * (b[:, None] == candidate[:, j])).sum()
+        assert u[j] == expected
+    assert ((0 < p) & (p <= 1)).all()
+
+
+def test_bootstrap_medians():
+    """ The medians have the distribution of the medians of explicit resamplings, for odd and even sizes """
+    rng = np.random.default_rng(2)
+    for n in (5, 6):
+        x = np.arange(1., n + 1)[:, None]
+        drawn = bootstrap_medians(x, 100000, rng)[:, 0]
+        resampled = np.median(x[rng.integers(0, n, (100000, n)), 0], axis=1)
+        values = np.unique(np.concatenate([drawn, resampled]))
+        freqs = [(drawn == v).mean() - (resampled == v).mean() for v in values]
+        assert np.abs(freqs).max() < 0.01
@@ -0,0 +1,90 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from kopylog import Kompanion
+from kopylog.utils_render import render, register_summarizer
+
+
+def test_render_small_values():
+    """ Small values are rendered exactly as their repr """
+    point = namedtuple('Point', 'x y')
+    for value in ({'hello': 'world', 'basic_nb': 2.0}, [1, (2,), {3}, frozenset(), ()], point(1, 2), None, b'ab',
+                  np.arange(3)):
+        assert render(value) == repr(value)
+
+
+def test_render_budget():
+    """ Large values are summarized or truncated, within the budget """
+    pi = Kompanion()
+    with pi.add_new_phase('big') as phase:
+        phase.df = pd.DataFrame({'a': np.arange(10 ** 6)})
+        phase.arr = np.zeros((1000, 3))
+        phase.items = list(range(10 ** 6))
+        phase.text = 'x' * 10 ** 6
+
+    s = str(phase)
+    assert s.startswith("{'df': DataFrame(shape=(1000000, 1), columns=['a']), "
+                        "'arr': ndarray(shape=(1000, 3), dtype=float64), 'items': [0, 1, 2")
+    assert len(s) <= 2000
+    assert len(render(phase.odict, max_chars=100)) <= 100
+
+    table = str(pi.phases)
+    assert table.startswith("TypedTable - [PhaseInfo:\n{'df': DataFrame") and len(table) < 2100
+
+
+def test_register_summarizer():
+    """ Custom summarizers can be registered for a type and its subclasses """
+    class Model(object):
+        def __repr__(self):
+            raise AssertionError("should not be called")
+
+    class SubModel(Model):
+        pass
+
+    register_summarizer(Model, lambda value, out: out.write("<%s>" % type(value).__name__))
+    assert render([Model(), SubModel()]) == "[<Model>, <SubModel>]"
+
+
+def test_render_large_repr():
+    """ Values with more items or bytes than the budget are summarized, without building their repr """
+    from array import array
+
+    class Huge(object):
+        def __len__(self):
+            return 10 ** 9
+
+        def __repr__(self):
+            raise AssertionError("should not be called")
+
+    class Buffer(object):
+        nbytes = 10 ** 9
+
+        def __repr__(self):
+            raise AssertionError("should not be called")
+
+    assert render([Huge(), Buffer()]) == "[Huge(len=1000000000), Buffer(nbytes=1000000000)]"
+    assert render(array('b', range(100)), max_chars=50) == "array(len=100)"
+    assert render(array('b', range(3))) == repr(array('b', range(3)))
+
+
+def test_render_cycles():
+    """ Containers containing themselves are rendered with '...', as with repr """
+    lst = [1]
+    lst.append(lst)
+    dct = {}
+    dct['a'] = dct
+    assert render(lst) == "[1, ...]"
+    assert render(dct) == "{'a': ...}"
+    # a value appearing twice without cycle is rendered twice
+    shared = [1]
+    assert render([shared, shared]) == "[[1], [1]]"
+
+    pi = Kompanion()
+    phase = pi.add_new_phase('cycle', start=False)
+    phase.itself = phase
+    assert render(phase) == "PhaseInfo:\n{'itself': ...}"
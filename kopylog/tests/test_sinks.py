@@ -0,0 +1,101 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import json
+
+from kopylog import Kompanion
+from kopylog.sinks import JsonLinesSink
+
+
+def test_jsonlines_sink(tmpdir):
+    """ Stopped phases are written as JSON Lines records, and optionally dropped from memory """
+    path = str(tmpdir.join('phases.jsonl'))
+
+    with JsonLinesSink(path, batch_size=2, flush_interval=0.01) as sink:
+        pi = Kompanion(sink=sink, keep_phases=False)
+        with pi.add_new_phase('outer') as outer:
+            outer.foo = 'bar'
+            with pi.add_new_phase('inner') as inner:
+                inner.obj = object()
+            assert pi.phases.keys() == ['outer']
+        assert len(pi.phases) == 0
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+
+    assert [r['phase_id'] for r in records] == ['inner', 'outer']
+    assert records[0]['parent_phase_id'] == 'outer'
+    assert records[0]['obj'].startswith('<object object')
+    assert records[1]['foo'] == 'bar'
+    assert records[1]['elapsed_seconds'] == outer.elapsed_seconds
+    assert records[1]['start_time'] == outer.start_time.isoformat()
+
+
+def test_discard_concurrent():
+    """ Phases can be dropped from a concurrent Kompanion before their buffer is merged """
+    pi = Kompanion(concurrent=True, keep_phases=False)
+    with pi.add_new_phase('dropped'):
+        pass
+    kept = pi.add_new_phase('kept')
+    assert pi.phases.keys() == ['kept']
+    kept.stop()
+    assert len(pi.phases) == 0
+
+
+def test_jsonlines_sink_errors(tmpdir):
+    """ A record that can not be serialized is reported, and the other records are still written """
+    path = str(tmpdir.join('phases.jsonl'))
+    errors = []
+
+    def fail(obj):
+        raise TypeError("not serializable")
+
+    with JsonLinesSink(path, flush_interval=0.01, default=fail,
+                       on_error=lambda phase_id, e: errors.append(phase_id)) as sink:
+        pi = Kompanion(sink=sink)
+        with pi.add_new_phase('before'):
+            pass
+        with pi.add_new_phase('bad') as bad:
+            bad.obj = object()
+        with pi.add_new_phase('after'):
+            pass
+        sink.flush()
+        assert sink._thread.is_alive()
+
+    with open(path) as f:
+        assert [json.loads(line)['phase_id'] for line in f] == ['before', 'after']
+    assert errors == ['bad']
+    assert sink.nb_errors == 1
+
+
+def test_jsonlines_sink_io_errors():
+    """ A batch that can not be written is reported and dropped: the writer thread survives, and memory is bounded """
+    from io import StringIO
+
+    class FullDisk(StringIO):
+        full = True
+
+        def write(self, s):
+            if self.full:
+                raise OSError(28, "No space left on device")
+            return super(FullDisk, self).write(s)
+
+    f = FullDisk()
+    errors = []
+    sink = JsonLinesSink(f, batch_size=10 ** 6, flush_interval=10, max_pending=3,
+                         on_error=lambda phase_id, e: errors.append((phase_id, type(e))))
+    pi = Kompanion(sink=sink)
+    for i in range(5):
+        with pi.add_new_phase('phase_%s' % i):
+            pass
+    assert sink.nb_dropped == 2 and len(sink._pending) == 3
+
+    sink.flush()
+    assert errors == [(None, OSError)] and sink.nb_dropped == 5 and sink.nb_errors == 1
+    assert sink._thread.is_alive()
+
+    f.full = False
+    with pi.add_new_phase('after'):
+        pass
+    sink.close()
+    assert [json.loads(line)['phase_id'] for line in f.getvalue().splitlines()] == ['after']
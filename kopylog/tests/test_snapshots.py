@@ -0,0 +1,97 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import gc
+from threading import Thread
+
+import pytest
+
+from kopylog import Kompanion
+
+
+def test_snapshot():
+    """ Snapshots are read-only, and share the frozen phases that did not change """
+    pi = Kompanion()
+    with pi.add_new_phase('a') as a:
+        a.foo = 1
+    with pi.add_new_phase('b') as b:
+        b.bar = 2
+    running = pi.add_new_phase('c')
+
+    s1 = pi.snapshot()
+    assert s1.keys() == ['a', 'b', 'c'] and s1.nb_frozen == 3
+    assert s1['a'].foo == 1 and s1['a'].elapsed_ns == a.elapsed_ns
+    assert not s1['c'].is_stopped()
+    with pytest.raises(AttributeError):
+        s1['a'].foo = 2
+
+    # only the modified, running and new phases are copied again
+    b.bar = 3
+    running.stop()
+    with pi.add_new_phase('d'):
+        pass
+    s2 = pi.snapshot()
+    assert s2.nb_frozen == 3
+    assert s2['a'] is s1['a']
+    assert s2['b'].bar == 3 and s1['b'].bar == 2
+    assert s2['c'].is_stopped() and 'd' in s2 and 'd' not in s1
+
+    s3 = pi.snapshot()
+    assert s3.nb_frozen == 0
+    assert s3.to_columns(pivot=True)['bar'] == [None, 3, None, None]
+
+    # frozen phases do not keep the live phases alive
+    from kopylog.main import PhaseInfo
+    assert not any(isinstance(r, PhaseInfo) for f in s3 for r in gc.get_referents(f))
+
+
+def test_snapshot_concurrent():
+    """ Snapshots can be taken while other threads add phases and set attributes """
+    pi = Kompanion(concurrent=True)
+
+    def work(i):
+        for j in range(2000):
+            with pi.add_new_phase('%s-%s' % (i, j)) as p:
+                p.j = j
+
+    threads = [Thread(target=work, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    snapshots = []
+    while any(t.is_alive() for t in threads):
+        snapshots.append(pi.snapshot())
+    for t in threads:
+        t.join()
+
+    final = pi.snapshot()
+    assert len(final) == 8000
+    assert sum(s.nb_frozen for s in snapshots) + final.nb_frozen < 8000 + 4 * len(snapshots) + 1
+
+
+def test_snapshot_only_visits_changes(monkeypatch):
+    """ Once a snapshot was taken, the next ones only copy the changed phases, without checking the other ones """
+    from kopylog.snapshots import FrozenPhase
+    pi = Kompanion()
+    for i in range(1000):
+        with pi.add_new_phase('phase_%s' % i) as p:
+            p.i = i
+    first = pi.snapshot()
+
+    def fail(*args):
+        raise AssertionError("unchanged phases should not be checked")
+
+    monkeypatch.setattr(FrozenPhase, '_is_up_to_date', fail)
+    p.i = -1
+    pi.add_new_phase('new', start=False)
+    pi.phases.discard(pi.phases['phase_0'])
+    second = pi.snapshot()
+    assert second.nb_frozen == 2 and len(second) == 1000
+    assert second['phase_999'].i == -1 and first['phase_999'].i == 999
+    assert second['phase_1'] is first['phase_1'] and 'phase_0' not in second
+    assert pi.snapshot().nb_frozen == 0
+
+    # None cells of the pivoted layout are kept, as in Kompanion.to_df
+    pd = pytest.importorskip('pandas')
+    df = second.to_df(pivot=True)
+    assert df['i'].dtype == object and df['i'].iloc[-1] is None
+    pd.testing.assert_frame_equal(df, pi.to_df(pivot=True))
@@ -0,0 +1,136 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import gc
+import os
+import pickle
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from kopylog import Kompanion
+from kopylog import spill
+from kopylog.sinks import phase_to_record
+from kopylog.spill import SpillPolicy, SpillHandle
+
+
+def test_spill(tmpdir):
+    """ Large attribute values are spilled to disk and loaded back memory-mapped """
+    pi = Kompanion(spill=SpillPolicy(threshold_bytes=1000, directory=str(tmpdir)))
+    with pi.add_new_phase('phase') as phase:
+        phase.small = list(range(10))
+        phase.arr = np.arange(1000, dtype=np.float64)
+        phase.df = pd.DataFrame({'a': np.arange(1000), 'b': np.ones(1000)})
+
+    assert phase.odict['small'] == list(range(10))
+    assert isinstance(phase.odict['arr'], SpillHandle) and isinstance(phase.odict['df'], SpillHandle)
+    assert pi._spill.nb_spilled == 2
+    assert len(tmpdir.listdir()) == 2
+
+    arr = phase.arr
+    assert np.array_equal(arr, np.arange(1000, dtype=np.float64))
+    # the buffer is memory-mapped, and writable (copy-on-write)
+    assert not arr.flags.owndata
+    arr[0] = -1
+    assert phase.arr[0] == 0
+    pd.testing.assert_frame_equal(phase.df, pd.DataFrame({'a': np.arange(1000), 'b': np.ones(1000)}))
+    assert 'SpillHandle<DataFrame' in str(phase)
+
+    # the spill files are local: pickling sends the values
+    unpickled = pickle.loads(pickle.dumps(phase))
+    assert type(unpickled.odict['arr']) is np.ndarray and np.array_equal(unpickled.arr, phase.arr)
+
+    del arr
+    pi.delete_spill_files()
+    assert tmpdir.listdir() == []
+
+
+def test_spill_cleanup_on_gc():
+    """ The temporary spill directory is removed with the Kompanion """
+    pi = Kompanion(spill=SpillPolicy(threshold_bytes=1000))
+    with pi.add_new_phase('phase') as phase:
+        phase.arr = np.zeros(1000)
+    directory = os.path.dirname(phase.odict['arr'].path)
+    assert os.path.isdir(directory)
+    # phases reference their Kompanion: the cycle is collected by the garbage collector
+    del pi, phase
+    gc.collect()
+    assert not os.path.exists(directory)
+
+
+def test_spill_all_paths(tmpdir):
+    """ The policy applies to all the ways of setting attributes, and exports contain the values, not the handles """
+    from kopylog.main import PhaseInfo
+
+    policy = SpillPolicy(threshold_bytes=1000, directory=str(tmpdir))
+    pi = Kompanion(spill=policy)
+    big = np.arange(1000)
+    phase = PhaseInfo('init', start=False, initial_dict={'arr': big}, kompanion=pi)
+    assert type(phase.odict['arr']) is SpillHandle
+    pi.add_existing_phase(phase)
+
+    # phases restored from another process, from columns or from an archive
+    other = Kompanion()
+    with other.add_new_phase('other') as other_phase:
+        other_phase.arr = big
+    pi.merge_phases([pickle.loads(pickle.dumps(other_phase))])
+    restored = Kompanion.from_columns(other.to_columns(), spill=policy)
+    archived = BytesIO()
+    other.save(archived)
+    loaded = Kompanion.load(archived, spill=policy)
+    for p in (pi.phases['other'], restored.phases['other'], loaded.phases['other']):
+        assert type(p.odict['arr']) is SpillHandle and np.array_equal(p.arr, big)
+    # adding a phase applies the policy again, but does not spill the handles
+    assert pi._spill.nb_spilled == 2
+
+    # exports load the spilled values back
+    assert np.array_equal(pi.to_columns(pivot=True)['arr'][-1], big)
+    assert np.array_equal(phase_to_record(phase)['arr'], big)
+    archived = BytesIO()
+    pi.save(archived)
+    assert type(Kompanion.load(archived).phases['init'].odict['arr']) is np.ndarray
+
+
+def test_spill_in_band(tmpdir, monkeypatch):
+    """ Without pickle protocol 5 (python < 3.8), values are spilled in-band """
+    monkeypatch.setattr(spill, '_OUT_OF_BAND', False)
+    pi = Kompanion(spill=SpillPolicy(threshold_bytes=1000, directory=str(tmpdir)))
+    with pi.add_new_phase('phase') as phase:
+        phase.arr = np.arange(1000)
+    assert type(phase.odict['arr']) is SpillHandle
+    assert np.array_equal(phase.arr, np.arange(1000))
+
+
+def test_spill_errors(tmpdir):
+    """ A value that can not be pickled is kept in memory, and its partial file is deleted """
+    class Unpicklable(object):
+        nbytes = 10 ** 6
+
+        def __reduce__(self):
+            raise TypeError("not picklable")
+
+    pi = Kompanion(spill=SpillPolicy(threshold_bytes=1000, directory=str(tmpdir)))
+    value = Unpicklable()
+    with pi.add_new_phase('phase') as phase:
+        with pytest.warns(RuntimeWarning):
+            phase.value = value
+    assert phase.odict['value'] is value
+    assert pi._spill.nb_errors == 1 and pi._spill.nb_spilled == 0
+    assert tmpdir.listdir() == []
+
+
+def test_spill_files_freed(tmpdir):
+    """ A spill file is deleted when its attribute is set again, or when its phase is removed and freed """
+    pi = Kompanion(spill=SpillPolicy(threshold_bytes=1000, directory=str(tmpdir)), keep_phases=False)
+    with pi.add_new_phase('phase') as phase:
+        phase.arr = np.zeros(1000)
+        first = phase.odict['arr'].path
+        phase.arr = np.ones(1000)
+        assert not os.path.exists(first)
+        assert len(tmpdir.listdir()) == 1
+    # the phase is removed from the Kompanion when it stops
+    del phase
+    gc.collect()
+    assert tmpdir.listdir() == []
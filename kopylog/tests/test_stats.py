@@ -0,0 +1,100 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from kopylog import Kompanion, PhaseStats, NULL_PHASE, RateSampler
+
+
+def test_phase_stats():
+    """ Quantiles are estimated within the relative accuracy, and stats can be merged """
+    a, b = PhaseStats('a'), PhaseStats('a')
+    for i in range(1, 5001):
+        a.add(i)
+        b.add(i + 5000)
+    assert len(a.histogram.buckets) < 500
+
+    merged = PhaseStats.merged([a, b])
+    assert merged.count == 10000
+    assert merged.min == 1 and merged.max == 10000
+    assert merged.mean == pytest.approx(5000.5)
+    for q, expected in ((0.5, 5000), (0.95, 9500), (0.99, 9900)):
+        assert merged.quantile(q) == pytest.approx(expected, rel=0.01)
+    assert merged.to_dict()['p95'] == merged.p95
+
+
+def test_aggregate():
+    """ Repeated phase ids are aggregated, including from several threads """
+    pi = Kompanion(aggregate=True, concurrent=True)
+
+    def work(i):
+        with pi.add_new_phase('score_batch'):
+            pass
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(work, range(1000)))
+    with pi.add_new_phase('other'):
+        pass
+
+    stats = pi.get_stats()
+    assert stats['score_batch'].count == 1000
+    assert stats['other'].count == 1
+    assert stats['score_batch'].min <= stats['score_batch'].p50 <= stats['score_batch'].max
+    assert len(pi.phases) == 2
+
+    with pytest.raises(ValueError):
+        Kompanion().get_stats()
+
+
+def test_sampling():
+    """ Sampled phase ids are recorded one time in n, and statistics are scaled """
+    pi = Kompanion(aggregate=True, sampling={'step': 10})
+    for i in range(1000):
+        with pi.add_new_phase('step'):
+            pass
+        with pi.add_new_phase('other'):
+            pass
+
+    stats = pi.get_stats()
+    assert stats['step'].count == 1000 and stats['step'].nb_recorded == 100
+    assert stats['step'].sampling_rate == pytest.approx(0.1)
+    assert stats['other'].nb_recorded == 1000 and stats['other'].sampling_rate == 1
+    assert pi.phases['step'].sample_weight == 10
+
+    # sampling can be changed or removed
+    pi.set_sampling('step', None)
+    assert pi.add_new_phase('step', start=False) is not NULL_PHASE
+
+
+def test_rate_sampler():
+    """ The weights of a RateSampler always sum to the number of calls """
+    sampler = RateSampler(per_second=100, window=0.01)
+    weights = [sampler.sample() for _ in range(100000)]
+    assert sampler.n > 1
+    recorded = [w for w in weights if w]
+    assert len(recorded) < 100000
+    # the calls after the last recorded one are not counted yet
+    assert 0 <= 100000 - sum(recorded) < sampler.n
+
+
+def test_rate_sampler_rate_drop():
+    """ When the call rate drops, one of the first calls after the end of the window is recorded and adjusts n """
+    sampler = RateSampler(per_second=1000, window=0.05)
+    weights = []
+    while sampler.n < 100:
+        weights.append(sampler.sample())
+    time.sleep(0.06)
+    # far fewer than n calls after the end of the window: one of them is recorded
+    weights.extend(sampler.sample() for _ in range(16))
+    last = max(i for i, w in enumerate(weights) if w)
+    assert last >= len(weights) - 16
+    assert sum(weights) == last + 1
+    time.sleep(0.06)
+    # a few calls per second: the period is adjusted, then all of them are recorded
+    weights = [sampler.sample() for _ in range(16)]
+    assert any(weights)
+    assert sampler.n == 1
+    assert sampler.sample() == 1
@@ -0,0 +1,134 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  Copyright (c) Schneider Electric Industries, 2019. All right reserved.
+import time
+
+import pytest
+
+from kopylog import Kompanion, RetentionPolicy
+
+
+@pytest.mark.parametrize('concurrent', [False, True], ids="concurrent={}".format)
+def test_retention_max_entries(concurrent):
+    """ The oldest phases are evicted, passed to the callback and counted """
+    evicted = []
+    pi = Kompanion(concurrent=concurrent, retention=RetentionPolicy(max_entries=3, on_evict=evicted.append))
+    for i in range(5):
+        with pi.add_new_phase('phase_%s' % i):
+            pass
+
+    assert pi.phases.keys() == ['phase_2', 'phase_3', 'phase_4']
+    assert [p.phase_id for p in evicted] == ['phase_0', 'phase_1']
+    assert pi.phases.nb_evicted == 2
+
+    # an overwritten phase is moved to the end
+    with pi.add_new_phase('phase_2'):
+        pass
+    assert pi.phases.keys() == ['phase_3', 'phase_4', 'phase_2']
+
+
+def test_retention_max_age():
+    """ Phases older than max_age are evicted """
+    pi = Kompanion(retention=RetentionPolicy(max_age=0.05))
+    pi.add_new_phase('old', start=False)
+    time.sleep(0.1)
+    pi.add_new_phase('new', start=False)
+    assert pi.phases.keys() == ['new']
+
+    time.sleep(0.1)
+    pi.phases.enforce_retention()
+    assert len(pi.phases) == 0
+    assert pi.phases.nb_evicted == 2
+
+
+def test_retention_max_bytes():
+    """ Phases are evicted when the memory budget is exceeded """
+    from kopylog.utils_tables import approx_sizeof
+
+    big = Kompanion().add_new_phase('big', start=False)
+    big.data = b' ' * 20000
+    small_size = approx_sizeof(Kompanion().add_new_phase('phase_0', start=False))
+    budget = approx_sizeof(big) + 2 * small_size
+
+    pi = Kompanion(retention=RetentionPolicy(max_bytes=budget))
+    for i in range(5):
+        pi.add_new_phase('phase_%s' % i, start=False)
+    assert pi.phases.retained_bytes == 5 * small_size
+    assert pi.phases.nb_evicted == 0
+
+    pi.add_existing_phase(big)
+    assert pi.phases.keys() == ['phase_3', 'phase_4', 'big']
+    assert pi.phases.retained_bytes == budget
+    assert pi.phases.nb_evicted == 3
+    assert pi.phases.evicted_bytes == 3 * small_size
+
+    pi.phases.discard(big)
+    assert pi.phases.retained_bytes == 2 * small_size
+
+
+@pytest.mark.parametrize('concurrent', [False, True], ids="concurrent={}".format)
+def test_retention_max_bytes_attributes(concurrent):
+    """ The size of a phase is measured again when it stops, so that the attributes set while running count """
+    from kopylog.utils_tables import approx_sizeof
+
+    big = Kompanion().add_new_phase('big', start=False)
+    big.data = b' ' * 20000
+    # some room for the other attributes, such as thread_id
+    budget = 3 * approx_sizeof(big) + 1000
+
+    pi = Kompanion(concurrent=concurrent, retention=RetentionPolicy(max_bytes=budget))
+    for i in range(10):
+        with pi.add_new_phase('phase_%s' % i) as phase:
+            phase.data = b' ' * 20000
+    assert pi.phases.keys() == ['phase_7', 'phase_8', 'phase_9']
+    assert pi.phases.nb_evicted == 7
+    assert pi.phases.retained_bytes <= budget
+
+
+def test_concurrent_eviction_callback_reads_table():
+    """ The eviction callbacks of a concurrent table are called without holding its lock, so they can read it """
+    lengths = []
+    policy = RetentionPolicy(max_entries=2, on_evict=lambda p: lengths.append(len(pi.phases)))
+    pi = Kompanion(concurrent=True, retention=policy)
+    for i in range(4):
+        with pi.add_new_phase('phase_%s' % i):
+            pass
+    assert pi.phases.keys() == ['phase_2', 'phase_3']
+    assert lengths == [2, 2]
+
+
+def test_concurrent_retention_without_reads():
+    """ A concurrent table enforces its retention policy from append, even if it is never read """
+    evicted = []
+    pi = Kompanion(concurrent=True, retention=RetentionPolicy(max_entries=10, on_evict=evicted.append))
+    for i in range(10000):
+        with pi.add_new_phase('phase_%s' % i):
+            pass
+    # nb_evicted does not merge the buffers
+    assert pi.phases.nb_evicted == len(evicted) >= 10000 - 10 - pi.phases.buffer_size
+    assert all(len(buffer) < pi.phases.buffer_size for buffer in pi.phases._buffers)
+
+    # max_age is checked at each append
+    pi = Kompanion(concurrent=True, retention=RetentionPolicy(max_age=0.01))
+    pi.add_new_phase('old').stop()
+    time.sleep(0.02)
+    pi.add_new_phase('new').stop()
+    assert pi.phases.nb_evicted == 1
+
+
+@pytest.mark.parametrize('options', [dict(keep_phases=False), dict(retention=RetentionPolicy(max_entries=10)),
+                                     dict(aggregate=True), dict(concurrent=True, keep_phases=False),
+                                     dict(concurrent=True, retention=RetentionPolicy(max_entries=10))],
+                         ids=str)
+def test_removed_children_unlinked(options):
+    """ The phases removed from a bounded Kompanion are not kept alive by their parent, exclusive time is correct """
+    pi = Kompanion(**options)
+    children_ns = 0
+    with pi.add_new_phase('root') as root:
+        for i in range(5000):
+            with pi.add_new_phase('child') as child:
+                pass
+            children_ns += child.elapsed_ns
+        pi.phases.enforce_retention()
+        assert len(root.child_phases) <= 10
+    assert root.exclusive_seconds == (root.elapsed_ns - children_ns) / 1e9
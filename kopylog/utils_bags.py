@@ -10,6 +10,8 @@ else:
 
 from six import raise_from
 
+from kopylog.utils_render import render, register_summarizer, RenderOutput
+
 try:  # python 3.5+
     from typing import Iterable, Tuple, Any, Mapping
 except ImportError:
@@ -96,11 +98,23 @@ class OrderedMunch(object):
 
     # object base
     def __str__(self):
-        return dict.__str__(self.odict)
+        # budgeted: a huge value such as a DataFrame is only summarized, see `kopylog.utils_render`
+        return render(self.odict)
 
     def __repr__(self):
-        return "%s:\n%s" % (self.__class__.__name__, dict.__repr__(self.odict))
+        return "%s:\n%s" % (self.__class__.__name__, render(self.odict))
 
     def __hash__(self):
         """Make the type hashable with a fake hash: python object id"""
         return id(self)
+
+
+def _render_munch(munch,  # type: OrderedMunch
+                  out     # type: RenderOutput
+                  ):
+    """ Renders a munch nested in another value, as its repr, sharing the budget of the whole rendering """
+    out.write("%s:\n" % munch.__class__.__name__)
+    out.render(munch.odict)
+
+
+register_summarizer(OrderedMunch, _render_munch)
@@ -0,0 +1,76 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from time import perf_counter_ns
+
+
+_ONE_US = timedelta(microseconds=1)
+
+
+class WallClockAnchor(object):
+    """
+    A (wall-clock datetime, monotonic counter) pair captured at the same instant.
+
+    Durations are measured with the monotonic `perf_counter_ns` counter only, so they are not affected by NTP
+    adjustments and do not allocate any object. The anchor is used to convert counter values back to wall-clock
+    datetimes, only when they are needed.
+    """
+    __slots__ = 'wall_time', 'counter_ns'
+
+    def __init__(self,
+                 wall_time=None,   # type: datetime
+                 counter_ns=None   # type: int
+                 ):
+        """
+        Constructor. By default the anchor is captured now.
+
+        :param wall_time: an optional wall-clock datetime. Both `wall_time` and `counter_ns` should be provided
+            together, for example when restoring an anchor captured in another process.
+        :param counter_ns: the value of `perf_counter_ns()` at `wall_time`.
+        """
+        if wall_time is None:
+            counter_ns = perf_counter_ns()
+            wall_time = datetime.now()
+        self.wall_time = wall_time
+        self.counter_ns = counter_ns
+
+    def to_datetime(self,
+                    counter_ns  # type: int
+                    ):
+        # type: (...) -> datetime
+        """
+        Returns the wall-clock datetime corresponding to the given `perf_counter_ns()` value.
+
+        :param counter_ns:
+        :return:
+        """
+        return self.wall_time + timedelta(microseconds=(counter_ns - self.counter_ns) // 1000)
+
+    def to_counter_ns(self,
+                      dt  # type: datetime
+                      ):
+        # type: (...) -> int
+        """
+        Returns the `perf_counter_ns()` value corresponding to the given wall-clock datetime, with a microsecond
+        resolution. This is the inverse of `to_datetime`.
+
+        :param dt:
+        :return:
+        """
+        return self.counter_ns + ((dt - self.wall_time) // _ONE_US) * 1000
+
+    def __reduce__(self):
+        return WallClockAnchor, (self.wall_time, self.counter_ns)
+
+    def __repr__(self):
+        return "%s(wall_time=%r, counter_ns=%r)" % (type(self).__name__, self.wall_time, self.counter_ns)
+
+
+DEFAULT_ANCHOR = WallClockAnchor()
+""" The anchor used by phases that are not created by a Kompanion """
+
+
+_loop_clock = ContextVar('kopylog_loop_clock', default=None)
+""" The clock measuring the time the current asyncio task spends running on its event loop. See `kopylog.aio` """
@@ -0,0 +1,284 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+"""
+Budgeted rendering of values as strings, used by `OrderedMunch.__str__` and `TypedTable.__str__`.
+
+The rendering stops as soon as a maximum number of characters or a maximum duration is reached, so that printing a
+huge structure costs at most about its output budget. Values are rendered by summarizers, chosen according to their
+type: containers are rendered item by item, numpy arrays and pandas objects are summarized with their shape and dtype,
+and other values are rendered with `repr`, unless their length or `nbytes` shows that it would exceed the budget. New
+summarizers can be added with `register_summarizer`.
+"""
+from time import perf_counter
+
+try:  # python 3.5+
+    from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Type, Union
+except ImportError:
+    pass
+
+
+DEFAULT_MAX_CHARS = 2000
+""" The default maximum number of characters of a rendering """
+
+DEFAULT_MAX_SECONDS = 0.05
+""" The default maximum duration of a rendering, in seconds """
+
+_SMALL_ARRAY_SIZE = 8
+""" Arrays with at most this number of elements are rendered with `repr` """
+
+ELLIPSIS = '...'
+
+
+class RenderOutput(object):
+    """
+    The output of a rendering, with its remaining budget. Summarizers write to it with `write`, render nested values
+    with `render`, and should stop rendering items as soon as `is_exhausted()` is True. As with `reprlib`, a value
+    rendered again while it is being rendered, such as a list containing itself, is written as '...'.
+    """
+    __slots__ = 'parts', 'chars_left', 'deadline', 'rendering'
+
+    def __init__(self,
+                 max_chars,   # type: int
+                 max_seconds  # type: float
+                 ):
+        self.parts = []
+        self.chars_left = max_chars
+        self.deadline = perf_counter() + max_seconds
+        self.rendering = set()  # the ids of the values being rendered by a summarizer
+
+    def write(self,
+              s  # type: str
+              ):
+        self.parts.append(s)
+        self.chars_left -= len(s)
+
+    def is_exhausted(self):
+        # type: (...) -> bool
+        return self.chars_left <= 0 or perf_counter() > self.deadline
+
+    def render(self,
+               value  # type: Any
+               ):
+        """ Renders `value` with the summarizer registered for its type """
+        summarizer = _get_summarizer(type(value))
+        if summarizer is _render_repr or summarizer is _render_str:
+            # these do not render nested values, and repr has its own recursion guard
+            summarizer(value, self)
+            return
+        key = id(value)
+        if key in self.rendering:
+            self.write(ELLIPSIS)
+            return
+        self.rendering.add(key)
+        try:
+            summarizer(value, self)
+        finally:
+            self.rendering.discard(key)
+
+
+Summarizer = Callable[[Any, RenderOutput], None]
+
+_summarizers = dict()  # type: Dict[Union[Type, str], Summarizer]
+""" The registered summarizers, by type or by qualified type name """
+
+_cache = dict()  # type: Dict[Type, Summarizer]
+""" The summarizer to use for each type, resolved from `_summarizers` using the type's mro """
+
+
+def register_summarizer(cls,        # type: Union[Type, str]
+                        summarizer  # type: Summarizer
+                        ):
+    """
+    Registers the summarizer used to render the instances of `cls` and of its subclasses. The summarizer receives the
+    value and a `RenderOutput`.
+
+    :param cls: a type, or a qualified type name such as 'numpy.ndarray' so that the module is not imported
+    :param summarizer:
+    :return:
+    """
+    _summarizers[cls] = summarizer
+    _cache.clear()
+
+
+def _get_summarizer(cls  # type: Type
+                    ):
+    # type: (...) -> Summarizer
+    try:
+        return _cache[cls]
+    except KeyError:
+        pass
+    summarizer = _render_repr
+    for c in cls.__mro__:
+        s = _summarizers.get(c) or _summarizers.get("%s.%s" % (c.__module__, c.__qualname__))
+        if s is not None:
+            summarizer = s
+            break
+    _cache[cls] = summarizer
+    return summarizer
+
+
+def render(value,             # type: Any
+           max_chars=None,    # type: int
+           max_seconds=None   # type: float
+           ):
+    # type: (...) -> str
+    """
+    Renders `value` as a string of at most `max_chars` characters, stopping after about `max_seconds`. Small values
+    are rendered as with `repr`; truncated parts are replaced with '...'.
+
+    :param value:
+    :param max_chars: the maximum number of characters. Default `DEFAULT_MAX_CHARS`.
+    :param max_seconds: the maximum duration. Default `DEFAULT_MAX_SECONDS`.
+    :return:
+    """
+    if max_chars is None:
+        max_chars = DEFAULT_MAX_CHARS
+    out = RenderOutput(max_chars, DEFAULT_MAX_SECONDS if max_seconds is None else max_seconds)
+    out.render(value)
+    result = ''.join(out.parts)
+    if len(result) > max_chars:
+        result = result[:max(0, max_chars - len(ELLIPSIS))] + ELLIPSIS
+    return result
+
+
+# ------- Summarizers
+def _size_of(value):
+    # type: (...) -> Optional[Tuple[str, int]]
+    """
+    Returns the number of items ('len') or bytes ('nbytes') of `value`, or None if it has none. Reading them does not
+    render the value, and for most types the repr is at least as long.
+    """
+    try:
+        return 'len', len(value)
+    except Exception:
+        pass
+    try:
+        nbytes = value.nbytes
+    except Exception:
+        return None
+    return ('nbytes', nbytes) if isinstance(nbytes, int) else None
+
+
+def _render_repr(value, out):
+    """ The default summarizer: `repr`, truncated. Values with more items or bytes than the budget are summarized. """
+    size = _size_of(value)
+    if size is not None and size[1] > out.chars_left:
+        # the repr would be built entirely before being truncated
+        out.write("%s(%s=%s)" % (type(value).__name__, size[0], size[1]))
+        return
+    r = repr(value)
+    if len(r) > out.chars_left:
+        r = r[:max(0, out.chars_left)] + ELLIPSIS
+    out.write(r)
+
+
+def _render_str(value, out):
+    """ Strings and bytes: only the beginning is copied """
+    left = max(0, out.chars_left)
+    if len(value) <= left:
+        out.write(repr(value))
+    else:
+        out.write("%r%s(%s chars)" % (value[:left], ELLIPSIS, len(value)))
+
+
+def _render_items(items,    # type: Iterable
+                  length,   # type: int
+                  opening,  # type: str
+                  closing,  # type: str
+                  out,      # type: RenderOutput
+                  pairs=False
+                  ):
+    """ Renders the items of a container lazily, until the budget is exhausted """
+    out.write(opening)
+    i = 0
+    for item in items:
+        if out.is_exhausted():
+            out.write("%s(%s more)" % (ELLIPSIS, length - i))
+            break
+        if i > 0:
+            out.write(', ')
+        if pairs:
+            out.render(item[0])
+            out.write(': ')
+            out.render(item[1])
+        else:
+            out.render(item)
+        i += 1
+    out.write(closing)
+
+
+def _render_container(value,    # type: Any
+                      base,     # type: Type
+                      opening,  # type: str
+                      closing,  # type: str
+                      out,      # type: RenderOutput
+                      items=None,
+                      pairs=False
+                      ):
+    """ Renders a container of type `base`. Subclasses such as namedtuple have their own repr, used when small. """
+    if type(value) is not base:
+        if len(value) <= _SMALL_ARRAY_SIZE:
+            _render_repr(value, out)
+            return
+        opening = "%s(%s" % (type(value).__name__, opening)
+        closing = "%s)" % closing
+    _render_items(value if items is None else items, len(value), opening, closing, out, pairs=pairs)
+
+
+def _render_list(value, out):
+    _render_container(value, list, '[', ']', out)
+
+
+def _render_tuple(value, out):
+    if type(value) is tuple and len(value) == 1:
+        out.write('(')
+        out.render(value[0])
+        out.write(',)')
+    else:
+        _render_container(value, tuple, '(', ')', out)
+
+
+def _render_set(value, out):
+    if len(value) == 0:
+        _render_repr(value, out)
+    elif type(value) is set:
+        _render_items(value, len(value), '{', '}', out)
+    else:
+        _render_items(value, len(value), '%s({' % type(value).__name__, '})', out)
+
+
+def _render_dict(value, out):
+    _render_container(value, dict, '{', '}', out, items=value.items(), pairs=True)
+
+
+def _render_array(value, out):
+    """ numpy arrays: shape and dtype, except for small arrays """
+    if value.size <= _SMALL_ARRAY_SIZE:
+        _render_repr(value, out)
+    else:
+        out.write("%s(shape=%s, dtype=%s)" % (type(value).__name__, value.shape, value.dtype))
+
+
+def _render_frame(value, out):
+    """ pandas DataFrames: shape and columns """
+    out.write("%s(shape=%s, columns=" % (type(value).__name__, value.shape))
+    columns = value.columns
+    _render_items(columns, len(columns), '[', ']', out)
+    out.write(')')
+
+
+def _render_series(value, out):
+    """ pandas Series: name, length and dtype """
+    out.write("%s(name=" % type(value).__name__)
+    out.render(value.name)
+    out.write(", length=%s, dtype=%s)" % (len(value), value.dtype))
+
+
+for _cls, _summarizer in ((str, _render_str), (bytes, _render_str), (list, _render_list), (tuple, _render_tuple),
+                          (set, _render_set), (frozenset, _render_set), (dict, _render_dict),
+                          ('numpy.ndarray', _render_array),
+                          # recent versions of pandas set the __module__ of their public types to 'pandas'
+                          ('pandas.DataFrame', _render_frame), ('pandas.core.frame.DataFrame', _render_frame),
+                          ('pandas.Series', _render_series), ('pandas.core.series.Series', _render_series)):
+    register_summarizer(_cls, _summarizer)
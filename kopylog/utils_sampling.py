@@ -0,0 +1,120 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+from itertools import count
+from threading import Lock
+
+from kopylog.utils_clock import perf_counter_ns
+
+try:  # python 3.5+
+    from typing import Union
+except ImportError:
+    pass
+
+
+class Sampler(object):
+    """
+    Decides which calls of a given phase id are recorded. `sample()` is called once for each call and returns the
+    number of calls that the recorded phase represents (its weight), or 0 if the call should not be recorded.
+
+    Unsampled calls should be as cheap as possible: no object creation, no lock and no clock read if possible.
+    """
+    __slots__ = ()
+
+    def sample(self):
+        # type: (...) -> int
+        raise NotImplementedError()
+
+
+class EveryNSampler(Sampler):
+    """ Records one call every `n` calls, with weight `n` """
+    __slots__ = 'n', '_counter'
+
+    def __init__(self,
+                 n  # type: int
+                 ):
+        if n < 1:
+            raise ValueError("n should be a positive integer: %r" % n)
+        self.n = n
+        # next() on a count is atomic with the GIL, so this is thread-safe
+        self._counter = count()
+
+    def sample(self):
+        # type: (...) -> int
+        n = self.n
+        return n if next(self._counter) % n == 0 else 0
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.n)
+
+
+_CLOCK_PERIOD = 16
+""" The number of unsampled calls between two clock reads of a `RateSampler` """
+
+
+class RateSampler(Sampler):
+    """
+    Records about `per_second` calls per second. This is an `EveryNSampler` whose `n` is adjusted every `window`
+    seconds from the observed call rate. Unsampled calls also read the clock once every `_CLOCK_PERIOD` calls, and
+    the first of them after the end of a window is recorded and adjusts `n`: this way `n` decreases even if the call
+    rate dropped far below `n` calls per window. The weight of a recorded phase is the exact number of calls since the
+    previous recorded one.
+    """
+    __slots__ = 'per_second', 'window_ns', 'n', '_counter', '_lock', '_last_idx', '_window_start_ns', \
+                '_window_start_idx', '_window_end_ns'
+
+    def __init__(self,
+                 per_second,  # type: float
+                 window=1.    # type: float
+                 ):
+        """
+
+        :param per_second: the target number of recorded calls per second
+        :param window: the time in seconds between two adjustments of the sampling period
+        """
+        if per_second <= 0:
+            raise ValueError("per_second should be positive: %r" % per_second)
+        self.per_second = per_second
+        self.window_ns = int(window * 1e9)
+        self.n = 1
+        self._counter = count()
+        self._lock = Lock()
+        self._last_idx = -1
+        self._window_start_ns = None
+        self._window_start_idx = 0
+        self._window_end_ns = 0
+
+    def sample(self):
+        # type: (...) -> int
+        idx = next(self._counter)
+        if idx % self.n != 0 and (idx % _CLOCK_PERIOD != 0 or perf_counter_ns() < self._window_end_ns):
+            return 0
+
+        with self._lock:
+            weight = idx - self._last_idx
+            if weight <= 0:
+                # another thread already recorded a later call
+                return 0
+            self._last_idx = idx
+
+            now = perf_counter_ns()
+            if now >= self._window_end_ns:
+                if self._window_start_ns is not None:
+                    calls_per_second = (idx - self._window_start_idx) * 1e9 / (now - self._window_start_ns)
+                    self.n = max(1, int(round(calls_per_second / self.per_second)))
+                self._window_start_ns = now
+                self._window_start_idx = idx
+                self._window_end_ns = now + self.window_ns
+        return weight
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.per_second)
+
+
+def to_sampler(sampling  # type: Union[int, Sampler]
+               ):
+    # type: (...) -> Sampler
+    """ Returns `sampling` if it is a `Sampler`, or an `EveryNSampler` if it is an integer """
+    if isinstance(sampling, Sampler):
+        return sampling
+    return EveryNSampler(sampling)
@@ -0,0 +1,234 @@
+#  Authors: Sylvain Marie <sylvain.marie@se.com>
+#
+#  License: BSD 3 clause
+from math import ceil, log
+
+try:  # python 3.5+
+    from typing import Dict, Iterable, Optional
+except ImportError:
+    pass
+
+
+class LogHistogram(object):
+    """
+    A mergeable histogram of positive values with logarithmic buckets, in the spirit of DDSketch: quantiles are
+    estimated with a bounded relative error `relative_accuracy`, and the number of buckets is at most `max_buckets`
+    (the lowest buckets are collapsed when this limit is reached). Memory is therefore fixed.
+
+    Values can be added with a weight, for example to account for sampling.
+    """
+    __slots__ = 'relative_accuracy', 'max_buckets', '_gamma', '_log_gamma', 'buckets', 'zero_count', 'count'
+
+    def __init__(self,
+                 relative_accuracy=0.01,  # type: float
+                 max_buckets=2048         # type: int
+                 ):
+        """
+
+        :param relative_accuracy: the relative accuracy of the quantile estimates
+        :param max_buckets: the maximum number of buckets
+        """
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = log(self._gamma)
+        self.buckets = dict()  # type: Dict[int, float]
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self,
+            value,    # type: float
+            weight=1  # type: float
+            ):
+        """
+        Adds a value. Values lower or equal to zero are counted in a special bucket.
+
+        :param value:
+        :param weight:
+        :return:
+        """
+        self.count += weight
+        if value <= 0:
+            self.zero_count += weight
+            return
+        idx = int(ceil(log(value) / self._log_gamma))
+        buckets = self.buckets
+        try:
+            buckets[idx] += weight
+        except KeyError:
+            buckets[idx] = weight
+            if len(buckets) > self.max_buckets:
+                self._collapse()
+
+    def _collapse(self):
+        """ Merges the two lowest buckets """
+        buckets = self.buckets
+        lowest, second = sorted(buckets)[:2]
+        buckets[second] += buckets.pop(lowest)
+
+    def merge(self,
+              other  # type: LogHistogram
+              ):
+        """
+        Adds all values of `other` to this histogram. Both should have the same relative accuracy.
+
+        :param other:
+        :return:
+        """
+        if other._gamma != self._gamma:
+            raise ValueError("Histograms with different relative accuracies can not be merged")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        buckets = self.buckets
+        # list() copies atomically: other may be updated by another thread
+        for idx, weight in list(other.buckets.items()):
+            buckets[idx] = buckets.get(idx, 0) + weight
+        while len(buckets) > self.max_buckets:
+            self._collapse()
+
+    def quantile(self,
+                 q  # type: float
+                 ):
+        # type: (...) -> Optional[float]
+        """
+        Returns an estimate of the `q` quantile (0 <= q <= 1), or None if the histogram is empty.
+
+        :param q:
+        :return:
+        """
+        if self.count <= 0:
+            return None
+        rank = q * self.count
+        cumulated = self.zero_count
+        if cumulated >= rank and self.zero_count > 0:
+            return 0.
+        idx = None
+        for idx in sorted(self.buckets):
+            cumulated += self.buckets[idx]
+            if cumulated >= rank:
+                break
+        # the value in the middle of the bucket, in relative terms
+        return 2 * self._gamma ** idx / (self._gamma + 1)
+
+
+class PhaseStats(object):
+    """
+    Streaming statistics about the durations of repeated phases: count, sum, min, max, mean, and quantiles estimated
+    with a `LogHistogram`. The memory used is fixed.
+
+    Durations can be added with a weight, to account for sampling: `count` and `sum` are then estimates, while
+    `nb_recorded` is the actual number of durations added.
+    """
+    __slots__ = 'phase_id', 'count', 'nb_recorded', 'sum', 'min', 'max', 'histogram'
+
+    def __init__(self,
+                 phase_id=None,          # type: str
+                 relative_accuracy=0.01  # type: float
+                 ):
+        """
+
+        :param phase_id:
+        :param relative_accuracy: the relative accuracy of the quantiles
+        """
+        self.phase_id = phase_id
+        self.count = 0
+        self.nb_recorded = 0
+        self.sum = 0.
+        self.min = None  # type: Optional[float]
+        self.max = None  # type: Optional[float]
+        self.histogram = LogHistogram(relative_accuracy)
+
+    def add(self,
+            seconds,  # type: float
+            weight=1  # type: float
+            ):
+        """
+        Adds a phase duration.
+
+        :param seconds:
+        :param weight: the number of phases that this duration represents, for example when sampling
+        :return:
+        """
+        self.count += weight
+        self.nb_recorded += 1
+        self.sum += seconds * weight
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.histogram.add(seconds, weight)
+
+    def merge(self,
+              other  # type: PhaseStats
+              ):
+        """
+        Adds all durations of `other` to these statistics.
+
+        :param other:
+        :return:
+        """
+        self.count += other.count
+        self.nb_recorded += other.nb_recorded
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.histogram.merge(other.histogram)
+
+    @classmethod
+    def merged(cls,
+               stats  # type: Iterable[PhaseStats]
+               ):
+        # type: (...) -> PhaseStats
+        """ Returns a new `PhaseStats` merging all the given ones """
+        result = None
+        for s in stats:
+            if result is None:
+                result = cls(s.phase_id, s.histogram.relative_accuracy)
+            result.merge(s)
+        return result
+
+    @property
+    def mean(self):
+        # type: (...) -> Optional[float]
+        return self.sum / self.count if self.count > 0 else None
+
+    @property
+    def sampling_rate(self):
+        # type: (...) -> Optional[float]
+        """ The ratio of recorded durations over the (estimated) number of phases """
+        return self.nb_recorded / self.count if self.count > 0 else None
+
+    def quantile(self,
+                 q  # type: float
+                 ):
+        # type: (...) -> Optional[float]
+        """ Returns an estimate of the `q` quantile (0 <= q <= 1) of the durations """
+        value = self.histogram.quantile(q)
+        if value is None:
+            return None
+        # the estimate can be made more precise using the exact min and max
+        return min(max(value, self.min), self.max)
+
+    @property
+    def p50(self):
+        return self.quantile(0.5)
+
+    @property
+    def p95(self):
+        return self.quantile(0.95)
+
+    @property
+    def p99(self):
+        return self.quantile(0.99)
+
+    def to_dict(self):
+        # type: (...) -> Dict[str, Optional[float]]
+        """ Returns all statistics as a dictionary """
+        return {'phase_id': self.phase_id, 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.mean, 'p50': self.p50, 'p95': self.p95, 'p99': self.p99,
+                'sampling_rate': self.sampling_rate}
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % i for i in self.to_dict().items()))
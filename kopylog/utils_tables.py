@@ -2,12 +2,18 @@
 #
 #  License: BSD 3 clause
 
+import sys
 from collections import OrderedDict
+from itertools import chain
+from operator import attrgetter
+from threading import local, Lock
+from time import monotonic
 
 from kopylog.utils_bags import ODict
+from kopylog.utils_render import render
 
 try:  # python 3.5+
-    from typing import Any
+    from typing import Any, Callable, Iterable, Iterator, List, Tuple, Dict, Optional, MutableMapping, Set
     ValueType = Any
 #     from typing import Generic, TypeVar
 # 
@@ -24,6 +30,161 @@ except:
     pass
 
 
+def approx_sizeof(entry  # type: Any
+                  ):
+    # type: (...) -> int
+    """
+    A cheap approximation of the memory used by an entry: its own size plus, for entries having an `odict` (such as
+    `OrderedMunch`), the shallow size of this dict and of its keys and values.
+
+    :param entry:
+    :return:
+    """
+    size = sys.getsizeof(entry)
+    try:
+        odict = entry.odict
+    except AttributeError:
+        return size
+    if odict:
+        getsizeof = sys.getsizeof
+        size += getsizeof(odict) + sum(getsizeof(k) + getsizeof(v) for k, v in odict.items())
+    return size
+
+
+class RetentionPolicy(object):
+    """
+    Limits on what a `TypedTable` retains. When a limit is exceeded, the oldest entries are evicted (removed) and passed
+    to `on_evict`. Any combination of limits can be used:
+
+     - `max_entries`: a maximum number of entries,
+     - `max_age`: a maximum age in seconds, since the entry was appended,
+     - `max_bytes`: an approximate memory budget, computed with `sizeof` when entries are appended, and again when
+       they are resized (a `Kompanion` resizes its phases when they stop).
+
+    Limits are enforced when entries are appended, or when `TypedTable.enforce_retention()` is called.
+    """
+    __slots__ = 'max_entries', 'max_age', 'max_bytes', 'on_evict', 'sizeof'
+
+    def __init__(self,
+                 max_entries=None,     # type: int
+                 max_age=None,         # type: float
+                 max_bytes=None,       # type: int
+                 on_evict=None,        # type: Callable[[Any], Any]
+                 sizeof=approx_sizeof  # type: Callable[[Any], int]
+                 ):
+        """
+
+        :param max_entries: the maximum number of entries
+        :param max_age: the maximum age of entries, in seconds
+        :param max_bytes: the approximate maximum memory used by entries, in bytes
+        :param on_evict: an optional callback receiving each evicted entry, for example to archive or aggregate it
+        :param sizeof: the function used to estimate the size of an entry when `max_bytes` is set. Default is
+            `approx_sizeof`. Note that the size is only computed when the entry is appended, and when it is resized
+            with `TypedTable.resize`.
+        """
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.sizeof = sizeof
+
+
+class _RetentionState(object):
+    """ The bookkeeping of a `TypedTable` with a `RetentionPolicy` """
+    __slots__ = 'policy', 'on_remove', 'times', 'sizes', 'total_bytes', 'nb_evicted', 'evicted_bytes', 'deferred'
+
+    def __init__(self,
+                 policy,         # type: RetentionPolicy
+                 on_remove=None  # type: Callable[[Any], Any]
+                 ):
+        self.policy = policy
+        self.on_remove = on_remove
+        self.times = dict()  # type: Dict[Any, float]
+        self.sizes = dict()  # type: Dict[Any, int]
+        self.total_bytes = 0
+        self.nb_evicted = 0
+        self.evicted_bytes = 0
+        # when a list, the (callback, entry) calls are appended to it instead of being made, see `ConcurrentTypedTable`
+        self.deferred = None  # type: Optional[List[Tuple[Callable[[Any], Any], Any]]]
+
+    def _call(self,
+              callback,  # type: Callable[[Any], Any]
+              entry
+              ):
+        """ Calls callback(entry), or defers this call """
+        if self.deferred is None:
+            callback(entry)
+        else:
+            self.deferred.append((callback, entry))
+
+    def add(self,
+            odict,  # type: OrderedDict
+            key,
+            entry
+            ):
+        """ Adds an entry at the end of odict, then enforces the policy """
+        replaced = odict.pop(key, None)
+        if replaced is not None:
+            self.forget(key)
+            if self.on_remove is not None and replaced is not entry:
+                self._call(self.on_remove, replaced)
+        odict[key] = entry
+        policy = self.policy
+        if policy.max_age is not None:
+            self.times[key] = monotonic()
+        if policy.max_bytes is not None:
+            size = self.sizes[key] = policy.sizeof(entry)
+            self.total_bytes += size
+        self.enforce(odict)
+
+    def resize(self,
+               odict,  # type: OrderedDict
+               key,
+               entry
+               ):
+        """ Measures the size of an entry again if it is retained, then enforces the policy """
+        if self.policy.max_bytes is not None and key in self.sizes and odict.get(key) is entry:
+            size = self.policy.sizeof(entry)
+            self.total_bytes += size - self.sizes[key]
+            self.sizes[key] = size
+            self.enforce(odict)
+
+    def forget(self, key):
+        """ Forgets the bookkeeping about a removed entry """
+        self.times.pop(key, None)
+        self.total_bytes -= self.sizes.pop(key, 0)
+
+    def enforce(self,
+                odict  # type: OrderedDict
+                ):
+        """ Evicts the oldest entries until all limits are satisfied """
+        policy = self.policy
+        if policy.max_entries is not None:
+            while len(odict) > policy.max_entries:
+                self._evict_oldest(odict)
+        if policy.max_age is not None and odict:
+            limit = monotonic() - policy.max_age
+            times = self.times
+            while odict and times.get(next(iter(odict)), limit) < limit:
+                self._evict_oldest(odict)
+        if policy.max_bytes is not None:
+            while odict and self.total_bytes > policy.max_bytes:
+                self._evict_oldest(odict)
+
+    def _evict_oldest(self,
+                      odict  # type: OrderedDict
+                      ):
+        key, entry = odict.popitem(last=False)
+        self.nb_evicted += 1
+        self.evicted_bytes += self.sizes.get(key, 0)
+        self.forget(key)
+        if self.on_remove is not None:
+            self._call(self.on_remove, entry)
+        on_evict = self.policy.on_evict
+        if on_evict is not None:
+            self._call(on_evict, entry)
+
+
 class TypedTable(object):  # TODO maybe one day inherit OrderedMunch
     """
     An ordered key-value container of entries (= and OrderedDict)
@@ -33,21 +194,35 @@ class TypedTable(object):  # TODO maybe one day inherit OrderedMunch
 
 
     This makes us able to provide to_df() and from_df() methods at the container level.
+
+    An optional `RetentionPolicy` can limit the number, age or memory size of the entries retained.
     """
-    __slots__ = ('odict', 'value_type', 'key_name')
+    __slots__ = ('odict', 'value_type', 'key_name', '_retention', '_on_remove')
 
     def __init__(self,
-                 value_type,    # type: Any
-                 key_name       # type: str
+                 value_type,     # type: Any
+                 key_name,       # type: str
+                 retention=None,  # type: RetentionPolicy
+                 on_remove=None   # type: Callable[[ValueType], Any]
                  ):
         """
 
         :param value_type:
         :param key_name:
+        :param retention: an optional `RetentionPolicy`
+        :param on_remove: an optional callback receiving each entry removed from the table: discarded, evicted by
+            the retention policy, or replaced by another entry with the same id.
         """
-        self.odict = ODict()
         self.value_type = value_type
         self.key_name = key_name
+        self._on_remove = on_remove
+        if retention is None:
+            self.odict = ODict()
+            self._retention = None
+        else:
+            # OrderedDict is able to pop its oldest entry in constant time
+            self.odict = OrderedDict()
+            self._retention = _RetentionState(retention, on_remove)
 
     def append(self,
                entry  # type: ValueType
@@ -58,11 +233,135 @@ class TypedTable(object):  # TODO maybe one day inherit OrderedMunch
         :param entry:
         :return:
         """
-        self.odict[getattr(entry, self.key_name)] = entry
+        if self._retention is not None:
+            self._retention.add(self.odict, getattr(entry, self.key_name), entry)
+        elif self._on_remove is None:
+            self.odict[getattr(entry, self.key_name)] = entry
+        else:
+            key = getattr(entry, self.key_name)
+            replaced = self.odict.get(key)
+            self.odict[key] = entry
+            if replaced is not None and replaced is not entry:
+                self._on_remove(replaced)
+
+    def extend(self,
+               entries  # type: Iterable[ValueType]
+               ):
+        """
+        Adds several entries to this container, in order. This is faster than appending them one by one.
+
+        :param entries:
+        :return:
+        """
+        if self._retention is None and self._on_remove is None:
+            entries = list(entries)
+            self.odict.update(zip(map(attrgetter(self.key_name), entries), entries))
+        else:
+            for entry in entries:
+                self.append(entry)
+
+    @property
+    def retention(self):
+        # type: (...) -> Optional[RetentionPolicy]
+        """ The retention policy of this table, if any """
+        return None if self._retention is None else self._retention.policy
+
+    @property
+    def nb_evicted(self):
+        # type: (...) -> int
+        """ The number of entries evicted so far by the retention policy """
+        return 0 if self._retention is None else self._retention.nb_evicted
+
+    @property
+    def evicted_bytes(self):
+        # type: (...) -> int
+        """ The approximate size of the entries evicted so far, when the retention policy has a `max_bytes` """
+        return 0 if self._retention is None else self._retention.evicted_bytes
+
+    @property
+    def retained_bytes(self):
+        # type: (...) -> int
+        """ The approximate size of the retained entries, when the retention policy has a `max_bytes` """
+        return 0 if self._retention is None else self._retention.total_bytes
+
+    def enforce_retention(self):
+        """ Evicts the entries that do not satisfy the retention policy anymore, typically because of their age """
+        if self._retention is not None:
+            self._retention.enforce(self.odict)
+
+    def resize(self,
+               entry  # type: ValueType
+               ):
+        """
+        Measures the size of an entry again, after it was modified, when the retention policy has a `max_bytes`. This
+        may evict the oldest entries.
+
+        :param entry:
+        :return:
+        """
+        if self._retention is not None:
+            self._retention.resize(self.odict, getattr(entry, self.key_name), entry)
+
+    def discard(self,
+                entry  # type: ValueType
+                ):
+        """
+        Removes an entry from this container, if present. Note that an entry with the same id that replaced it is not
+        removed.
+
+        :param entry:
+        :return:
+        """
+        key = getattr(entry, self.key_name)
+        if self.odict.get(key) is entry:
+            del self.odict[key]
+            if self._retention is not None:
+                self._retention.forget(key)
+            if self._on_remove is not None:
+                self._on_remove(entry)
+
+    def keys(self):
+        # type: (...) -> List[Any]
+        """ Returns the list of entry ids, in order """
+        return list(self.odict.keys())
+
+    def values(self):
+        # type: (...) -> List[ValueType]
+        """ Returns the list of entries, in order """
+        return list(self.odict.values())
+
+    def items(self):
+        # type: (...) -> List[Tuple[Any, ValueType]]
+        """ Returns the list of (id, entry) pairs, in order """
+        return list(self.odict.items())
+
+    def __getitem__(self, key):
+        # type: (...) -> ValueType
+        return self.odict[key]
+
+    def __contains__(self, key):
+        return key in self.odict
+
+    def __iter__(self):
+        # type: (...) -> Iterator[ValueType]
+        """ Iterates over the entries (not the ids, since entries know their id) """
+        return iter(self.values())
+
+    def __len__(self):
+        return len(self.odict)
+
+    def _reduce_args(self):
+        # type: (...) -> Tuple[Any, ...]
+        """ The constructor arguments used to rebuild this table when it is unpickled. The retention is not kept. """
+        return self.value_type, self.key_name
+
+    def __reduce__(self):
+        """ Compact wire format: the constructor arguments and the list of entries """
+        return _restore_table, (type(self), self._reduce_args(), self.values())
 
     def __str__(self):
         # since all entries have their id in their str representation, do not display the keys(), only values() ?
-        return "{cn} - {dct}".format(cn=type(self).__name__, dct=list(self.odict.values()))
+        return "{cn} - {dct}".format(cn=type(self).__name__, dct=render(self.values()))
 
     # ------ MappingProxyMixIn implementation
 
@@ -128,6 +427,242 @@ class TypedTable(object):  # TODO maybe one day inherit OrderedMunch
     #     return new_instance
 
 
+def _restore_table(cls,
+                   args,    # type: Tuple[Any, ...]
+                   entries  # type: List[ValueType]
+                   ):
+    # type: (...) -> TypedTable
+    """ Rebuilds a table from its wire format. See `TypedTable.__reduce__` """
+    table = cls(*args)
+    key_name = table.key_name
+    for entry in entries:
+        table.odict[getattr(entry, key_name)] = entry
+    return table
+
+
+class ConcurrentTypedTable(TypedTable):
+    """
+    A `TypedTable` where several threads can append entries concurrently.
+
+    Each thread appends to its own buffer without taking any lock. The buffers are merged into the table when it is
+    read (`keys()`, `values()`, `items()`, `len()`, ...), in the order given by `sort_key`. Note that this relies on
+    list `append`/`del` being atomic, as is the case in CPython.
+
+    When the table has a retention policy, or when entries were discarded, the buffers are also merged by `append`
+    as soon as the buffer of the current thread holds `buffer_size` entries, or when the `max_age` of the policy has
+    elapsed since the last merge. This way the memory stays bounded even if the table is never read.
+    """
+    __slots__ = ('sort_key', 'buffer_size', '_local', '_buffers', '_lock', '_discarded', '_next_age_merge')
+
+    def __init__(self,
+                 value_type,        # type: Any
+                 key_name,          # type: str
+                 sort_key,          # type: Callable[[ValueType], Any]
+                 retention=None,    # type: RetentionPolicy
+                 buffer_size=1024,  # type: int
+                 on_remove=None     # type: Callable[[ValueType], Any]
+                 ):
+        """
+
+        :param value_type:
+        :param key_name:
+        :param sort_key: a function returning the key used to sort entries coming from different threads
+        :param retention: an optional `RetentionPolicy`. It is enforced when buffers are merged, and new entries are
+            appended after the existing ones in this case.
+        :param buffer_size: the number of entries in a thread buffer above which `append` merges the buffers, when
+            there is a retention policy or discarded entries. Default 1024.
+        :param on_remove: see `TypedTable`
+        """
+        super(ConcurrentTypedTable, self).__init__(value_type, key_name, retention=retention, on_remove=on_remove)
+        self.sort_key = sort_key
+        self.buffer_size = buffer_size
+        self._local = local()
+        self._buffers = []  # type: List[List[ValueType]]
+        self._lock = Lock()
+        self._discarded = set()  # the discarded entries that may still be in a buffer (entries must be hashable)
+        # the monotonic time after which append merges the buffers to evict old entries, or None
+        self._next_age_merge = None if retention is None or retention.max_age is None else monotonic()
+
+    def append(self,
+               entry  # type: ValueType
+               ):
+        """
+        Adds an entry to the buffer of the current thread. It will be visible in the table on next read.
+
+        :param entry:
+        :return:
+        """
+        try:
+            buffer = self._local.buffer
+        except AttributeError:
+            # first append from this thread: register its buffer
+            buffer = self._local.buffer = []
+            with self._lock:
+                self._buffers.append(buffer)
+        buffer.append(entry)
+        if len(buffer) >= self.buffer_size:
+            if self._retention is not None or self._discarded:
+                self._merge()
+        elif self._next_age_merge is not None and monotonic() >= self._next_age_merge:
+            self._merge()
+
+    def extend(self,
+               entries  # type: Iterable[ValueType]
+               ):
+        """
+        Adds several entries to the buffer of the current thread. They will be visible in the table on next read.
+
+        :param entries:
+        :return:
+        """
+        for entry in entries:
+            self.append(entry)
+
+    def discard(self,
+                entry  # type: ValueType
+                ):
+        """
+        Removes an entry from this container, if present. If the entry is still in a thread buffer, it will be removed
+        on next merge.
+
+        :param entry:
+        :return:
+        """
+        with self._lock:
+            self._discarded.add(entry)
+            if self._retention is None:
+                # with a retention policy the bookkeeping is only modified on next merge
+                key = getattr(entry, self.key_name)
+                if self.odict.get(key) is entry:
+                    del self.odict[key]
+        if self._on_remove is not None:
+            self._on_remove(entry)
+
+    def resize(self,
+               entry  # type: ValueType
+               ):
+        """
+        See `TypedTable.resize`. An entry still in a thread buffer is measured when the buffers are merged.
+
+        :param entry:
+        :return:
+        """
+        if self._retention is not None:
+            deferred = []  # type: List[Tuple[Callable[[Any], Any], Any]]
+            with self._lock:
+                self._retention.deferred = deferred
+                try:
+                    self._retention.resize(self.odict, getattr(entry, self.key_name), entry)
+                finally:
+                    self._retention.deferred = None
+            _call_all(deferred)
+
+    def _merge(self):
+        """ Moves all buffered entries into the table, sorted with `sort_key` """
+        # the callbacks are called once the lock is released, so that they can read this table
+        deferred = []  # type: List[Tuple[Callable[[Any], Any], Any]]
+        try:
+            self._merge_entries(deferred)
+        finally:
+            _call_all(deferred)
+
+    def _merge_entries(self,
+                       deferred  # type: List[Tuple[Callable[[Any], Any], Any]]
+                       ):
+        """ Merges the buffers under the lock, appending the (callback, entry) calls to make to `deferred` """
+        with self._lock:
+            if self._next_age_merge is not None:
+                self._next_age_merge = monotonic() + self._retention.policy.max_age
+            new_entries = []
+            for buffer in self._buffers:
+                # only the first n items are removed: other threads may be appending at the same time
+                n = len(buffer)
+                if n > 0:
+                    new_entries.extend(buffer[:n])
+                    del buffer[:n]
+
+            discarded = self._discarded
+            if self._retention is not None:
+                self._retention.deferred = deferred
+                try:
+                    self._merge_retained(new_entries, discarded)
+                finally:
+                    self._retention.deferred = None
+
+            elif new_entries or discarded:
+                if discarded:
+                    self._discarded = set()
+                key_name = self.key_name
+                on_remove = self._on_remove
+                odict = ODict()
+                for entry in sorted(chain(self.odict.values(), new_entries), key=self.sort_key):
+                    if entry not in discarded:
+                        key = getattr(entry, key_name)
+                        if on_remove is not None:
+                            replaced = odict.get(key)
+                            if replaced is not None:
+                                deferred.append((on_remove, replaced))
+                        odict[key] = entry
+                self.odict = odict
+
+    def _merge_retained(self,
+                        new_entries,  # type: List[ValueType]
+                        discarded     # type: Set[ValueType]
+                        ):
+        """ Removes the discarded entries and adds the new ones, enforcing the retention policy, under the lock """
+        key_name = self.key_name
+        if discarded:
+            self._discarded = set()
+            # on_remove was already called by discard()
+            odict = self.odict
+            for entry in discarded:
+                key = getattr(entry, key_name)
+                if odict.get(key) is entry:
+                    del odict[key]
+                    self._retention.forget(key)
+        for entry in sorted(new_entries, key=self.sort_key):
+            if entry not in discarded:
+                self._retention.add(self.odict, getattr(entry, key_name), entry)
+        self._retention.enforce(self.odict)
+
+    def _reduce_args(self):
+        return self.value_type, self.key_name, self.sort_key
+
+    def enforce_retention(self):
+        self._merge()
+
+    def keys(self):
+        self._merge()
+        return super(ConcurrentTypedTable, self).keys()
+
+    def values(self):
+        self._merge()
+        return super(ConcurrentTypedTable, self).values()
+
+    def items(self):
+        self._merge()
+        return super(ConcurrentTypedTable, self).items()
+
+    def __getitem__(self, key):
+        self._merge()
+        return super(ConcurrentTypedTable, self).__getitem__(key)
+
+    def __contains__(self, key):
+        self._merge()
+        return super(ConcurrentTypedTable, self).__contains__(key)
+
+    def __len__(self):
+        self._merge()
+        return super(ConcurrentTypedTable, self).__len__()
+
+
+def _call_all(calls  # type: List[Tuple[Callable[[Any], Any], Any]]
+              ):
+    """ Makes the (callback, entry) calls deferred by `ConcurrentTypedTable` """
+    for callback, entry in calls:
+        callback(entry)
+
+
 # class TypedTableField(TypedTable):
 #     """
 #     Implements the descriptor protocol over a typed table